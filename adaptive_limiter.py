@@ -0,0 +1,152 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from groq import APIStatusError, APITimeoutError
+
+from latency_metrics import key_label
+
+# Limite inicial, mínimo e máximo de chamadas simultâneas por chave e modelo
+LIMITER_INITIAL_LIMIT = 4.0
+LIMITER_MIN_LIMIT = 1.0
+LIMITER_MAX_LIMIT = 16.0
+
+# Fator de redução do limite a cada limite de taxa ou tempo esgotado (diminuição multiplicativa)
+LIMITER_DECREASE_FACTOR = 0.5
+
+# Tempo máximo (s) de espera por uma vaga antes de desistir da chamada
+LIMITER_ACQUIRE_TIMEOUT = 60
+
+# Falhas seguidas que abrem o disjuntor de uma chave e modelo
+BREAKER_FAILURE_THRESHOLD = 5
+
+# Tempo (s) em que o disjuntor fica aberto antes de liberar uma chamada de teste
+BREAKER_OPEN_SECONDS = 30
+
+# Resultados que indicam sobrecarga do serviço: reduzem o limite e contam como falha no disjuntor.
+# Os demais erros (por exemplo, 400 por uma requisição inválida) não dizem nada sobre a saúde do serviço
+OVERLOAD_OUTCOMES = ('rate_limited', 'timeout', 'server_error')
+
+# Todas as situações de erro que classify_error pode devolver
+ERROR_OUTCOMES = ('error', 'circuit_open') + OVERLOAD_OUTCOMES
+
+_lock = threading.Lock()
+_changed = threading.Condition(_lock)
+_limiters = {}
+
+# Erro levantado quando o disjuntor de uma chave e modelo está aberto
+class CircuitOpenError(Exception):
+    pass
+
+# Função para classificar o erro de uma chamada
+def classify_error(error: Exception) -> str:
+    if isinstance(error, CircuitOpenError):
+        return 'circuit_open'
+    if 'rate_limit_exceeded' in str(error):
+        return 'rate_limited'
+    if isinstance(error, APITimeoutError):
+        return 'timeout'
+    if isinstance(error, APIStatusError) and error.status_code >= 500:
+        return 'server_error'
+    return 'error'
+
+# Função para obter o estado do limitador de uma chave e modelo, criando-o quando necessário
+def get_limiter(api_key: str, model_name: str) -> dict:
+    return _limiters.setdefault((api_key, model_name), {
+        'limit': LIMITER_INITIAL_LIMIT,
+        'in_flight': 0,
+        'state': 'closed',
+        'failures': 0,
+        'opened_at': 0.0,
+        'rejected': 0,
+    })
+
+# Função para verificar, sem esperar, se uma chave e modelo aceitam chamadas (disjuntor fechado ou pronto para teste)
+def is_available(api_key: str, model_name: str) -> bool:
+    with _lock:
+        limiter = _limiters.get((api_key, model_name))
+        if limiter is None or limiter['state'] != 'open':
+            return True
+        return time.time() - limiter['opened_at'] >= BREAKER_OPEN_SECONDS
+
+# Função para obter o tempo (s) até o disjuntor de uma chave e modelo liberar uma chamada de teste; 0 se já aceita chamadas
+def seconds_until_available(api_key: str, model_name: str) -> float:
+    with _lock:
+        limiter = _limiters.get((api_key, model_name))
+        if limiter is None or limiter['state'] != 'open':
+            return 0.0
+        return max(0.0, limiter['opened_at'] + BREAKER_OPEN_SECONDS - time.time())
+
+# Função para reservar uma vaga de chamada; falha imediatamente com o disjuntor aberto
+def acquire(api_key: str, model_name: str, timeout: float = LIMITER_ACQUIRE_TIMEOUT):
+    deadline = time.time() + timeout
+    with _lock:
+        limiter = get_limiter(api_key, model_name)
+        while True:
+            if limiter['state'] == 'open':
+                if time.time() - limiter['opened_at'] < BREAKER_OPEN_SECONDS:
+                    limiter['rejected'] += 1
+                    raise CircuitOpenError(f"Disjuntor aberto para o modelo {model_name} nesta chave.")
+                # Passado o tempo de espera, uma única chamada de teste decide se o disjuntor fecha
+                limiter['state'] = 'half_open'
+            elif limiter['state'] == 'half_open' and limiter['in_flight'] > 0:
+                limiter['rejected'] += 1
+                raise CircuitOpenError(f"Disjuntor em teste para o modelo {model_name} nesta chave.")
+            capacity = 1 if limiter['state'] == 'half_open' else int(limiter['limit'])
+            if limiter['in_flight'] < capacity:
+                limiter['in_flight'] += 1
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Nenhuma vaga disponível para o modelo {model_name} em {timeout} segundos.")
+            _changed.wait(remaining)
+
+# Função para liberar a vaga e ajustar o limite: aumento aditivo no sucesso, redução multiplicativa na sobrecarga.
+# Só a sobrecarga conta como falha do disjuntor; um erro da própria requisição mostra que o serviço respondeu
+def release(api_key: str, model_name: str, outcome: str):
+    with _lock:
+        limiter = get_limiter(api_key, model_name)
+        limiter['in_flight'] -= 1
+        if outcome == 'ok':
+            limiter['limit'] = min(LIMITER_MAX_LIMIT, limiter['limit'] + 1.0 / limiter['limit'])
+            limiter['failures'] = 0
+            limiter['state'] = 'closed'
+        elif outcome not in OVERLOAD_OUTCOMES:
+            limiter['failures'] = 0
+            limiter['state'] = 'closed'
+        else:
+            limiter['limit'] = max(LIMITER_MIN_LIMIT, limiter['limit'] * LIMITER_DECREASE_FACTOR)
+            limiter['failures'] += 1
+            if limiter['state'] == 'half_open' or limiter['failures'] >= BREAKER_FAILURE_THRESHOLD:
+                limiter['state'] = 'open'
+                limiter['opened_at'] = time.time()
+        _changed.notify_all()
+
+# Contexto que reserva uma vaga para a chamada e a libera com o resultado observado
+@contextmanager
+def limiter_slot(api_key: str, model_name: str):
+    acquire(api_key, model_name)
+    outcome = 'ok'
+    try:
+        yield
+    except Exception as e:
+        outcome = classify_error(e)
+        raise
+    finally:
+        release(api_key, model_name, outcome)
+
+# Função para obter o estado de todos os limitadores, com a chave identificada apenas pelo final
+def get_limiter_state() -> list:
+    with _lock:
+        return [
+            {
+                'key': key_label(api_key),
+                'model': model_name,
+                'limit': round(limiter['limit'], 2),
+                'in_flight': limiter['in_flight'],
+                'state': limiter['state'],
+                'failures': limiter['failures'],
+                'rejected': limiter['rejected'],
+            }
+            for (api_key, model_name), limiter in _limiters.items()
+        ]
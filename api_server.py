@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from aiohttp import web
+from adaptive_limiter import get_limiter_state
+from pipeline import MODEL_MAX_TOKENS, start_storage_maintenance, get_api_key, load_agents, get_interaction_number, load_chat_history, save_chat_history, fetch_assistant_response, refine_response, evaluate_response_with_rag
+from full_pipeline import run_full_pipeline
+from expert_fanout import EXPERT_FAN_OUT_SIZE, MIN_EXPERT_FAN_OUT, MAX_EXPERT_FAN_OUT, compare_experts
+from quality_gate import QUALITY_GATE_MODES, gate_refine, record_refine_result, record_evaluation
+
+logger = logging.getLogger(__name__)
+
+# Máximo de chamadas simultâneas por chave de API (configurável por variável de ambiente)
+MAX_CONCURRENCY_PER_KEY = int(os.environ.get('MAX_CONCURRENCY_PER_KEY', 4))
+
+# Quantidade padrão de interações do histórico enviadas como contexto
+DEFAULT_MEMORY = 5
+
+# Opção que pede a geração de um especialista ideal em vez de um agente do catálogo
+DEFAULT_AGENT = 'Escolher um especialista...'
+
+_key_semaphores = {}
+
+# Função para obter o semáforo que limita a concorrência da chave usada por uma ação
+def get_key_semaphore(action: str) -> asyncio.Semaphore:
+    api_key = get_api_key(action)
+    if api_key not in _key_semaphores:
+        _key_semaphores[api_key] = asyncio.Semaphore(MAX_CONCURRENCY_PER_KEY)
+    return _key_semaphores[api_key]
+
+# Função para executar uma etapa do pipeline em uma thread, respeitando o limite de concorrência da chave
+async def run_stage(action: str, stage_function, *args, **kwargs):
+    async with get_key_semaphore(action):
+        return await asyncio.to_thread(stage_function, *args, **kwargs)
+
+# Função para ler e validar os parâmetros comuns de uma requisição
+async def parse_request(request: web.Request) -> dict:
+    try:
+        payload = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text=json.dumps({'error': 'Corpo da requisição não é um JSON válido.'}), content_type='application/json')
+    if not isinstance(payload, dict):
+        raise web.HTTPBadRequest(text=json.dumps({'error': 'Corpo da requisição deve ser um objeto JSON.'}), content_type='application/json')
+    if not payload.get('user_input'):
+        raise web.HTTPBadRequest(text=json.dumps({'error': "O campo 'user_input' é obrigatório."}), content_type='application/json')
+    model_name = payload.get('model_name', next(iter(MODEL_MAX_TOKENS)))
+    memory = int(payload.get('memory', DEFAULT_MEMORY))
+    return {
+        'payload': payload,
+        'user_input': payload['user_input'],
+        'user_prompt': payload.get('user_prompt', ""),
+        'model_name': model_name,
+        'temperature': float(payload.get('temperature', 0.0)),
+        'hedge': bool(payload.get('hedge', False)),
+        'semantic_cache': payload.get('semantic_cache', 'off'),
+        'chat_history': load_chat_history(memory),
+        'interaction_number': get_interaction_number(),
+    }
+
+# Função para exigir um campo específico de uma etapa
+def require_field(payload: dict, field: str) -> str:
+    if not payload.get(field):
+        raise web.HTTPBadRequest(text=json.dumps({'error': f"O campo '{field}' é obrigatório."}), content_type='application/json')
+    return payload[field]
+
+# Função para ler o modo do filtro de qualidade aplicado antes do refinamento
+def parse_quality_gate(payload: dict) -> str:
+    mode = payload.get('quality_gate', 'off')
+    if mode not in QUALITY_GATE_MODES:
+        raise web.HTTPBadRequest(text=json.dumps({'error': f"O campo 'quality_gate' deve ser um de: {', '.join(QUALITY_GATE_MODES)}."}), content_type='application/json')
+    return mode
+
+# Função para ler a quantidade de especialistas do /experts, limitada como na interface
+def parse_expert_count(payload: dict) -> int:
+    count = payload.get('experts', EXPERT_FAN_OUT_SIZE)
+    if isinstance(count, bool) or not isinstance(count, int) or not MIN_EXPERT_FAN_OUT <= count <= MAX_EXPERT_FAN_OUT:
+        raise web.HTTPBadRequest(text=json.dumps({'error': f"O campo 'experts' deve ser um inteiro de {MIN_EXPERT_FAN_OUT} a {MAX_EXPERT_FAN_OUT}."}), content_type='application/json')
+    return count
+
+# Função para ler as referências, enviadas como textos simples ou como trechos já extraídos
+def parse_references(payload: dict) -> list:
+    return [reference if isinstance(reference, dict) else {'source': 'api', 'page': index + 1, 'text': reference} for index, reference in enumerate(payload.get('references') or [])]
+
+# Função para executar a etapa de busca da resposta do especialista
+async def run_fetch(params: dict) -> dict:
+    payload = params['payload']
+    cache_hit = {}
+    expert_title, response = await run_stage('fetch', fetch_assistant_response, params['user_input'], params['user_prompt'], params['model_name'], params['temperature'], payload.get('agent_selection', DEFAULT_AGENT), params['chat_history'], params['interaction_number'], params['hedge'], semantic_cache=params['semantic_cache'], on_cache_hit=cache_hit.update)
+    await asyncio.to_thread(save_chat_history, params['user_input'], params['user_prompt'], response)
+    return {'stage': 'fetch', 'expert_title': expert_title, 'response': response, 'cache_similarity': cache_hit.get('similarity')}
+
+# Função para executar a etapa de refinamento da resposta; com o filtro de qualidade em 'skip', uma resposta aprovada
+# volta sem refinamento (a menos que force_refine)
+async def run_refine(params: dict, expert_title: str, response: str) -> dict:
+    references = parse_references(params['payload'])
+    quality_gate = parse_quality_gate(params['payload'])
+    gate = await asyncio.to_thread(gate_refine, response, params['user_input'], params['user_prompt'], references, params['chat_history'], quality_gate, bool(params['payload'].get('force_refine', False)))
+    if gate['skip']:
+        return {'stage': 'refine', 'expert_title': expert_title, 'response': response, 'skipped': True, 'quality_score': gate['score']}
+    refined_response = await run_stage('refine', refine_response, expert_title, response, params['user_input'], params['user_prompt'], params['model_name'], params['temperature'], references, params['chat_history'], params['interaction_number'], params['hedge'], mode=params['payload'].get('refine_mode', 'full'))
+    await asyncio.to_thread(save_chat_history, params['user_input'], params['user_prompt'], refined_response)
+    if quality_gate != 'off':
+        await asyncio.to_thread(record_refine_result, response, refined_response)
+    return {'stage': 'refine', 'expert_title': expert_title, 'response': refined_response, 'skipped': False, 'quality_score': gate['score']}
+
+# Função para executar a etapa de avaliação com RAG
+async def run_evaluate(params: dict, expert_title: str, expert_description: str, response: str) -> dict:
+    quality_gate = parse_quality_gate(params['payload'])
+    evaluation = await run_stage('evaluate', evaluate_response_with_rag, params['user_input'], params['user_prompt'], expert_title, expert_description, response, params['model_name'], params['temperature'], params['chat_history'], params['interaction_number'], params['hedge'], references=parse_references(params['payload']), fan_out=bool(params['payload'].get('fan_out', False)))
+    await asyncio.to_thread(save_chat_history, params['user_input'], params['user_prompt'], evaluation)
+    if quality_gate != 'off':
+        await asyncio.to_thread(record_evaluation, response, evaluation)
+    return {'stage': 'evaluate', 'expert_title': expert_title, 'response': evaluation}
+
+# Função para executar busca, refinamento e avaliação com o mesmo pipeline da interface; on_stage(stage, result) recebe
+# cada etapa assim que ela termina
+async def run_pipeline(params: dict, on_stage=None) -> dict:
+    payload = params['payload']
+    return await run_stage('fetch', run_full_pipeline, params['user_input'], params['user_prompt'], params['model_name'], params['temperature'], payload.get('agent_selection', DEFAULT_AGENT), params['chat_history'], params['interaction_number'], parse_references(payload), params['hedge'], refine_mode=payload.get('refine_mode', 'full'), fan_out=bool(payload.get('fan_out', False)), speculative=bool(payload.get('speculative', True)), semantic_cache=params['semantic_cache'], quality_gate=parse_quality_gate(payload), force_refine=bool(payload.get('force_refine', False)), on_stage=on_stage)
+
+# Rota POST /fetch
+async def fetch_handler(request: web.Request) -> web.Response:
+    params = await parse_request(request)
+    return web.json_response(await run_fetch(params))
+
+# Rota POST /refine
+async def refine_handler(request: web.Request) -> web.Response:
+    params = await parse_request(request)
+    expert_title = require_field(params['payload'], 'expert_title')
+    response = require_field(params['payload'], 'response')
+    return web.json_response(await run_refine(params, expert_title, response))
+
+# Rota POST /experts: consulta ao mesmo tempo os especialistas mais próximos da pergunta e devolve as respostas, a melhor primeiro
+async def experts_handler(request: web.Request) -> web.Response:
+    params = await parse_request(request)
+    payload = params['payload']
+    candidates = await run_stage('fetch', compare_experts, params['user_input'], params['user_prompt'], params['model_name'], params['temperature'], params['chat_history'], params['interaction_number'], parse_references(payload), parse_expert_count(payload), bool(payload.get('judge', False)), params['hedge'])
+    await asyncio.to_thread(save_chat_history, params['user_input'], params['user_prompt'], candidates[0]['response'])
+    return web.json_response({'stage': 'experts', 'expert_title': candidates[0]['expert_title'], 'response': candidates[0]['response'], 'candidates': candidates})
+
+# Rota POST /evaluate
+async def evaluate_handler(request: web.Request) -> web.Response:
+    params = await parse_request(request)
+    expert_title = require_field(params['payload'], 'expert_title')
+    response = require_field(params['payload'], 'response')
+    # Assim como na interface, a descrição do especialista é o próprio título quando não informada
+    expert_description = params['payload'].get('expert_description', expert_title)
+    return web.json_response(await run_evaluate(params, expert_title, expert_description, response))
+
+# Rota POST /pipeline: busca, refina e avalia; com "stream": true, envia cada etapa (NDJSON) assim que termina
+async def pipeline_handler(request: web.Request) -> web.StreamResponse:
+    params = await parse_request(request)
+    stream = bool(params['payload'].get('stream', False))
+    # O modo do filtro é validado antes de o fluxo começar, enquanto ainda é possível responder com 400
+    parse_quality_gate(params['payload'])
+
+    if not stream:
+        stages = []
+        result = await run_pipeline(params, lambda stage, stage_result: stages.append({'stage': stage, **stage_result}))
+        return web.json_response({'expert_title': result['expert_title'], 'stages': stages})
+
+    # As etapas terminam na thread do pipeline e chegam ao laço de eventos por uma fila; None marca o fim
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    async def produce():
+        try:
+            await run_pipeline(params, lambda stage, stage_result: loop.call_soon_threadsafe(events.put_nowait, {'stage': stage, **stage_result}))
+        finally:
+            events.put_nowait(None)
+
+    stream_response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await stream_response.prepare(request)
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            await stream_response.write((json.dumps(event) + "\n").encode('utf-8'))
+        await producer
+    except Exception as e:
+        # O status HTTP já foi enviado; o erro segue como o último evento do fluxo
+        logger.exception("Erro no pipeline")
+        await stream_response.write((json.dumps({'stage': 'error', 'error': str(e)}) + "\n").encode('utf-8'))
+    await stream_response.write_eof()
+    return stream_response
+
+# Rota GET /agents
+async def agents_handler(request: web.Request) -> web.Response:
+    agents = await asyncio.to_thread(load_agents)
+    return web.json_response([agent["agente"] for agent in agents if "agente" in agent])
+
+# Rota GET /health
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({'status': 'ok', 'models': list(MODEL_MAX_TOKENS), 'limiters': get_limiter_state()})
+
+# Middleware que converte erros das etapas em respostas JSON
+@web.middleware
+async def error_middleware(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Erro ao processar %s", request.path)
+        return web.json_response({'error': str(e)}, status=502)
+
+# Função para criar a aplicação HTTP
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[error_middleware])
+    app.router.add_post('/fetch', fetch_handler)
+    app.router.add_post('/refine', refine_handler)
+    app.router.add_post('/experts', experts_handler)
+    app.router.add_post('/evaluate', evaluate_handler)
+    app.router.add_post('/pipeline', pipeline_handler)
+    app.router.add_get('/agents', agents_handler)
+    app.router.add_get('/health', health_handler)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API HTTP dos Agentes Alan Kay (busca, refinamento e avaliação com RAG).")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    start_storage_maintenance()
+    web.run_app(create_app(), host=args.host, port=args.port)
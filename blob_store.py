@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from shared_state import get_state_backend
+
+# Diretório onde cada texto distinto é gravado uma única vez, comprimido e endereçado pelo hash
+BLOB_DIR = 'blobs'
+
+# Nível de compressão zlib dos blobs
+BLOB_COMPRESSION_LEVEL = 6
+
+# Quantidade de blobs lidos mantidos em memória
+BLOB_CACHE_SIZE = 256
+
+# Espaço do backend compartilhado onde ficam os blobs, quando configurado
+BLOB_NAMESPACE = 'blobs'
+
+# Campo que guarda, no backend compartilhado, o blob comprimido em base64
+BLOB_COMPRESSED_FIELD = 'zlib'
+
+_lock = threading.Lock()
+_blob_cache = OrderedDict()
+
+# Função para obter o caminho do arquivo de um blob a partir do seu hash
+def blob_path(blob_hash: str, blob_dir=BLOB_DIR) -> str:
+    return os.path.join(blob_dir, blob_hash[:2], blob_hash)
+
+# Função para comprimir um blob para o backend compartilhado, que só guarda valores JSON
+def pack_blob(data: bytes) -> dict:
+    return {BLOB_COMPRESSED_FIELD: base64.b64encode(zlib.compress(data, BLOB_COMPRESSION_LEVEL)).decode('ascii')}
+
+# Função para ler um blob do backend compartilhado; os gravados antes da compressão voltam como estão
+def unpack_blob(stored):
+    if isinstance(stored, dict) and list(stored) == [BLOB_COMPRESSED_FIELD]:
+        return json.loads(zlib.decompress(base64.b64decode(stored[BLOB_COMPRESSED_FIELD])).decode('utf-8'))
+    return stored
+
+# Função para gravar um valor no repositório de blobs e devolver o seu hash; com ttl, o blob vale por ttl segundos a
+# partir da última gravação, então cada nova referência ao mesmo valor renova o prazo
+def put_blob(value, blob_dir=BLOB_DIR, ttl: float = None) -> str:
+    data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+    blob_hash = hashlib.sha256(data).hexdigest()
+    backend = get_state_backend()
+    if backend:
+        # O valor é endereçado pelo conteúdo, então gravar de novo o mesmo hash só renova a validade
+        backend.put(BLOB_NAMESPACE, blob_hash, pack_blob(data), ttl=ttl)
+        return blob_hash
+    path = blob_path(blob_hash, blob_dir)
+    with _lock:
+        try:
+            # No modo 'files', a data de modificação marca a última referência e é o que sweep_blobs compara
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Grava em arquivo temporário e renomeia, para que leitores nunca vejam um blob incompleto
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(zlib.compress(data, BLOB_COMPRESSION_LEVEL))
+            os.replace(temp_path, path)
+    return blob_hash
+
+# Função para remover os blobs do modo 'files' sem referência nos últimos max_age segundos; devolve quantos removeu.
+# No backend compartilhado os blobs gravados com ttl expiram sozinhos
+def sweep_blobs(max_age: float, blob_dir=BLOB_DIR) -> int:
+    if get_state_backend() or not os.path.exists(blob_dir):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for root, _, files in os.walk(blob_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            with _lock:
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                        _blob_cache.pop(name, None)
+                except FileNotFoundError:
+                    continue
+    return removed
+
+# Função para ler um valor do repositório de blobs pelo hash
+def get_blob(blob_hash: str, blob_dir=BLOB_DIR):
+    with _lock:
+        if blob_hash in _blob_cache:
+            _blob_cache.move_to_end(blob_hash)
+            return _blob_cache[blob_hash]
+    backend = get_state_backend()
+    if backend:
+        stored = backend.get(BLOB_NAMESPACE, blob_hash)
+        if stored is None:
+            return None
+        value = unpack_blob(stored)
+    else:
+        path = blob_path(blob_hash, blob_dir)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            value = json.loads(zlib.decompress(file.read()).decode('utf-8'))
+    with _lock:
+        _blob_cache[blob_hash] = value
+        if len(_blob_cache) > BLOB_CACHE_SIZE:
+            _blob_cache.popitem(last=False)
+    return value
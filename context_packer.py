@@ -0,0 +1,114 @@
+import logging
+import math
+import threading
+from collections import Counter, deque
+
+from model_router import estimate_tokens
+from reference_ingest import CHUNK_OVERLAP, tokenize_terms, retrieve_chunks
+
+logger = logging.getLogger(__name__)
+
+# Orçamento de tokens das referências em cada etapa
+STAGE_REFERENCE_BUDGET = {
+    'refine': 1500,
+    'evaluate': 1000,
+}
+
+# Orçamento usado por etapas sem orçamento próprio
+DEFAULT_REFERENCE_BUDGET = 1000
+
+# Quantidade de trechos candidatos recuperados antes do reordenamento
+PACK_CANDIDATES = 20
+
+# Peso da relevância frente à diversidade no reordenamento por relevância marginal máxima (MMR)
+MMR_LAMBDA = 0.7
+
+# Similaridade acima da qual um candidato é considerado duplicado de um trecho já escolhido
+DUPLICATE_THRESHOLD = 0.9
+
+# Menor sobreposição (caracteres) removida entre trechos vizinhos da mesma página
+MIN_OVERLAP_CHARS = 30
+
+# Quantidade de relatórios de empacotamento mantidos em memória
+PACKING_LOG_SIZE = 100
+
+_lock = threading.Lock()
+_packing_log = deque(maxlen=PACKING_LOG_SIZE)
+
+# Função para calcular a similaridade de cosseno entre dois vetores de termos
+def cosine_similarity(first: Counter, second: Counter) -> float:
+    dot = sum(count * second.get(term, 0) for term, count in first.items())
+    norm = math.sqrt(sum(count * count for count in first.values())) * math.sqrt(sum(count * count for count in second.values()))
+    return dot / norm if norm else 0.0
+
+# Função para remover do candidato o trecho que já aparece em um trecho escolhido vizinho,
+# seja no início do candidato (vizinho anterior) ou no final (vizinho seguinte)
+def trim_overlap(selected_text: str, candidate_text: str) -> str:
+    # Trechos vizinhos compartilham no máximo CHUNK_OVERLAP caracteres (ver chunk_text)
+    for size in range(min(len(selected_text), len(candidate_text), CHUNK_OVERLAP), MIN_OVERLAP_CHARS - 1, -1):
+        if selected_text.endswith(candidate_text[:size]):
+            return candidate_text[size:].strip()
+        if candidate_text.endswith(selected_text[:size]):
+            return candidate_text[:-size].strip()
+    return candidate_text
+
+# Função para reordenar os candidatos por relevância marginal máxima
+def mmr_rerank(candidates: list, query: str, mmr_lambda: float = MMR_LAMBDA) -> list:
+    query_vector = Counter(tokenize_terms(query))
+    vectors = [Counter(tokenize_terms(chunk['text'])) for chunk in candidates]
+    relevance = [cosine_similarity(query_vector, vector) for vector in vectors]
+    remaining = list(range(len(candidates)))
+    ranked = []
+    while remaining:
+        def mmr_score(index):
+            redundancy = max((cosine_similarity(vectors[index], vectors[chosen]) for chosen in ranked), default=0.0)
+            return mmr_lambda * relevance[index] - (1 - mmr_lambda) * redundancy
+
+        best = max(remaining, key=mmr_score)
+        remaining.remove(best)
+        ranked.append(best)
+    return [(candidates[index], vectors[index]) for index in ranked]
+
+# Função para montar o contexto de referências de uma etapa: recupera candidatos, reordena por MMR,
+# descarta duplicados, remove sobreposições e preenche o orçamento de tokens de forma gulosa
+def pack_context(references: list, query: str, stage: str, budget: int = None) -> tuple:
+    if budget is None:
+        budget = STAGE_REFERENCE_BUDGET.get(stage, DEFAULT_REFERENCE_BUDGET)
+    candidates = retrieve_chunks(references, query, PACK_CANDIDATES)
+
+    packed = []
+    packed_vectors = []
+    tokens_packed = 0
+    for chunk, vector in mmr_rerank(candidates, query):
+        if any(cosine_similarity(vector, chosen) >= DUPLICATE_THRESHOLD for chosen in packed_vectors):
+            continue
+        text = chunk['text']
+        for chosen in packed:
+            if (chosen['source'], chosen['page']) == (chunk['source'], chunk['page']):
+                text = trim_overlap(chosen['text'], text)
+        if not text:
+            continue
+        entry = f"\n[{chunk['source']}, p. {chunk['page']}] {text}\n"
+        tokens = estimate_tokens(entry)
+        if tokens_packed + tokens > budget:
+            continue
+        packed.append({'source': chunk['source'], 'page': chunk['page'], 'text': text, 'entry': entry})
+        packed_vectors.append(vector)
+        tokens_packed += tokens
+
+    report = {
+        'stage': stage,
+        'candidates': len(candidates),
+        'packed': len(packed),
+        'tokens_packed': tokens_packed,
+        'tokens_available': budget,
+    }
+    with _lock:
+        _packing_log.append(report)
+    logger.info("Contexto de %s: %d/%d tokens em %d trechos", stage, tokens_packed, budget, len(packed))
+    return "".join(chunk['entry'] for chunk in packed), report
+
+# Função para obter os relatórios de empacotamento mais recentes
+def get_packing_log() -> list:
+    with _lock:
+        return list(_packing_log)
@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Seções da rubrica de avaliação, na ordem em que são juntadas: id, título exibido e item pedido ao modelo
+EVALUATION_SECTIONS = [
+    ('gap', "Gap Científico", "Busque o Gap científico e interprete. Forneça o seed e o gen_id registrados na descrição do agente, nas buscas das respostas e no refinar as respostas。"),
+    ('swot', "Análise SWOT", "SWOT 分析（优势、劣势、机会、威胁）和数据解释。"),
+    ('risk_matrix', "Matriz de Riscos", "风险矩阵和数据解释。"),
+    ('anova', "ANOVA", "ANOVA（方差分析）和数据解释。"),
+    ('q_statistic', "Estatística Q", "Q 统计和数据解释。"),
+    ('q_index', "Índice Q", "Q 指数和数据解释。"),
+]
+
+# Tentativas extras de uma seção que falhou, sem refazer as demais
+SECTION_RETRIES = 1
+
+# Quantidade de avaliações mantidas no registro de tempos
+EVALUATION_LOG_SIZE = 50
+
+_lock = threading.Lock()
+_evaluation_log = []
+
+# Erro de uma seção que não chegou a ser pedida porque a avaliação foi cancelada
+class EvaluationCancelled(Exception):
+    pass
+
+# Função para formatar uma seção concluída com o seu título
+def format_section(title: str, text: str) -> str:
+    return f"### {title}\n{text.strip()}"
+
+# Função para executar as seções em paralelo; run_section(index, section_id, instruction) devolve o texto da seção,
+# on_section recebe cada seção formatada assim que termina e o resultado final segue a ordem fixa da rubrica.
+# Depois de cancel, nenhuma seção ou nova tentativa é pedida; as chamadas já em andamento terminam e são cobradas,
+# e o registro de tempos mostra quantas foram feitas e quantas foram canceladas
+def run_sections(run_section: Callable, on_section: Callable = None, sections: list = None, cancel: threading.Event = None) -> str:
+    sections = sections or EVALUATION_SECTIONS
+    start_time = time.time()
+    results = {}
+    section_times = {}
+    calls = []
+
+    def attempt(index: int, section_id: str, instruction: str) -> str:
+        for retry in range(SECTION_RETRIES + 1):
+            if cancel is not None and cancel.is_set():
+                raise EvaluationCancelled("Avaliação cancelada.")
+            calls.append(section_id)
+            section_start = time.time()
+            try:
+                text = run_section(index, section_id, instruction)
+                section_times[section_id] = time.time() - section_start
+                return text
+            except EvaluationCancelled:
+                raise
+            except Exception as e:
+                logger.warning("Seção '%s' da avaliação falhou (tentativa %d): %s", section_id, retry + 1, e)
+                error = e
+        raise error
+
+    cancelled = 0
+
+    with ThreadPoolExecutor(max_workers=len(sections), thread_name_prefix='evaluation') as executor:
+        futures = {executor.submit(attempt, index, section_id, instruction): (section_id, title) for index, (section_id, title, instruction) in enumerate(sections)}
+        for future in as_completed(futures):
+            section_id, title = futures[future]
+            try:
+                text = format_section(title, future.result())
+            except EvaluationCancelled as e:
+                text = format_section(title, str(e))
+                section_times.setdefault(section_id, None)
+                cancelled += 1
+            except Exception as e:
+                text = format_section(title, f"Não foi possível gerar esta seção: {e}")
+                section_times.setdefault(section_id, None)
+            results[section_id] = text
+            if on_section:
+                on_section(text + "\n\n")
+
+    failed = [section_id for section_id, _, _ in sections if section_times.get(section_id) is None]
+    completed_times = [section_time for section_time in section_times.values() if section_time is not None]
+    with _lock:
+        _evaluation_log.append({
+            'timestamp': start_time,
+            'sections': len(sections),
+            'failed': len(failed) - cancelled,
+            'cancelled': cancelled,
+            'calls': len(calls),
+            'wall_time': round(time.time() - start_time, 2),
+            'slowest_section': round(max(completed_times), 2) if completed_times else None,
+            'sum_of_sections': round(sum(completed_times), 2),
+        })
+        del _evaluation_log[:-EVALUATION_LOG_SIZE]
+    if cancel is not None and cancel.is_set():
+        raise EvaluationCancelled("Avaliação cancelada.")
+    if len(failed) == len(sections):
+        raise Exception("Todas as seções da avaliação falharam.")
+    return "\n\n".join(results[section_id] for section_id, _, _ in sections)
+
+# Função para obter o registro de tempos das avaliações em paralelo
+def get_evaluation_log() -> list:
+    with _lock:
+        return list(_evaluation_log)
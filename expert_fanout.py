@@ -0,0 +1,144 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from pipeline import load_agents, get_completion, fetch_assistant_response
+from context_packer import cosine_similarity
+from model_router import estimate_tokens
+from reference_ingest import REFERENCE_TOP_K, tokenize_terms, retrieve_chunks
+
+logger = logging.getLogger(__name__)
+
+# Quantidade padrão de especialistas consultados ao mesmo tempo
+EXPERT_FAN_OUT_SIZE = 3
+
+# Quantidades mínima e máxima de especialistas aceitas; cada um é uma chamada à API
+MIN_EXPERT_FAN_OUT = 2
+MAX_EXPERT_FAN_OUT = 5
+
+# Pesos dos sinais locais na nota de cada resposta
+RANKING_WEIGHTS = {
+    'overlap': 0.5,
+    'length': 0.25,
+    'structure': 0.25,
+}
+
+# Tamanho (tokens) a partir do qual a resposta recebe a nota máxima de extensão
+TARGET_ANSWER_TOKENS = 600
+
+# Parágrafos e marcadores (itens de lista e títulos) a partir dos quais a resposta recebe a nota máxima de estrutura
+STRUCTURE_PARAGRAPHS = 4
+STRUCTURE_MARKERS = 5
+
+# Caracteres de cada resposta enviados ao juiz
+JUDGE_ANSWER_CHARS = 2000
+
+# Quantidade de comparações mantidas no registro de tempos
+FAN_OUT_LOG_SIZE = 50
+
+_lock = threading.Lock()
+_fan_out_log = []
+
+# Função para escolher os especialistas do catálogo mais próximos da pergunta (TF-IDF sobre nome e descrição)
+def select_experts(user_input: str, user_prompt: str, count: int = EXPERT_FAN_OUT_SIZE) -> list:
+    agents = [agent for agent in load_agents() if agent.get("agente")]
+    profiles = [{'agente': agent["agente"], 'text': f"{agent['agente']} {agent.get('descricao', '')}".replace("_", " ")} for agent in agents]
+    return [profile['agente'] for profile in retrieve_chunks(profiles, f"{user_input} {user_prompt}", count)]
+
+# Função para calcular os sinais locais de uma resposta: sobreposição com as referências (ou a pergunta), extensão e estrutura
+def score_answer(answer: str, reference_terms: Counter) -> dict:
+    lines = [line.strip() for line in answer.splitlines() if line.strip()]
+    paragraphs = len([block for block in re.split(r"\n\s*\n", answer) if block.strip()])
+    markers = len([line for line in lines if re.match(r"(#+\s|[-*•]\s|\d+[.)]\s)", line)])
+    signals = {
+        'overlap': cosine_similarity(Counter(tokenize_terms(answer)), reference_terms),
+        'length': min(1.0, estimate_tokens(answer) / TARGET_ANSWER_TOKENS),
+        'structure': 0.5 * min(1.0, paragraphs / STRUCTURE_PARAGRAPHS) + 0.5 * min(1.0, markers / STRUCTURE_MARKERS),
+    }
+    signals['score'] = sum(RANKING_WEIGHTS[name] * signals[name] for name in RANKING_WEIGHTS)
+    return {name: round(value, 3) for name, value in signals.items()}
+
+# Função para pedir a um juiz, em uma única chamada, a ordem das respostas; devolve None quando o juiz falha ou a
+# resposta não é uma permutação de inteiros, e a ordem dos sinais locais é mantida
+def judge_answers(candidates: list, user_input: str, user_prompt: str, model_name: str, interaction_number: int) -> list:
+    answers = "\n\n".join(f"[Resposta {index}] ({candidate['expert_title']})\n{candidate['response'][:JUDGE_ANSWER_CHARS]}" for index, candidate in enumerate(candidates, start=1))
+    judge_prompt = (
+        f"Compare as respostas abaixo para a solicitação: {user_input} e {user_prompt}.\n\n{answers}\n\n"
+        f"Ordene as respostas da melhor para a pior em precisão, completude e clareza. "
+        f'Responda somente com um JSON no formato {{"ranking": [2, 1, 3]}}, usando os números das respostas.'
+    )
+    try:
+        judge_response = get_completion('evaluate', judge_prompt, model_name, 0.0, interaction_number, user_input, user_prompt, "", "", stage='judge_experts')
+    except Exception as e:
+        logger.warning("Juiz indisponível, mantida a ordem local: %s", e)
+        return None
+    match = re.search(r"\{.*\}", judge_response, re.DOTALL)
+    try:
+        ranking = json.loads(match.group(0))['ranking'] if match else None
+    except (json.JSONDecodeError, KeyError, TypeError):
+        ranking = None
+    if not isinstance(ranking, list) or not all(isinstance(position, int) and not isinstance(position, bool) for position in ranking) or sorted(ranking) != list(range(1, len(candidates) + 1)):
+        logger.warning("Ordem do juiz descartada: %s", judge_response[:200])
+        return None
+    return ranking
+
+# Função para consultar vários especialistas ao mesmo tempo, cada um começando o rodízio por uma chave diferente,
+# e ordenar as respostas pelos sinais locais (e, com judge, por uma única chamada de juiz), a melhor primeiro;
+# on_candidate recebe cada resposta assim que ela chega
+def compare_experts(user_input: str, user_prompt: str, model_name: str, temperature: float, chat_history: list, interaction_number: int, references: list = None, count: int = EXPERT_FAN_OUT_SIZE, judge: bool = False, hedge: bool = False, on_candidate: Callable = None) -> list:
+    start_time = time.time()
+    experts = select_experts(user_input, user_prompt, count)
+    if not experts:
+        raise ValueError("Nenhum especialista disponível no catálogo.")
+    query = f"{user_input} {user_prompt}"
+    reference_text = " ".join(chunk['text'] for chunk in retrieve_chunks(references or [], query, REFERENCE_TOP_K)) or query
+    reference_terms = Counter(tokenize_terms(reference_text))
+
+    def consult(index: int, expert: str) -> dict:
+        call_start = time.time()
+        expert_title, response = fetch_assistant_response(user_input, user_prompt, model_name, temperature, expert, chat_history, interaction_number, hedge, key_offset=index)
+        candidate = {'expert_title': expert_title, 'response': response, 'time_taken': round(time.time() - call_start, 2)}
+        candidate.update(score_answer(response, reference_terms))
+        if on_candidate:
+            on_candidate(candidate)
+        return candidate
+
+    candidates = []
+    with ThreadPoolExecutor(max_workers=len(experts), thread_name_prefix='experts') as executor:
+        futures = [executor.submit(consult, index, expert) for index, expert in enumerate(experts)]
+        for future in futures:
+            try:
+                candidates.append(future.result())
+            except Exception as e:
+                logger.warning("Especialista descartado da comparação: %s", e)
+    if not candidates:
+        raise Exception("Nenhum especialista respondeu.")
+
+    candidates.sort(key=lambda candidate: candidate['score'], reverse=True)
+    ranking = judge_answers(candidates, user_input, user_prompt, model_name, interaction_number) if judge and len(candidates) > 1 else None
+    if ranking:
+        candidates = [candidates[position - 1] for position in ranking]
+
+    with _lock:
+        _fan_out_log.append({
+            'timestamp': start_time,
+            'experts': len(experts),
+            'answered': len(candidates),
+            'judge': bool(ranking),
+            'best': candidates[0]['expert_title'],
+            'wall_time': round(time.time() - start_time, 2),
+            'slowest_call': max(candidate['time_taken'] for candidate in candidates),
+            'sum_of_calls': round(sum(candidate['time_taken'] for candidate in candidates), 2),
+        })
+        del _fan_out_log[:-FAN_OUT_LOG_SIZE]
+    return candidates
+
+# Função para obter o registro de tempos das comparações de especialistas
+def get_fan_out_log() -> list:
+    with _lock:
+        return list(_fan_out_log)
@@ -0,0 +1,123 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from pipeline import load_agents, save_chat_history, fetch_assistant_response, refine_response, evaluate_response_with_rag
+from context_packer import PACK_CANDIDATES
+from reference_ingest import retrieve_chunks
+from refine_delta import answer_similarity
+from quality_gate import gate_refine, record_refine_result, record_evaluation
+
+# Trechos de referência pré-selecionados pela pergunta enquanto a busca roda; as etapas seguintes empacotam a partir deles
+PREFETCH_REFERENCES = 3 * PACK_CANDIDATES
+
+# Semelhança mínima (parágrafos preservados) entre o rascunho e a resposta refinada para aproveitar a avaliação especulativa
+SPECULATION_THRESHOLD = 0.8
+
+# Quantidade de execuções mantidas no registro de tempos
+PIPELINE_LOG_SIZE = 50
+
+_lock = threading.Lock()
+_pipeline_log = []
+
+# Função para obter a descrição do agente escolhido no catálogo, ou None para o especialista gerado na busca
+def load_agent_description(agent_selection: str) -> str:
+    agent_found = next((agent for agent in load_agents() if agent.get("agente") == agent_selection), None)
+    return agent_found["descricao"] if agent_found else None
+
+# Função para executar busca, refinamento e avaliação em uma única tarefa; o que não depende da etapa anterior começa
+# antes (descrição do agente e pré-seleção das referências) e, com speculative, o rascunho é avaliado enquanto o
+# refinamento roda, aproveitando essa avaliação quando o refinamento preserva a maior parte da resposta; com quality_gate
+# em 'skip', uma resposta aprovada pelo filtro de qualidade local não é refinada (a menos que force_refine) e o rascunho é avaliado;
+# on_stage(stage, result) recebe o resultado de cada etapa assim que ela termina, com 'expert_title' e 'response' (a busca
+# inclui 'cache_similarity'; o refinamento, 'skipped' e 'quality_score')
+def run_full_pipeline(user_input: str, user_prompt: str, model_name: str, temperature: float, agent_selection: str, chat_history: list, interaction_number: int, references: list, hedge: bool = False, refine_mode: str = 'full', fan_out: bool = False, speculative: bool = True, semantic_cache: str = 'off', quality_gate: str = 'off', force_refine: bool = False, on_stage: Callable = None) -> dict:
+    start_time = time.time()
+    timings = {}
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='pipeline')
+    try:
+        description_future = executor.submit(load_agent_description, agent_selection)
+        references_future = executor.submit(retrieve_chunks, references, f"{user_input} {user_prompt}", PREFETCH_REFERENCES)
+
+        fetch_start = time.time()
+        cache_hit = {}
+        expert_title, response = fetch_assistant_response(user_input, user_prompt, model_name, temperature, agent_selection, chat_history, interaction_number, hedge, semantic_cache=semantic_cache, on_cache_hit=cache_hit.update)
+        timings['fetch'] = time.time() - fetch_start
+        save_chat_history(user_input, user_prompt, response)
+        if on_stage:
+            on_stage('fetch', {'expert_title': expert_title, 'response': response, 'cache_similarity': cache_hit.get('similarity')})
+
+        # Assim como na interface, a descrição do especialista gerado é o próprio título
+        expert_description = description_future.result() or expert_title
+        reference_pool = references_future.result()
+
+        def timed(stage: str, function: Callable, *args, **kwargs):
+            stage_start = time.time()
+            result = function(*args, **kwargs)
+            timings[stage] = time.time() - stage_start
+            return result
+
+        def evaluate(answer: str, stage: str, cancel: threading.Event = None):
+            return executor.submit(timed, stage, evaluate_response_with_rag, user_input, user_prompt, expert_title, expert_description, answer, model_name, temperature, chat_history, interaction_number, hedge, references=reference_pool, fan_out=fan_out, cancel=cancel)
+
+        gate = gate_refine(response, user_input, user_prompt, reference_pool, chat_history, quality_gate, force_refine)
+        if gate['skip']:
+            # O filtro de qualidade aprovou o rascunho: ele é a resposta final e é avaliado sem o refinamento
+            refined, similarity, timings['refine'] = response, 1.0, 0.0
+            speculation = 'gated'
+            if on_stage:
+                on_stage('refine', {'expert_title': expert_title, 'response': response, 'skipped': True, 'quality_score': gate['score']})
+            evaluation = evaluate(response, 'evaluate').result()
+        else:
+            cancel_speculation = threading.Event()
+            speculative_future = evaluate(response, 'evaluate_speculative', cancel_speculation) if speculative else None
+            refined = timed('refine', refine_response, expert_title, response, user_input, user_prompt, model_name, temperature, reference_pool, chat_history, interaction_number, hedge, mode=refine_mode)
+            save_chat_history(user_input, user_prompt, refined)
+            if on_stage:
+                on_stage('refine', {'expert_title': expert_title, 'response': refined, 'skipped': False, 'quality_score': gate['score']})
+            similarity = answer_similarity(response, refined)
+            if quality_gate != 'off':
+                record_refine_result(response, refined)
+            if speculative_future and similarity >= SPECULATION_THRESHOLD:
+                speculation = 'accepted'
+                evaluation = speculative_future.result()
+            else:
+                # Sem especulação, ou o refinamento mudou demais: a avaliação do rascunho é cancelada (as chamadas param de
+                # ser lidas e as seções ainda não pedidas não são feitas; os tokens já gerados ficam no registro de uso
+                # com status 'cancelled') e a resposta refinada é avaliada
+                speculation = 'rejected' if speculative_future else 'off'
+                cancel_speculation.set()
+                evaluation = evaluate(refined, 'evaluate').result()
+        # A avaliação do rascunho fica registrada junto à nota local dele, para ajustar o limiar do filtro
+        if quality_gate != 'off' and speculation in ('gated', 'accepted'):
+            record_evaluation(response, evaluation)
+        save_chat_history(user_input, user_prompt, evaluation)
+        if on_stage:
+            on_stage('evaluate', {'expert_title': expert_title, 'response': evaluation})
+    finally:
+        executor.shutdown(wait=False)
+
+    wall_time = time.time() - start_time
+    evaluate_time = timings['evaluate'] if speculation != 'accepted' else timings['evaluate_speculative']
+    run = {
+        'timestamp': start_time,
+        'speculation': speculation,
+        'similarity': round(similarity, 2),
+        'quality_score': gate['score'],
+        'fetch': round(timings['fetch'], 2),
+        'refine': round(timings['refine'], 2),
+        'evaluate': round(evaluate_time, 2),
+        'wall_time': round(wall_time, 2),
+        # Tempo das mesmas etapas uma após a outra, como no fluxo manual (sem contar recargas da página e cliques)
+        'manual_time': round(timings['fetch'] + timings['refine'] + evaluate_time, 2),
+    }
+    with _lock:
+        _pipeline_log.append(run)
+        del _pipeline_log[:-PIPELINE_LOG_SIZE]
+    return {'expert_title': expert_title, 'response': response, 'refined': refined, 'evaluation': evaluation, 'refine_skipped': gate['skip'], 'quality': gate, 'timings': run}
+
+# Função para obter o registro de tempos das execuções do pipeline completo
+def get_pipeline_log() -> list:
+    with _lock:
+        return list(_pipeline_log)
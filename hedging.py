@@ -0,0 +1,127 @@
+import queue
+import threading
+from collections import deque
+from typing import Callable
+
+from model_router import percentile
+
+# Percentil do tempo até o primeiro token usado como limite para disparar a requisição de reserva
+HEDGE_QUANTILE = 0.90
+
+# Limite (s) usado enquanto não há amostras suficientes de tempo até o primeiro token
+HEDGE_DEFAULT_DELAY = 3.0
+
+# Menor limite (s) aceito, para não duplicar chamadas que ainda estão dentro do normal
+HEDGE_MIN_DELAY = 0.5
+
+# Fração máxima das chamadas que pode gerar uma requisição de reserva
+HEDGE_MAX_RATE = 0.2
+
+# Mínimo de amostras para usar o percentil observado no lugar do limite padrão
+HEDGE_MIN_SAMPLES = 10
+
+# Quantidade de amostras de tempo até o primeiro token mantidas por modelo e etapa
+HEDGE_WINDOW = 200
+
+_lock = threading.Lock()
+_first_token_samples = {}
+_hedge_stats = {
+    'calls': 0,
+    'hedged': 0,
+    'hedge_wins': 0,
+    'extra_tokens': 0,
+}
+
+# Função para registrar o tempo até o primeiro token de uma chamada
+def record_first_token(model_name: str, stage: str, time_to_first_token: float):
+    with _lock:
+        samples = _first_token_samples.setdefault((model_name, stage), deque(maxlen=HEDGE_WINDOW))
+        samples.append(time_to_first_token)
+
+# Função para calcular o limite dinâmico de espera pelo primeiro token antes de disparar a reserva
+def get_hedge_threshold(model_name: str, stage: str) -> float:
+    with _lock:
+        samples = list(_first_token_samples.get((model_name, stage), []))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, percentile(samples, HEDGE_QUANTILE))
+
+# Função para reservar o direito de disparar uma requisição de reserva, respeitando a taxa máxima
+def reserve_hedge() -> bool:
+    with _lock:
+        if _hedge_stats['hedged'] + 1 > HEDGE_MAX_RATE * max(_hedge_stats['calls'], 1):
+            return False
+        _hedge_stats['hedged'] += 1
+        return True
+
+# Função para obter as estatísticas acumuladas das requisições com hedge
+def get_hedge_stats() -> dict:
+    with _lock:
+        stats = dict(_hedge_stats)
+    stats['hedge_rate'] = stats['hedged'] / stats['calls'] if stats['calls'] else 0.0
+    return stats
+
+# Função para executar uma chamada com hedge: se o primeiro token não chegar a tempo, repete a chamada
+# em outra chave e usa o primeiro resultado, cancelando o outro.
+# A função attempt recebe (api_key, first_token, cancel) e devolve um dicionário com 'content' e
+# 'tokens_used'; ela deve sinalizar first_token ao receber o primeiro token e parar quando cancel for sinalizado.
+def run_hedged(attempt: Callable, api_keys: list, threshold: float) -> dict:
+    results = queue.Queue()
+    winner = {}
+    cancel_events = []
+
+    with _lock:
+        _hedge_stats['calls'] += 1
+
+    def launch(api_key: str, is_hedge: bool) -> threading.Event:
+        first_token = threading.Event()
+        cancel = threading.Event()
+        with _lock:
+            cancel_events.append(cancel)
+            if winner:
+                cancel.set()
+
+        def target():
+            result, error = None, None
+            try:
+                result = attempt(api_key, first_token, cancel)
+            except Exception as e:
+                error = e
+            finally:
+                # Libera a espera pelo primeiro token também quando a chamada termina ou falha
+                first_token.set()
+            with _lock:
+                won = error is None and not winner
+                if won:
+                    winner['is_hedge'] = is_hedge
+                    # Cancela as demais chamadas assim que existe um vencedor
+                    for event in cancel_events:
+                        if event is not cancel:
+                            event.set()
+                elif result is not None:
+                    # Tokens consumidos pela chamada perdedora, concluída ou cancelada
+                    _hedge_stats['extra_tokens'] += result.get('tokens_used', 0)
+            results.put((won, result, error))
+
+        threading.Thread(target=target, daemon=True).start()
+        return first_token
+
+    primary_first_token = launch(api_keys[0], False)
+    pending = 1
+    if len(api_keys) > 1 and not primary_first_token.wait(threshold) and reserve_hedge():
+        launch(api_keys[1], True)
+        pending += 1
+
+    first_error = None
+    while pending:
+        won, result, error = results.get()
+        pending -= 1
+        if won:
+            if winner['is_hedge']:
+                with _lock:
+                    _hedge_stats['hedge_wins'] += 1
+            result['hedged'] = len(cancel_events) > 1
+            return result
+        if error is not None and first_error is None:
+            first_error = error
+    raise first_error
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Callable
+
+from shared_state import get_state_backend
+
+logger = logging.getLogger(__name__)
+
+# Arquivo onde as tarefas concluídas são mantidas para sobreviver a recarregamentos da página
+JOBS_FILE = 'jobs.json'
+
+# Quantidade de workers que executam as tarefas em segundo plano (configurável por variável de ambiente)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# Quantidade máxima de tarefas mantidas no arquivo
+JOB_RETENTION = 200
+
+# Espaço do backend compartilhado onde o estado das tarefas é publicado, para que qualquer réplica o encontre
+JOBS_NAMESPACE = 'jobs'
+
+# Validade, em segundos, de uma tarefa no backend compartilhado
+JOB_TTL = 86400
+
+# Intervalo mínimo, em segundos, entre publicações da saída parcial no backend compartilhado
+JOB_PUBLISH_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_save_lock = threading.Lock()
+_jobs = {}
+_job_queue = queue.Queue()
+_workers = []
+_jobs_loaded = False
+# Número da última cópia das tarefas tirada e da última gravada, para nunca gravar uma cópia mais antiga por cima
+_snapshot_sequence = 0
+_saved_sequence = 0
+
+# Função para carregar as tarefas salvas; as que estavam na fila ou em execução foram interrompidas, e um arquivo
+# corrompido é tratado como vazio
+def load_jobs(jobs_file=JOBS_FILE):
+    global _jobs_loaded
+    with _lock:
+        if _jobs_loaded:
+            return
+        if os.path.exists(jobs_file):
+            try:
+                with open(jobs_file, 'r') as file:
+                    jobs = json.load(file)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.warning("Arquivo de tarefas ignorado por estar corrompido: %s", e)
+                jobs = []
+            for job in jobs:
+                if job['status'] in ('queued', 'running'):
+                    job['status'] = 'interrupted'
+                _jobs[job['id']] = job
+        _jobs_loaded = True
+
+# Função para salvar as tarefas mais recentes no arquivo; a cópia é tirada sob _lock e gravada sob _save_lock, e
+# uma cópia que chega à gravação depois de outra mais nova é descartada
+def save_jobs(jobs_file=JOBS_FILE):
+    global _snapshot_sequence, _saved_sequence
+    with _lock:
+        jobs = sorted(_jobs.values(), key=lambda job: job['created'])
+        # Descarta da memória as tarefas antigas já encerradas, mantendo as ativas
+        for job in jobs[:-JOB_RETENTION]:
+            if job['status'] not in ('queued', 'running'):
+                del _jobs[job['id']]
+        jobs = [dict(job) for job in jobs[-JOB_RETENTION:]]
+        _snapshot_sequence += 1
+        sequence = _snapshot_sequence
+    with _save_lock:
+        if sequence < _saved_sequence:
+            return
+        _saved_sequence = sequence
+        # Grava em arquivo temporário e renomeia, para que uma interrupção ou um leitor nunca vejam o arquivo pela metade
+        temp_path = f"{jobs_file}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(jobs, file, indent=4)
+        os.replace(temp_path, jobs_file)
+
+# Função para publicar o estado de uma tarefa no backend compartilhado, quando configurado; a tarefa continua sendo
+# executada pela réplica que a recebeu, e as demais leem o estado publicado
+def publish_job(job_id: str):
+    backend = get_state_backend()
+    if not backend:
+        return
+    with _lock:
+        job = _jobs.get(job_id)
+        if not job:
+            return
+        job = dict(job)
+    backend.put(JOBS_NAMESPACE, job_id, job, ttl=JOB_TTL)
+
+# Função executada por cada worker: retira tarefas da fila e guarda o resultado
+def worker_loop():
+    while True:
+        job_id, job_function = _job_queue.get()
+        with _lock:
+            job = _jobs[job_id]
+            job['status'] = 'running'
+            job['started'] = time.time()
+        publish_job(job_id)
+        last_publish = [time.time()]
+
+        def on_token(token: str):
+            with _lock:
+                job['partial'] += token
+            if time.time() - last_publish[0] >= JOB_PUBLISH_INTERVAL:
+                last_publish[0] = time.time()
+                publish_job(job_id)
+
+        try:
+            result = job_function(on_token)
+            with _lock:
+                job['result'] = result
+                job['partial'] = ""
+                job['status'] = 'done'
+        except Exception as e:
+            with _lock:
+                job['error'] = str(e)
+                job['status'] = 'error'
+        finally:
+            with _lock:
+                job['finished'] = time.time()
+            save_jobs()
+            publish_job(job_id)
+            _job_queue.task_done()
+
+# Função para iniciar os workers uma única vez por processo
+def start_workers(worker_count: int = JOB_WORKERS):
+    load_jobs()
+    with _lock:
+        while len(_workers) < worker_count:
+            worker = threading.Thread(target=worker_loop, daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+# Função para enviar uma tarefa à fila; job_function recebe on_token para publicar a saída parcial
+def submit_job(kind: str, job_function: Callable) -> str:
+    start_workers()
+    job_id = uuid.uuid4().hex
+    with _lock:
+        _jobs[job_id] = {
+            'id': job_id,
+            'kind': kind,
+            'status': 'queued',
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'partial': "",
+            'result': None,
+            'error': None,
+        }
+    save_jobs()
+    publish_job(job_id)
+    _job_queue.put((job_id, job_function))
+    return job_id
+
+# Função para obter uma cópia do estado de uma tarefa; uma tarefa criada por outra réplica é lida do backend compartilhado
+def get_job(job_id: str) -> dict:
+    load_jobs()
+    with _lock:
+        job = _jobs.get(job_id)
+        if job:
+            return dict(job)
+    backend = get_state_backend()
+    return backend.get(JOBS_NAMESPACE, job_id) if backend and job_id else None
+
+# Função para verificar se uma tarefa ainda está na fila ou em execução
+def is_job_active(job: dict) -> bool:
+    return bool(job) and job['status'] in ('queued', 'running')
+
+# Função para obter as métricas da fila de tarefas
+def get_queue_metrics() -> dict:
+    with _lock:
+        statuses = [job['status'] for job in _jobs.values()]
+        workers = len(_workers)
+    return {
+        'workers': workers,
+        'queue_depth': statuses.count('queued'),
+        'running': statuses.count('running'),
+        'done': statuses.count('done'),
+        'error': statuses.count('error'),
+    }
@@ -0,0 +1,218 @@
+import codecs
+import io
+import json
+import re
+from typing import Iterator, Union
+
+# Tamanho (bytes) de cada bloco lido do arquivo; a memória usada fica limitada a um bloco mais o maior registro
+JSON_STREAM_BLOCK_SIZE = 64 * 1024
+
+# Caracteres que delimitam valores fora das strings e que encerram ou escapam dentro delas
+STRUCTURE_PATTERN = re.compile(r'[\[\]{}",]')
+WHITESPACE_PATTERN = re.compile(r'[ \t\n\r]*')
+
+# Distância (caracteres) do fim do buffer em que um erro do decodificador pode ser apenas um valor cortado pelo bloco
+TRUNCATION_MARGIN = 16
+
+# Caracteres que podem seguir um valor completo dentro de uma lista ou objeto
+VALUE_DELIMITERS = (',', ']', '}', ' ', '\t', '\n', '\r')
+
+# Erro de um JSON lido em partes, com a posição (caractere, linha e coluna) contada desde o início do arquivo;
+# é um json.JSONDecodeError, então os tratamentos já existentes continuam valendo
+class JSONStreamError(json.JSONDecodeError):
+    def __init__(self, msg: str, pos: int, lineno: int, colno: int):
+        ValueError.__init__(self, f"{msg}: line {lineno} column {colno} (char {pos})")
+        self.msg = msg
+        self.doc = None
+        self.pos = pos
+        self.lineno = lineno
+        self.colno = colno
+
+    # Permite devolver o erro dos processos de extração de referências
+    def __reduce__(self):
+        return self.__class__, (self.msg, self.pos, self.lineno, self.colno)
+
+# Leitor que mantém em memória apenas o trecho ainda não consumido do arquivo, com a posição dele no arquivo inteiro
+class JSONStreamReader:
+    def __init__(self, file, block_size: int = JSON_STREAM_BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+        self.decoder = None
+        self.buffer = ""
+        self.json_decoder = json.JSONDecoder()
+        # Posição (caracteres) do início do buffer no arquivo, linha desse ponto e posição do início dessa linha
+        self.offset = 0
+        self.line = 1
+        self.line_start = 0
+        self.eof = False
+
+    # Lê o próximo bloco para o fim do buffer; devolve False quando o arquivo acabou. Enquanto um registro grande não
+    # termina, cada leitura tem pelo menos o tamanho do buffer, que assim dobra a cada bloco: o total copiado ao juntar
+    # os blocos fica proporcional ao tamanho do registro, e não ao quadrado dele
+    def read_more(self) -> bool:
+        while not self.eof:
+            data = self.file.read(max(self.block_size, len(self.buffer)))
+            self.eof = not data
+            if isinstance(data, bytes):
+                # O decodificador incremental guarda caracteres UTF-8 cortados entre blocos e descarta o BOM
+                self.decoder = self.decoder or codecs.getincrementaldecoder('utf-8-sig')()
+                data = self.decoder.decode(data, final=self.eof)
+            if data:
+                self.buffer += data
+                return True
+        return False
+
+    # Descarta o trecho já consumido do buffer, mantendo a contagem de linhas
+    def discard(self, index: int):
+        newlines = self.buffer.count('\n', 0, index)
+        if newlines:
+            self.line += newlines
+            self.line_start = self.offset + self.buffer.rfind('\n', 0, index) + 1
+        self.offset += index
+        self.buffer = self.buffer[index:]
+
+    # Cria o erro de uma posição do buffer, com linha e coluna no arquivo inteiro
+    def error(self, msg: str, index: int) -> JSONStreamError:
+        pos = self.offset + index
+        newlines = self.buffer.count('\n', 0, index)
+        line_start = self.offset + self.buffer.rfind('\n', 0, index) + 1 if newlines else self.line_start
+        return JSONStreamError(msg, pos, self.line + newlines, pos - line_start + 1)
+
+    # Avança sobre os espaços, lendo mais blocos se preciso; devolve a posição do próximo caractere (ou o fim do arquivo)
+    def skip_whitespace(self, index: int) -> int:
+        while True:
+            index = WHITESPACE_PATTERN.match(self.buffer, index).end()
+            if index < len(self.buffer) or not self.read_more():
+                return index
+
+    # Encontra o fim de uma string que começa na aspa em index; devolve a posição após a aspa final, ou None no fim do arquivo
+    def scan_string(self, index: int) -> int:
+        index += 1
+        while True:
+            quote = self.buffer.find('"', index)
+            if quote == -1:
+                index = len(self.buffer)
+                if not self.read_more():
+                    return None
+                continue
+            # A aspa encerra a string quando não é escapada, isto é, quando a precede um número par de barras
+            # (a aspa inicial limita a contagem)
+            escape_start = quote
+            while self.buffer[escape_start - 1] == '\\':
+                escape_start -= 1
+            if (quote - escape_start) % 2 == 0:
+                return quote + 1
+            index = quote + 1
+
+    # Encontra o fim do valor que começa em index: a vírgula ou o fechamento do contêiner externo, fora de strings
+    # e de contêineres internos; devolve a posição desse delimitador, ou o fim do buffer quando o arquivo acabou antes
+    def scan_value(self, index: int) -> int:
+        depth = 0
+        while True:
+            match = STRUCTURE_PATTERN.search(self.buffer, index)
+            if match is None:
+                index = len(self.buffer)
+                if not self.read_more():
+                    return index
+                continue
+            char, index = match.group(), match.start()
+            if char == '"':
+                index = self.scan_string(index)
+                if index is None:
+                    return len(self.buffer)
+                continue
+            if char in '[{':
+                depth += 1
+            elif depth == 0:
+                return index
+            elif char in ']}':
+                depth -= 1
+            index += 1
+
+    # Decodifica o trecho [start, end) do buffer, trazendo a posição de um erro para o arquivo inteiro;
+    # dentro de um contêiner, o que sobra depois de um valor completo é uma vírgula faltando
+    def decode(self, start: int, end: int, in_container: bool = False):
+        try:
+            return json.loads(self.buffer[start:end])
+        except json.JSONDecodeError as e:
+            msg = "Expecting ',' delimiter" if in_container and e.msg == "Extra data" else e.msg
+            raise self.error(msg, start + e.pos) from None
+
+    # Decodifica o valor que começa em index; devolve o valor e a posição logo após ele. O decodificador em C lê o valor
+    # direto do buffer; enquanto o valor parecer apenas cortado no fim do buffer (uma string sem a aspa final, um número
+    # sem delimitador depois), lê mais um bloco e tenta de novo, o que custa pouco porque o buffer dobra a cada leitura.
+    # Um valor malformado é percorrido até o fim e decodificado sozinho, para apontar o erro como json.loads
+    def read_value(self, index: int) -> tuple:
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, index)
+                if self.buffer[end:end + 1] in VALUE_DELIMITERS:
+                    return value, end
+                truncated = end >= len(self.buffer)
+            except json.JSONDecodeError as e:
+                truncated = e.msg.startswith("Unterminated string") or e.pos >= len(self.buffer) - TRUNCATION_MARGIN
+            if not truncated or not self.read_more():
+                break
+        end = self.scan_value(index)
+        return self.decode(index, end, in_container=True), end
+
+# Função para ler um JSON registro a registro: os elementos de uma lista no nível superior ou os pares (chave, valor)
+# de um objeto no nível superior; qualquer outro valor é devolvido inteiro. source é um caminho, bytes ou um arquivo
+# aberto (binário ou texto). Cada registro é decodificado assim que termina, então um erro é apontado (com linha, coluna
+# e caractere no arquivo) quando a leitura chega nele, sem ler o resto do arquivo
+def iter_json_records(source: Union[str, bytes, io.IOBase], block_size: int = JSON_STREAM_BLOCK_SIZE) -> Iterator:
+    if isinstance(source, str):
+        with open(source, 'rb') as file:
+            yield from iter_json_records(file, block_size)
+        return
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    reader = JSONStreamReader(source, block_size)
+    index = reader.skip_whitespace(0)
+    opener = reader.buffer[index:index + 1]
+    if opener not in ('[', '{'):
+        while reader.read_more():
+            pass
+        yield reader.decode(index, len(reader.buffer))
+        return
+
+    closer = ']' if opener == '[' else '}'
+    index += 1
+    first = True
+    while True:
+        index = reader.skip_whitespace(index)
+        if first and reader.buffer[index:index + 1] == closer:
+            index += 1
+            break
+        first = False
+        if opener == '{':
+            if reader.buffer[index:index + 1] != '"':
+                raise reader.error("Expecting property name enclosed in double quotes", index)
+            end = reader.scan_string(index)
+            if end is None:
+                raise reader.error("Unterminated string starting at", index)
+            key = reader.decode(index, end)
+            index = reader.skip_whitespace(end)
+            if reader.buffer[index:index + 1] != ':':
+                raise reader.error("Expecting ':' delimiter", index)
+            index = reader.skip_whitespace(index + 1)
+        value, end = reader.read_value(index)
+        yield (key, value) if opener == '{' else value
+        end = reader.skip_whitespace(end)
+        delimiter = reader.buffer[end:end + 1]
+        if delimiter not in (',', closer):
+            raise reader.error("Expecting ',' delimiter", end)
+        index = end + 1
+        if delimiter == closer:
+            break
+        if index > reader.block_size:
+            reader.discard(index)
+            index = 0
+
+    index = reader.skip_whitespace(index)
+    if index < len(reader.buffer):
+        raise reader.error("Extra data", index)
+
+# Função para contar os registros de um JSON sem mantê-los em memória
+def count_json_records(source: Union[str, bytes, io.IOBase]) -> int:
+    return sum(1 for _ in iter_json_records(source))
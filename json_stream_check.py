@@ -0,0 +1,112 @@
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from json_stream import iter_json_records
+
+# Tamanhos de bloco usados na verificação: blocos minúsculos cortam strings, números e escapes em todas as posições
+CHECK_BLOCK_SIZES = (1, 2, 3, 7, 64)
+
+# Trechos inseridos ou trocados nos documentos para produzir JSON malformado
+CORRUPTIONS = [',', ']', '}', '"', 'x', '', '\\', ' ', ':', '[']
+
+# Valores simples dos documentos gerados, com escapes, acentos e barras
+SCALARS = [1, -2.5e3, "a\"b\\c", "ção\n", True, None, "\\\\"]
+
+# Função para gerar um valor aleatório com listas e objetos aninhados
+def random_value(rng: random.Random, depth: int = 0):
+    choice = rng.random()
+    if depth > 3 or choice < 0.3:
+        return rng.choice(SCALARS + ["x" * rng.randint(0, 30)])
+    if choice < 0.65:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f"k{index}\"": random_value(rng, depth + 1) for index in range(rng.randint(0, 4))}
+
+# Função para gerar um documento JSON aleatório, às vezes corrompido em uma posição
+def random_document(rng: random.Random) -> str:
+    value = random_value(rng) if rng.random() < 0.3 else [random_value(rng, 1) for _ in range(rng.randint(0, 6))]
+    text = json.dumps(value, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2]))
+    if rng.random() < 0.5:
+        index = rng.randrange(len(text) + 1)
+        text = text[:index] + rng.choice(CORRUPTIONS) + text[index + rng.choice([0, 1]):]
+    return text
+
+# Função para ler um documento inteiro por json.loads ou pelo leitor em partes, como ('ok', valor) ou
+# ('erro', mensagem, caractere, linha, coluna)
+def parse_outcome(text: str, block_size: int = None) -> tuple:
+    try:
+        if block_size is None:
+            return ('ok', json.loads(text))
+        records = list(iter_json_records(io.BytesIO(text.encode('utf-8')), block_size))
+        opener = text.lstrip()[:1]
+        return ('ok', dict(records) if opener == '{' else records if opener == '[' else records[0])
+    except json.JSONDecodeError as e:
+        return ('erro', e.msg, e.pos, e.lineno, e.colno)
+
+# Função para comparar o leitor em partes com json.loads em documentos aleatórios: o mesmo valor ou o mesmo erro,
+# na mesma posição; devolve os documentos divergentes
+def check_parity(cases: int, seed: int) -> list:
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(cases):
+        text = random_document(rng)
+        expected = parse_outcome(text)
+        for block_size in CHECK_BLOCK_SIZES:
+            outcome = parse_outcome(text, block_size)
+            if outcome != expected:
+                mismatches.append({'document': text, 'block_size': block_size, 'expected': expected, 'outcome': outcome})
+    return mismatches
+
+# Função para medir tempo e pico de memória de json.load e do leitor em partes em um arquivo
+def measure_file(path: str) -> list:
+    rows = []
+    for reader, parse in (('json.load', lambda file: json.load(file)), ('iter_json_records', lambda file: sum(1 for _ in iter_json_records(file)))):
+        with open(path, 'rb') as file:
+            tracemalloc.start()
+            start_time = time.time()
+            parse(file)
+            elapsed = time.time() - start_time
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        rows.append({'reader': reader, 'time_s': round(elapsed, 2), 'peak_mb': round(peak / 2 ** 20, 2)})
+    return rows
+
+# Função para gerar os arquivos grandes da medição: muitos registros pequenos e um único registro com uma string longa
+def write_large_files(directory: str, size_mb: int) -> dict:
+    size = size_mb * 2 ** 20
+    record = {'source': 'referencia.pdf', 'page': 1, 'text': 'Ele disse "olá" e saiu.\n' + 'texto ' * 150}
+    record_size = len(json.dumps(record, ensure_ascii=False))
+    documents = {
+        'registros': [record] * (size // record_size),
+        'registro único': {'text': ('Ele disse "olá" e saiu.\n' + 'texto ' * 30) * (size // 210)},
+    }
+    paths = {}
+    for name, document in documents.items():
+        paths[name] = os.path.join(directory, f"{len(paths)}.json")
+        with open(paths[name], 'w', encoding='utf-8') as file:
+            json.dump(document, file, ensure_ascii=False)
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica o leitor de JSON em partes (json_stream.py): mesmos valores e erros de json.loads e tempo e memória em arquivos grandes.")
+    parser.add_argument('--cases', type=int, default=4000, help="Documentos aleatórios comparados com json.loads.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--size-mb', type=int, default=80, help="Tamanho (MB) dos arquivos da medição; 0 pula a medição.")
+    args = parser.parse_args()
+
+    mismatches = check_parity(args.cases, args.seed)
+    print(f"Documentos: {args.cases} x {len(CHECK_BLOCK_SIZES)} tamanhos de bloco | divergências: {len(mismatches)}")
+    for mismatch in mismatches[:10]:
+        print(f"  bloco {mismatch['block_size']}: {mismatch['document'][:120]!r} esperado {mismatch['expected']} obtido {mismatch['outcome']}")
+
+    if args.size_mb:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, path in write_large_files(directory, args.size_mb).items():
+                for row in measure_file(path):
+                    print(f"{name} ({args.size_mb} MB) | {row['reader']}: {row['time_s']} s, pico de memória {row['peak_mb']} MB")
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,231 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# Arquivo onde os sketches de latência são salvos para sobreviver a reinícios
+METRICS_FILE = 'latency_metrics.json'
+
+# Intervalo mínimo (s) entre gravações do arquivo de métricas
+METRICS_SAVE_INTERVAL = 10
+
+# Precisão relativa dos quantis do DDSketch (1% do valor)
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Resoluções dos intervalos agregados: duração (s) de cada intervalo e quantos são mantidos
+METRICS_RESOLUTIONS = {
+    60: 60,
+    3600: 24,
+}
+
+# Janelas deslizantes exibidas: nome -> (resolução, quantidade de intervalos)
+METRICS_WINDOWS = {
+    '5 min': (60, 5),
+    '1 h': (60, 60),
+    '24 h': (3600, 24),
+}
+
+# Dimensões pelas quais as métricas são agrupadas
+METRICS_DIMENSIONS = ('model', 'key', 'stage')
+
+_lock = threading.Lock()
+_series = {}
+_metrics_loaded = False
+_last_save = 0.0
+
+# Sketch de quantis com erro relativo limitado (DDSketch): os valores caem em intervalos
+# logarítmicos, então a memória cresce com a faixa de valores e não com a quantidade de amostras,
+# e dois sketches se combinam somando os contadores de cada intervalo
+class DDSketch:
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float):
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other: 'DDSketch'):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self) -> dict:
+        return {'bins': {str(index): count for index, count in self.bins.items()}, 'zero_count': self.zero_count, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DDSketch':
+        sketch = cls()
+        sketch.bins = {int(index): count for index, count in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        return sketch
+
+# Função para criar as métricas vazias de um intervalo
+def new_interval(start: int) -> dict:
+    return {
+        'start': start,
+        'latency': DDSketch(),
+        'rate_limit_wait': DDSketch(),
+        'calls': 0,
+        'errors': 0,
+        'tokens': 0,
+        'time_taken': 0.0,
+    }
+
+# Função para obter o intervalo atual de uma série em uma resolução, descartando os que saíram da janela
+def current_interval(series: dict, resolution: int, now: float) -> dict:
+    intervals = series[resolution]
+    start = int(now // resolution * resolution)
+    if not intervals or intervals[-1]['start'] != start:
+        intervals.append(new_interval(start))
+    return intervals[-1]
+
+# Função para obter as séries de uma chave (dimensão, valor), criando-as quando necessário
+def get_series(dimension: str, value: str) -> dict:
+    return _series.setdefault((dimension, value), {resolution: deque(maxlen=size) for resolution, size in METRICS_RESOLUTIONS.items()})
+
+# Função para identificar uma chave de API sem expô-la
+def key_label(api_key: str) -> str:
+    return f"…{api_key[-4:]}" if api_key else "?"
+
+# Função para registrar uma chamada concluída (ou com erro) nos sketches de modelo, chave e etapa
+def record_completion(model_name: str, api_key: str, stage: str, time_taken: float, tokens_used: int = 0, status: str = 'ok', now: float = None):
+    load_metrics()
+    now = now or time.time()
+    with _lock:
+        for dimension, value in zip(METRICS_DIMENSIONS, (model_name, key_label(api_key), stage)):
+            series = get_series(dimension, value)
+            for resolution in METRICS_RESOLUTIONS:
+                interval = current_interval(series, resolution, now)
+                interval['calls'] += 1
+                if status == 'ok':
+                    interval['latency'].add(time_taken)
+                    interval['tokens'] += tokens_used
+                    interval['time_taken'] += time_taken
+                else:
+                    interval['errors'] += 1
+    save_metrics()
+
+# Função para registrar o tempo de espera imposto por um limite de taxa
+def record_rate_limit_wait(model_name: str, api_key: str, stage: str, wait_time: float, now: float = None):
+    load_metrics()
+    now = now or time.time()
+    with _lock:
+        for dimension, value in zip(METRICS_DIMENSIONS, (model_name, key_label(api_key), stage)):
+            series = get_series(dimension, value)
+            for resolution in METRICS_RESOLUTIONS:
+                current_interval(series, resolution, now)['rate_limit_wait'].add(wait_time)
+    save_metrics()
+
+# Função para montar a tabela de uma dimensão em uma janela deslizante; combina no máximo
+# a quantidade fixa de intervalos da janela, independentemente de quantas chamadas foram registradas
+def get_metrics_table(dimension: str, window: str, now: float = None) -> dict:
+    load_metrics()
+    resolution, size = METRICS_WINDOWS[window]
+    now = now or time.time()
+    oldest = int(now // resolution * resolution) - (size - 1) * resolution
+    table = {}
+    with _lock:
+        for (series_dimension, value), series in _series.items():
+            if series_dimension != dimension:
+                continue
+            latency = DDSketch()
+            rate_limit_wait = DDSketch()
+            calls = errors = tokens = 0
+            time_taken = 0.0
+            for interval in series[resolution]:
+                if interval['start'] < oldest:
+                    continue
+                latency.merge(interval['latency'])
+                rate_limit_wait.merge(interval['rate_limit_wait'])
+                calls += interval['calls']
+                errors += interval['errors']
+                tokens += interval['tokens']
+                time_taken += interval['time_taken']
+            if calls == 0 and rate_limit_wait.count == 0:
+                continue
+            table[value] = {
+                'p50': latency.quantile(0.5),
+                'p95': latency.quantile(0.95),
+                'p99': latency.quantile(0.99),
+                'rate_limit_wait_p95': rate_limit_wait.quantile(0.95),
+                'error_rate': errors / calls if calls else 0.0,
+                'tokens_per_second': tokens / time_taken if time_taken > 0 else 0.0,
+                'calls': calls,
+            }
+    return table
+
+# Função para carregar os sketches salvos, uma única vez por processo
+def load_metrics(metrics_file=METRICS_FILE):
+    global _metrics_loaded
+    with _lock:
+        if _metrics_loaded:
+            return
+        _metrics_loaded = True
+        if not os.path.exists(metrics_file):
+            return
+        with open(metrics_file, 'r') as file:
+            saved = json.load(file)
+        for entry in saved:
+            series = get_series(entry['dimension'], entry['value'])
+            for resolution, intervals in entry['intervals'].items():
+                for interval in intervals:
+                    loaded = dict(interval)
+                    loaded['latency'] = DDSketch.from_dict(interval['latency'])
+                    loaded['rate_limit_wait'] = DDSketch.from_dict(interval['rate_limit_wait'])
+                    series[int(resolution)].append(loaded)
+
+# Função para salvar os sketches, no máximo uma vez a cada METRICS_SAVE_INTERVAL segundos
+def save_metrics(metrics_file=METRICS_FILE, force: bool = False):
+    global _last_save
+    with _lock:
+        if not force and time.time() - _last_save < METRICS_SAVE_INTERVAL:
+            return
+        _last_save = time.time()
+        saved = [
+            {
+                'dimension': dimension,
+                'value': value,
+                'intervals': {
+                    str(resolution): [dict(interval, latency=interval['latency'].to_dict(), rate_limit_wait=interval['rate_limit_wait'].to_dict()) for interval in intervals]
+                    for resolution, intervals in series.items()
+                },
+            }
+            for (dimension, value), series in _series.items()
+        ]
+    temp_path = f"{metrics_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(saved, file)
+    os.replace(temp_path, metrics_file)
+
+# Função para apagar todas as métricas
+def clear_metrics(metrics_file=METRICS_FILE):
+    with _lock:
+        _series.clear()
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
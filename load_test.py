@@ -0,0 +1,285 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from model_router import percentile
+
+# Diretório onde os resultados de cada execução são salvos para comparar versões
+LOAD_TEST_RESULTS_DIR = 'load_test_results'
+
+# Arquivos da aplicação copiados para o diretório de trabalho isolado de cada execução
+APP_FILES = ['*.py', 'agents.json', 'agentsBR.json', '*.png', '*.ico', '*.gif', '*.mp3']
+
+# Arquivos e diretórios de dados verificados a cada etapa em busca de JSON corrompido
+DATA_FILES = ['api_usage/*.json', 'chat_history/*.json', 'routing_log/*.json', 'jobs.json', 'latency_metrics.json']
+
+# Tempo máximo (s) de espera pelas tarefas de refinamento e avaliação de uma sessão
+JOB_TIMEOUT = 120
+
+# Intervalo (s) entre as atualizações da página enquanto as tarefas estão em andamento
+POLL_INTERVAL = 1.0
+
+# Marca única de cada fluxo, ecoada pelo servidor simulado para detectar respostas trocadas entre sessões
+SESSION_TAG_PATTERN = r"\[sessão [\w-]+\]"
+
+# Servidor simulado compatível com a API de chat da Groq, com latência e limite de taxa configuráveis
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    rate_limit_rate = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(random.expovariate(1 / self.latency) if self.latency > 0 else 0)
+        if random.random() < self.rate_limit_rate:
+            message = "Rate limit reached for model. Please try again in 0.5s. Visit https://console.groq.com/docs/rate-limits for more information."
+            self.send_json(429, {'error': {'message': message, 'type': 'tokens', 'code': 'rate_limit_exceeded'}}, {'retry-after': '0'})
+            return
+
+        prompt = body['messages'][-1]['content']
+        tag = re.search(SESSION_TAG_PATTERN, prompt)
+        text = f"Especialista Simulado. Resposta para {tag.group(0) if tag else '[sem marca]'}."
+        usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(text) // 4, 'total_tokens': (len(prompt) + len(text)) // 4}
+        if not body.get('stream'):
+            self.send_json(200, {
+                'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for word in text.split(" "):
+            chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body['model'], 'choices': [{'index': 0, 'delta': {'content': word + " "}, 'finish_reason': None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body['model'], 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'x_groq': {'id': 'mock', 'usage': usage}}
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+        self.close_connection = True
+
+# Função executada no processo do servidor simulado; ao terminar, devolve o uso de CPU e memória do processo
+def run_mock_server(port: int, latency: float, rate_limit_rate: float, stop_event, usage_queue):
+    MockCompletionHandler.latency = latency
+    MockCompletionHandler.rate_limit_rate = rate_limit_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockCompletionHandler)
+    server.timeout = 0.5
+    while not stop_event.is_set():
+        server.handle_request()
+    usage_queue.put(process_usage())
+
+# Função para obter o uso de CPU (s) e o pico de memória (MB) do processo atual
+def process_usage() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'pid': os.getpid(), 'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_mb': usage.ru_maxrss / 1024}
+
+# Função para contar os arquivos de dados que não são JSON válido
+def count_corrupted_files(workdir: str) -> int:
+    corrupted = 0
+    for pattern in DATA_FILES:
+        for path in glob.glob(os.path.join(workdir, pattern)):
+            try:
+                with open(path, 'r') as file:
+                    json.load(file)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                corrupted += 1
+    return corrupted
+
+# Função executada em um processo à parte, no diretório de trabalho: conta as interações pelo mesmo armazenamento que a
+# aplicação usa, então a contagem vale para qualquer backend de estado; partições corrompidas entram em corrupted_files
+def count_workdir_chat_entries(workdir: str) -> int:
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    from partitioned_store import list_partitions, iter_partition
+    from pipeline import CHAT_HISTORY_DIR
+
+    entries = 0
+    for partition in list_partitions(CHAT_HISTORY_DIR):
+        try:
+            entries += sum(1 for _ in iter_partition(CHAT_HISTORY_DIR, partition))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass
+    return entries
+
+# Função para contar as interações gravadas no histórico de chat do diretório de trabalho
+def count_chat_entries(workdir: str) -> int:
+    with multiprocessing.get_context('spawn').Pool(processes=1) as pool:
+        return pool.apply(count_workdir_chat_entries, (workdir,))
+
+# Função executada em cada processo de sessão: percorre busca → refinamento → avaliação pela interface
+def run_session(workdir: str, session_id: str, iterations: int) -> dict:
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    from streamlit.testing.v1 import AppTest
+    from job_queue import get_job, is_job_active
+
+    flows = []
+    for iteration in range(iterations):
+        tag = f"[sessão {session_id}-{iteration}]"
+        flow = {'tag': tag, 'errors': 0, 'mixed_responses': 0}
+        flow_start = time.time()
+        try:
+            app = AppTest.from_file("run.py", default_timeout=JOB_TIMEOUT).run()
+            app.text_area(key="entrada_usuario").input(f"{tag} O que é fotossíntese?")
+
+            start_time = time.time()
+            app.button[0].click().run()
+            flow['fetch'] = time.time() - start_time
+            if tag not in app.session_state['resposta_assistente']:
+                flow['mixed_responses'] += 1
+
+            # O refinamento e a avaliação entram na fila de tarefas; a página é atualizada até terminarem
+            start_time = time.time()
+            app.button[1].click().run()
+            app.button[2].click().run()
+            job_ids = {stage: app.query_params.get(f"{stage}_job", [""])[0] for stage in ('refine', 'evaluate')}
+            pending = dict(job_ids)
+            while pending and time.time() - start_time < JOB_TIMEOUT:
+                time.sleep(POLL_INTERVAL)
+                app.run()
+                for stage, job_id in list(pending.items()):
+                    job = get_job(job_id)
+                    if not is_job_active(job):
+                        flow[stage] = time.time() - start_time
+                        del pending[stage]
+                        if not job or job['status'] != 'done':
+                            flow['errors'] += 1
+                        elif tag not in job['result']:
+                            flow['mixed_responses'] += 1
+            flow['errors'] += len(pending) + len(app.exception) + len(app.error)
+        except Exception:
+            flow['errors'] += 1
+        flow['total'] = time.time() - flow_start
+        flows.append(flow)
+    return {'session': session_id, 'flows': flows, 'process': process_usage()}
+
+# Função para resumir uma lista de latências em percentis
+def summarize_latencies(values: list) -> dict:
+    if not values:
+        return {}
+    return {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99), 'max': max(values)}
+
+# Função para executar um degrau da rampa com a concorrência informada
+def run_step(workdir: str, concurrency: int, iterations: int) -> dict:
+    expected_entries = count_chat_entries(workdir) + concurrency * iterations * 3
+    context = multiprocessing.get_context('spawn')
+    start_time = time.time()
+    with context.Pool(processes=concurrency) as pool:
+        sessions = pool.starmap(run_session, [(workdir, f"{concurrency}x{index}", iterations) for index in range(concurrency)])
+    wall_time = time.time() - start_time
+
+    flows = [flow for session in sessions for flow in session['flows']]
+    completed = [flow for flow in flows if flow['errors'] == 0]
+    return {
+        'concurrency': concurrency,
+        'flows': len(flows),
+        'completed': len(completed),
+        'wall_time': wall_time,
+        'throughput_flows_per_minute': len(completed) / wall_time * 60 if wall_time > 0 else 0.0,
+        'latency': {stage: summarize_latencies([flow[stage] for flow in flows if stage in flow]) for stage in ('fetch', 'refine', 'evaluate', 'total')},
+        'errors': sum(flow['errors'] for flow in flows),
+        'mixed_responses': sum(flow['mixed_responses'] for flow in flows),
+        'corrupted_files': count_corrupted_files(workdir),
+        'lost_chat_entries': max(0, expected_entries - count_chat_entries(workdir)),
+        'processes': [session['process'] for session in sessions],
+    }
+
+# Função para identificar a versão testada pelo commit atual, quando disponível
+def build_id() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconhecida'
+
+# Função para copiar a aplicação para um diretório de trabalho isolado, sem os dados do usuário
+def prepare_workdir() -> str:
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    for pattern in APP_FILES:
+        for path in glob.glob(pattern):
+            shutil.copy(path, workdir)
+    return workdir
+
+# Função para exibir os resultados salvos lado a lado, por versão e concorrência
+def compare_results(results_dir=LOAD_TEST_RESULTS_DIR):
+    for path in sorted(glob.glob(os.path.join(results_dir, '*.json'))):
+        with open(path, 'r') as file:
+            result = json.load(file)
+        print(f"{os.path.basename(path)} (versão {result['build']})")
+        for step in result['steps']:
+            total = step['latency']['total']
+            print(f"  {step['concurrency']:>3} sessões: {step['throughput_flows_per_minute']:7.1f} fluxos/min | total p50 {total.get('p50', 0):6.2f}s p95 {total.get('p95', 0):6.2f}s | erros {step['errors']} | trocadas {step['mixed_responses']} | corrompidos {step['corrupted_files']} | perdidas {step['lost_chat_entries']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga da interface: sessões simuladas percorrem busca, refinamento e avaliação contra um servidor simulado.")
+    parser.add_argument('--concurrency', default='1,2,4,8', help="Degraus da rampa de sessões simultâneas, separados por vírgula.")
+    parser.add_argument('--iterations', type=int, default=2, help="Fluxos completos por sessão em cada degrau.")
+    parser.add_argument('--mock-port', type=int, default=8765)
+    parser.add_argument('--mock-latency', type=float, default=0.2, help="Latência média (s) de cada chamada ao servidor simulado.")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fração das chamadas respondidas com limite de taxa.")
+    parser.add_argument('--compare', action='store_true', help="Apenas exibe os resultados salvos.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results()
+        sys.exit(0)
+
+    # O cliente Groq das sessões aponta para o servidor simulado, então nenhuma chamada chega à API real
+    os.environ['GROQ_BASE_URL'] = f"http://127.0.0.1:{args.mock_port}"
+
+    context = multiprocessing.get_context('spawn')
+    stop_event = context.Event()
+    mock_usage = context.Queue()
+    mock_server = context.Process(target=run_mock_server, args=(args.mock_port, args.mock_latency, args.rate_limit_rate, stop_event, mock_usage))
+    mock_server.start()
+
+    workdir = prepare_workdir()
+    steps = []
+    try:
+        for concurrency in [int(value) for value in args.concurrency.split(",")]:
+            print(f"Executando {concurrency} sessões simultâneas...")
+            step = run_step(workdir, concurrency, args.iterations)
+            total = step['latency']['total']
+            print(f"  {step['throughput_flows_per_minute']:.1f} fluxos/min | total p50 {total.get('p50', 0):.2f}s p95 {total.get('p95', 0):.2f}s | erros {step['errors']} | corrompidos {step['corrupted_files']} | perdidas {step['lost_chat_entries']}")
+            steps.append(step)
+    finally:
+        stop_event.set()
+        mock_server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'build': build_id(),
+        'timestamp': time.time(),
+        'settings': vars(args),
+        'mock_server': mock_usage.get() if not mock_usage.empty() else {},
+        'steps': steps,
+    }
+    os.makedirs(LOAD_TEST_RESULTS_DIR, exist_ok=True)
+    result_file = os.path.join(LOAD_TEST_RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['build']}.json")
+    with open(result_file, 'w') as file:
+        json.dump(result, file, indent=4)
+    print(f"Resultados salvos em {result_file}")
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Tuple
+
+from adaptive_limiter import ERROR_OUTCOMES
+from partitioned_store import append_entry, load_entries, clear_store, migrate_legacy_file, import_local_store
+
+# Opção do seletor de modelos que ativa o roteamento automático
+AUTO_MODEL = 'auto'
+
+# Diretório com uma partição por dia das decisões de roteamento
+ROUTING_LOG_DIR = 'routing_log'
+
+# Arquivo único antigo das decisões de roteamento, migrado para ROUTING_LOG_DIR
+ROUTING_LOG_FILE = 'routing_log.json'
+
+# Quantidade de chamadas recentes consideradas por modelo na tabela de latência
+LATENCY_WINDOW = 200
+
+# Mínimo de amostras para confiar nas estatísticas observadas de um modelo
+MIN_SAMPLES = 5
+
+# Situações registradas no log que contam como erro de um modelo (as mesmas que o limitador classifica)
+ERROR_STATUSES = ERROR_OUTCOMES
+
+# Modelos com taxa de erro acima deste limite são evitados pelo roteador
+MAX_ERROR_RATE = 0.5
+
+# Tokens reservados para a saída ao verificar se o prompt cabe na janela do modelo
+OUTPUT_TOKENS_RESERVE = 1024
+
+# Nível de qualidade de cada modelo (quanto maior, melhor a resposta esperada)
+MODEL_QUALITY_TIERS = {
+    'mixtral-8x7b-32768': 2,
+    'llama3-70b-8192': 3,
+    'llama3-8b-8192': 1,
+    'gemma-7b-it': 1,
+}
+
+# Nível mínimo de qualidade exigido por etapa; a geração do especialista (fase um) aceita modelos pequenos
+STAGE_MIN_TIER = {
+    'fetch_expert': 1,
+    'fetch': 2,
+    'refine': 2,
+    'evaluate': 2,
+}
+
+# Latência estimada (s) usada enquanto não há amostras suficientes de um modelo
+MODEL_LATENCY_PRIOR = {
+    'mixtral-8x7b-32768': 8.0,
+    'llama3-70b-8192': 10.0,
+    'llama3-8b-8192': 3.0,
+    'gemma-7b-it': 4.0,
+}
+
+_lock = threading.Lock()
+_latency_samples = {}
+_table_loaded = False
+
+# Função para estimar o número de tokens de um texto sem depender do tokenizador do modelo
+def estimate_tokens(text: str) -> int:
+    cjk_chars = sum(1 for char in text if '\u3000' <= char <= '\u9fff' or '\uff00' <= char <= '\uffef')
+    other_chars = len(text) - cjk_chars
+    return cjk_chars + (other_chars + 3) // 4
+
+# Função para calcular um percentil de uma lista de valores
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+# Função para registrar o resultado de uma chamada na tabela de latência em memória
+def record_call(model_name: str, time_taken: float, status: str = 'ok'):
+    with _lock:
+        samples = _latency_samples.setdefault(model_name, deque(maxlen=LATENCY_WINDOW))
+        samples.append((time_taken, status))
+
+# Função para montar a tabela de latência a partir do registro de uso da API
+def load_latency_table(api_usage: list):
+    global _table_loaded
+    with _lock:
+        _latency_samples.clear()
+        for entry in api_usage:
+            model_name = entry.get('model_name')
+            if not model_name:
+                continue
+            samples = _latency_samples.setdefault(model_name, deque(maxlen=LATENCY_WINDOW))
+            samples.append((entry.get('time_taken', 0.0), entry.get('status', 'ok')))
+        _table_loaded = True
+
+# Função para carregar a tabela de latência apenas uma vez por processo
+def ensure_latency_table(load_api_usage):
+    if not _table_loaded:
+        load_latency_table(load_api_usage())
+
+# Função para obter p50/p95 de latência e taxa de erro por modelo
+def get_latency_table() -> dict:
+    table = {}
+    with _lock:
+        snapshot = {model: list(samples) for model, samples in _latency_samples.items()}
+    for model_name, samples in snapshot.items():
+        latencies = [time_taken for time_taken, status in samples if status == 'ok']
+        errors = sum(1 for _, status in samples if status in ERROR_STATUSES)
+        calls = len(latencies) + errors
+        table[model_name] = {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'error_rate': errors / calls if calls else 0.0,
+            'calls': calls,
+        }
+    return table
+
+# Função para estimar a latência esperada de um modelo, considerando a taxa de erro
+def expected_latency(model_name: str, table: dict) -> Tuple[float, float]:
+    stats = table.get(model_name)
+    if not stats or stats['calls'] < MIN_SAMPLES or stats['p50'] == 0.0:
+        prior = MODEL_LATENCY_PRIOR.get(model_name, 10.0)
+        return prior, prior
+    # Cada erro obriga a uma nova tentativa, o que multiplica a latência esperada
+    penalty = 1.0 / max(1.0 - stats['error_rate'], 0.05)
+    return stats['p50'] * penalty, stats['p95'] * penalty
+
+# Função para escolher o modelo de uma etapa a partir do tamanho do prompt, latência e qualidade;
+# is_available, quando informada, descarta os modelos indisponíveis (por exemplo, com o disjuntor aberto)
+def route_model(stage: str, prompt: str, model_max_tokens: dict, is_available: Callable = None) -> Tuple[str, dict]:
+    prompt_tokens = estimate_tokens(prompt)
+    table = get_latency_table()
+    min_tier = STAGE_MIN_TIER.get(stage, 2)
+
+    candidates = []
+    for model_name, window in model_max_tokens.items():
+        if MODEL_QUALITY_TIERS.get(model_name, 1) < min_tier:
+            continue
+        if prompt_tokens + OUTPUT_TOKENS_RESERVE > window:
+            continue
+        if is_available and not is_available(model_name):
+            continue
+        stats = table.get(model_name)
+        if stats and stats['calls'] >= MIN_SAMPLES and stats['error_rate'] > MAX_ERROR_RATE:
+            continue
+        p50, p95 = expected_latency(model_name, table)
+        candidates.append((p95, p50, model_name))
+
+    if candidates:
+        _, chosen_p50, chosen = min(candidates)
+    else:
+        # Nenhum modelo atende aos critérios: usa o de maior janela para não falhar por tamanho
+        chosen = max(model_max_tokens, key=model_max_tokens.get)
+        chosen_p50, _ = expected_latency(chosen, table)
+
+    baseline = next(iter(model_max_tokens))
+    baseline_p50, _ = expected_latency(baseline, table)
+    decision = {
+        'timestamp': time.time(),
+        'stage': stage,
+        'prompt_tokens': prompt_tokens,
+        'chosen_model': chosen,
+        'candidates': [model_name for _, _, model_name in sorted(candidates)],
+        'baseline_model': baseline,
+        'estimated_latency': chosen_p50,
+        'estimated_latency_saved': baseline_p50 - chosen_p50,
+    }
+    return chosen, decision
+
+# Função para registrar uma decisão de roteamento na partição do dia (ou no backend compartilhado)
+def log_routing_decision(decision: dict, routing_log_dir=ROUTING_LOG_DIR):
+    append_entry(routing_log_dir, decision)
+
+# Função para carregar as decisões de roteamento registradas
+def load_routing_log(routing_log_dir=ROUTING_LOG_DIR) -> list:
+    return load_entries(routing_log_dir)
+
+# Função para apagar as decisões de roteamento registradas
+def clear_routing_log(routing_log_dir=ROUTING_LOG_DIR):
+    clear_store(routing_log_dir)
+
+# Função para migrar o arquivo único antigo das decisões de roteamento (e, com backend compartilhado, as partições locais)
+def migrate_routing_log(routing_log_dir=ROUTING_LOG_DIR):
+    migrate_legacy_file(ROUTING_LOG_FILE, routing_log_dir)
+    import_local_store(routing_log_dir)
@@ -0,0 +1,110 @@
+import threading
+from collections import deque
+from typing import Callable, Tuple
+
+from blob_store import get_blob
+from model_router import estimate_tokens, percentile
+
+# Percentil do tamanho das saídas usado como base do max_tokens
+OUTPUT_QUANTILE = 0.95
+
+# Margem de segurança multiplicada sobre o percentil e folga mínima somada
+OUTPUT_SAFETY_MARGIN = 1.25
+OUTPUT_MIN_HEADROOM = 64
+
+# Menor max_tokens enviado e valor usado enquanto não há amostras suficientes
+MIN_MAX_TOKENS = 256
+DEFAULT_MAX_TOKENS = 4096
+
+# Mínimo de amostras de um grupo para usar a previsão
+OUTPUT_MIN_SAMPLES = 5
+
+# Quantidade de amostras mantidas por grupo e de entradas do registro usadas na carga inicial
+OUTPUT_WINDOW = 200
+OUTPUT_HISTORY_ENTRIES = 1000
+
+# Quantidade máxima de continuações de uma resposta cortada pelo limite de tokens
+MAX_CONTINUATIONS = 2
+
+# Mensagem que pede a continuação de uma resposta cortada
+CONTINUATION_PROMPT = "Continue exatamente de onde a resposta anterior parou, sem repetir o que já foi escrito."
+
+_lock = threading.Lock()
+_output_samples = {}
+_history_loaded = False
+_predictor_stats = {
+    'calls': 0,
+    'predicted_calls': 0,
+    'reserved_tokens_freed': 0,
+    'truncated': 0,
+    'continuations': 0,
+}
+
+# Função para obter as chaves dos grupos de uma chamada, do mais específico ao mais geral
+def sample_keys(stage: str, model_name: str, agent: str) -> list:
+    return [(stage, model_name, agent), (stage, model_name, None), (stage, None, None)]
+
+# Função para registrar o tamanho (tokens) da saída de uma chamada concluída
+def record_output_tokens(stage: str, model_name: str, agent: str, completion_tokens: int):
+    with _lock:
+        for key in sample_keys(stage, model_name, agent):
+            _output_samples.setdefault(key, deque(maxlen=OUTPUT_WINDOW)).append(completion_tokens)
+
+# Função para carregar, uma única vez por processo, os tamanhos de saída do registro de uso da API;
+# entradas antigas sem completion_tokens têm o tamanho estimado a partir da resposta guardada
+def ensure_output_history(load_api_usage: Callable):
+    global _history_loaded
+    with _lock:
+        if _history_loaded:
+            return
+        _history_loaded = True
+    # O registro é percorrido entrada a entrada, guardando só as últimas
+    for entry in deque(load_api_usage(), maxlen=OUTPUT_HISTORY_ENTRIES):
+        if entry.get('status', 'ok') != 'ok':
+            continue
+        completion_tokens = entry.get('completion_tokens')
+        if completion_tokens is None:
+            response = get_blob(entry['api_response_hash']) if 'api_response_hash' in entry else entry.get('api_response')
+            if not response:
+                continue
+            completion_tokens = estimate_tokens(response)
+        agent = get_blob(entry['agent_used_hash']) if 'agent_used_hash' in entry else entry.get('agent_used', "")
+        record_output_tokens(entry.get('stage', entry['action']), entry.get('model_name', ""), agent, completion_tokens)
+
+# Função para prever o max_tokens de uma chamada: percentil das saídas do grupo mais específico com amostras
+# suficientes, mais a margem de segurança, sem ultrapassar o espaço que sobra na janela do modelo
+def predict_max_tokens(stage: str, model_name: str, agent: str, prompt_tokens: int, context_window: int) -> Tuple[int, dict]:
+    available = max(MIN_MAX_TOKENS, context_window - prompt_tokens)
+    with _lock:
+        samples = None
+        for key in sample_keys(stage, model_name, agent):
+            if len(_output_samples.get(key, ())) >= OUTPUT_MIN_SAMPLES:
+                samples = list(_output_samples[key])
+                break
+        if samples:
+            predicted = int(percentile(samples, OUTPUT_QUANTILE) * OUTPUT_SAFETY_MARGIN) + OUTPUT_MIN_HEADROOM
+            max_tokens = min(available, max(MIN_MAX_TOKENS, predicted))
+            _predictor_stats['predicted_calls'] += 1
+        else:
+            max_tokens = min(available, DEFAULT_MAX_TOKENS)
+        _predictor_stats['calls'] += 1
+        # Tokens que deixam de ser reservados frente ao max_tokens antigo (a janela inteira do modelo)
+        _predictor_stats['reserved_tokens_freed'] += max(0, context_window - max_tokens)
+    return max_tokens, {'max_tokens': max_tokens, 'predicted': bool(samples), 'samples': len(samples or [])}
+
+# Função para registrar uma resposta cortada pelo limite de tokens, uma vez por resposta
+def record_truncation():
+    with _lock:
+        _predictor_stats['truncated'] += 1
+
+# Função para registrar cada continuação pedida para uma resposta cortada
+def record_continuation():
+    with _lock:
+        _predictor_stats['continuations'] += 1
+
+# Função para obter as estatísticas do previsor de max_tokens
+def get_predictor_stats() -> dict:
+    with _lock:
+        stats = dict(_predictor_stats)
+    stats['truncation_rate'] = stats['truncated'] / stats['calls'] if stats['calls'] else 0.0
+    return stats
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import date, timedelta
+from typing import Callable, Iterator
+
+from json_stream import iter_json_records
+from shared_state import ROLLUP_PARTITION, get_state_backend
+
+logger = logging.getLogger(__name__)
+
+# Formato do nome de cada partição diária
+PARTITION_DATE_FORMAT = '%Y-%m-%d'
+
+# Intervalo (s) entre as execuções do compactador em segundo plano
+COMPACTION_INTERVAL = 3600
+
+# Sufixo da partição renomeada para compactação; um arquivo com esse sufixo é uma compactação interrompida
+COMPACTING_SUFFIX = '.compacting'
+
+_lock = threading.Lock()
+_compactor = None
+
+# Função para obter o nome da partição de hoje
+def today_partition() -> str:
+    return date.today().strftime(PARTITION_DATE_FORMAT)
+
+# Função para obter o caminho de uma partição diária
+def partition_path(store_dir: str, partition: str) -> str:
+    return os.path.join(store_dir, f"{partition}.json")
+
+# Função para listar as partições existentes, da mais antiga para a mais recente
+def list_partitions(store_dir: str) -> list:
+    backend = get_state_backend()
+    if backend:
+        return backend.list_partitions(store_dir)
+    if not os.path.exists(store_dir):
+        return []
+    return sorted(name[:-5] for name in os.listdir(store_dir) if name.endswith('.json'))
+
+# Função para percorrer as entradas de uma partição uma a uma, sem carregar o arquivo inteiro
+def iter_partition(store_dir: str, partition: str) -> Iterator[dict]:
+    backend = get_state_backend()
+    if backend:
+        yield from backend.read_partition(store_dir, partition)
+        return
+    path = partition_path(store_dir, partition)
+    if os.path.exists(path):
+        yield from iter_json_records(path)
+
+# Função para ler as entradas de uma partição
+def read_partition(store_dir: str, partition: str) -> list:
+    return list(iter_partition(store_dir, partition))
+
+# Função para percorrer as entradas de todas as partições, da mais antiga para a mais recente, uma a uma
+def iter_entries(store_dir: str) -> Iterator[dict]:
+    for partition in list_partitions(store_dir):
+        yield from iter_partition(store_dir, partition)
+
+# Função para contar as entradas de todas as partições sem mantê-las em memória
+def count_entries(store_dir: str) -> int:
+    return sum(1 for _ in iter_entries(store_dir))
+
+# Função para acrescentar uma entrada à partição de hoje; o custo depende só do tamanho do dia
+def append_entry(store_dir: str, entry: dict):
+    backend = get_state_backend()
+    if backend:
+        backend.append(store_dir, today_partition(), [entry])
+        return
+    with _lock:
+        os.makedirs(store_dir, exist_ok=True)
+        path = partition_path(store_dir, today_partition())
+        if os.path.exists(path):
+            with open(path, 'r+') as file:
+                entries = list(iter_json_records(file))
+                entries.append(entry)
+                file.seek(0)
+                json.dump(entries, file, indent=4)
+                file.truncate()
+        else:
+            with open(path, 'w') as file:
+                json.dump([entry], file, indent=4)
+
+# Função para carregar as entradas de todas as partições ou, com limit, apenas as mais recentes
+def load_entries(store_dir: str, limit: int = None) -> list:
+    if limit is None:
+        return list(iter_entries(store_dir))
+
+    # Lê as partições da mais recente para a mais antiga até reunir entradas suficientes
+    entries = []
+    for partition in reversed(list_partitions(store_dir)):
+        entries = read_partition(store_dir, partition) + entries
+        if len(entries) >= limit:
+            break
+    return entries[-limit:] if limit > 0 else []
+
+# Função para apagar todas as partições de um armazenamento
+def clear_store(store_dir: str):
+    backend = get_state_backend()
+    if backend:
+        backend.clear(store_dir)
+        return
+    with _lock:
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+
+# Função para reservar um arquivo local para migração, renomeando-o; só um processo consegue reservar cada arquivo
+def claim_file(path: str) -> str:
+    claimed_path = f"{path}.{os.getpid()}.migrating"
+    try:
+        os.replace(path, claimed_path)
+    except FileNotFoundError:
+        return None
+    return claimed_path
+
+# Função para levar ao backend compartilhado os arquivos locais de um armazenamento (partições e agregados),
+# gravados antes de o backend ser configurado
+def import_local_store(store_dir: str, rollup_file: str = None):
+    backend = get_state_backend()
+    if backend is None:
+        return
+    paths = [(partition, partition_path(store_dir, partition)) for partition in sorted(name[:-5] for name in os.listdir(store_dir) if name.endswith('.json'))] if os.path.exists(store_dir) else []
+    if rollup_file:
+        paths.append((None, rollup_file))
+    for partition, path in paths:
+        claimed_path = claim_file(path)
+        if claimed_path is None:
+            continue
+        entries = list(iter_json_records(claimed_path))
+        if partition:
+            backend.append(store_dir, partition, entries)
+        else:
+            backend.append(rollup_file, ROLLUP_PARTITION, entries)
+        os.remove(claimed_path)
+
+# Função para mover um arquivo único antigo para a partição de hoje
+def migrate_legacy_file(legacy_file: str, store_dir: str, transform: Callable = None):
+    backend = get_state_backend()
+    if backend:
+        claimed_path = claim_file(legacy_file)
+        if claimed_path is None:
+            return
+        entries = [transform(entry) if transform else entry for entry in iter_json_records(claimed_path)]
+        backend.append(store_dir, today_partition(), entries)
+        os.remove(claimed_path)
+        return
+    with _lock:
+        if not os.path.exists(legacy_file):
+            return
+        entries = [transform(entry) if transform else entry for entry in iter_json_records(legacy_file)]
+        os.makedirs(store_dir, exist_ok=True)
+        path = partition_path(store_dir, today_partition())
+        if os.path.exists(path):
+            entries.extend(iter_json_records(path))
+        with open(path, 'w') as file:
+            json.dump(entries, file, indent=4)
+        os.remove(legacy_file)
+
+# Função para acrescentar as agregações de uma partição ao arquivo de agregados
+def append_rollups(rollup_file: str, rollups: list):
+    backend = get_state_backend()
+    if backend:
+        backend.append(rollup_file, ROLLUP_PARTITION, rollups)
+        return
+    if os.path.exists(rollup_file):
+        rollups = list(iter_json_records(rollup_file)) + rollups
+    # Grava em arquivo temporário e renomeia, para que uma interrupção nunca deixe o arquivo de agregados pela metade
+    temp_path = f"{rollup_file}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(rollups, file, indent=4)
+    os.replace(temp_path, rollup_file)
+
+# Função para carregar os agregados de um armazenamento
+def load_rollups(rollup_file: str) -> list:
+    backend = get_state_backend()
+    if backend:
+        return backend.read_partition(rollup_file, ROLLUP_PARTITION)
+    if os.path.exists(rollup_file):
+        return list(iter_json_records(rollup_file))
+    return []
+
+# Função para apagar os agregados de um armazenamento
+def clear_rollups(rollup_file: str):
+    backend = get_state_backend()
+    if backend:
+        backend.clear(rollup_file)
+    elif os.path.exists(rollup_file):
+        os.remove(rollup_file)
+
+# Função para agregar e remover uma partição já renomeada para compactação (modo 'files'); os agregados levam o dia
+# no campo 'day', então uma compactação interrompida depois de gravá-los apenas remove a partição
+def finish_compaction(partition: str, compacting_path: str, rollup_function: Callable = None, rollup_file: str = None):
+    if rollup_function and rollup_file and not any(rollup.get('day') == partition for rollup in load_rollups(rollup_file)):
+        rollups = rollup_function(partition, list(iter_json_records(compacting_path)))
+        for rollup in rollups:
+            rollup.setdefault('day', partition)
+        append_rollups(rollup_file, rollups)
+    os.remove(compacting_path)
+
+# Função para aplicar a política de retenção: partições mais antigas que retention_days são agregadas
+# por rollup_function (quando informada) e então removidas inteiras, sem reescrever as demais
+def compact_store(store_dir: str, retention_days: int, rollup_function: Callable = None, rollup_file: str = None) -> int:
+    cutoff = (date.today() - timedelta(days=retention_days)).strftime(PARTITION_DATE_FORMAT)
+    backend = get_state_backend()
+    dropped = 0
+    if backend is None and os.path.exists(store_dir):
+        # Conclui as compactações interrompidas: a partição já saiu da listagem, mas pode faltar agregar ou remover
+        with _lock:
+            for name in sorted(os.listdir(store_dir)):
+                if name.endswith(f".json{COMPACTING_SUFFIX}"):
+                    finish_compaction(name[:-len(f".json{COMPACTING_SUFFIX}")], os.path.join(store_dir, name), rollup_function, rollup_file)
+    for partition in list_partitions(store_dir):
+        if partition >= cutoff:
+            break
+        if backend:
+            # A remoção e a gravação dos agregados são uma única transação; se outro processo já compactou
+            # a partição, nada é removido e os agregados não são gravados de novo
+            rollups = rollup_function(partition, read_partition(store_dir, partition)) if rollup_function and rollup_file else None
+            if backend.drop_partition(store_dir, partition, rollup_file, rollups):
+                dropped += 1
+            continue
+        # A partição é renomeada antes de agregar: sai da listagem de uma vez, e uma interrupção entre gravar os
+        # agregados e remover o arquivo é concluída na próxima execução, sem agregar o dia duas vezes
+        with _lock:
+            compacting_path = partition_path(store_dir, partition) + COMPACTING_SUFFIX
+            os.replace(partition_path(store_dir, partition), compacting_path)
+            finish_compaction(partition, compacting_path, rollup_function, rollup_file)
+        dropped += 1
+    return dropped
+
+# Função para iniciar, uma única vez por processo, o compactador que aplica as políticas periodicamente;
+# cada política é um dicionário com store_dir, retention_days e, opcionalmente, rollup_function e rollup_file,
+# e sweepers são funções sem argumentos executadas depois das políticas (por exemplo, a limpeza dos blobs)
+def start_compactor(policies: list, interval: float = COMPACTION_INTERVAL, sweepers: list = None):
+    global _compactor
+    with _lock:
+        if _compactor is not None:
+            return
+
+        def compactor_loop():
+            while True:
+                for policy in policies:
+                    try:
+                        dropped = compact_store(**policy)
+                        if dropped:
+                            logger.info("Compactador: %d partições removidas de %s", dropped, policy['store_dir'])
+                    except Exception:
+                        logger.exception("Erro ao compactar %s", policy['store_dir'])
+                for sweeper in sweepers or []:
+                    try:
+                        removed = sweeper()
+                        if removed:
+                            logger.info("Compactador: %d itens sem referência removidos por %s", removed, sweeper.__name__)
+                    except Exception:
+                        logger.exception("Erro ao executar %s", sweeper.__name__)
+                time.sleep(interval)
+
+        _compactor = threading.Thread(target=compactor_loop, daemon=True)
+        _compactor.start()
@@ -0,0 +1,780 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Tuple, Union
+from groq import Groq
+from model_router import AUTO_MODEL, ROUTING_LOG_DIR, ensure_latency_table, route_model, log_routing_decision, migrate_routing_log, record_call, estimate_tokens
+from hedging import run_hedged, get_hedge_threshold, record_first_token
+from singleflight import request_key, single_flight
+from blob_store import put_blob, sweep_blobs
+from context_packer import pack_context
+from latency_metrics import key_label, record_completion, record_rate_limit_wait
+from adaptive_limiter import classify_error, is_available, seconds_until_available, limiter_slot
+from semantic_cache import DEFAULT_SIMILARITY_THRESHOLD, lookup_answer, store_answer
+from transport import get_http_client
+from refine_delta import DELTA_INSTRUCTIONS, split_paragraphs, number_paragraphs, parse_edits, apply_edits, record_delta_result
+from evaluation_sections import EvaluationCancelled, run_sections
+from prompt_layout import layout_segments, layout_messages, prompt_text, record_prefix
+from output_predictor import MAX_CONTINUATIONS, CONTINUATION_PROMPT, ensure_output_history, predict_max_tokens, record_output_tokens, record_truncation, record_continuation
+from partitioned_store import append_entry, load_entries, iter_entries, count_entries, clear_store, migrate_legacy_file, import_local_store, start_compactor, load_rollups, clear_rollups
+from shared_state import get_state_backend
+from json_stream import iter_json_records
+
+logger = logging.getLogger(__name__)
+
+# Trava para as escritas nos arquivos JSON, compartilhados pela interface e pela API
+_file_lock = threading.Lock()
+_agents_seeded = False
+_interaction_counter_seeded = False
+
+# Definição de caminhos para arquivos
+FILEPATH = "agents.json"
+CHAT_HISTORY_FILE = 'chat_history.json'
+API_USAGE_FILE = 'api_usage.json'
+
+# Armazenamento e partição do catálogo de agentes no backend compartilhado, semeado a partir de FILEPATH
+AGENTS_STORE = 'agents'
+AGENTS_PARTITION = 'catalog'
+
+# Diretórios com uma partição por dia do histórico de chat e do uso da API
+CHAT_HISTORY_DIR = 'chat_history'
+API_USAGE_DIR = 'api_usage'
+
+# Arquivos com os agregados diários das partições removidas pela retenção
+CHAT_HISTORY_ROLLUP_FILE = 'chat_history_rollups.json'
+API_USAGE_ROLLUP_FILE = 'api_usage_rollups.json'
+
+# Contador persistido das chamadas registradas, que numera as interações sem percorrer o registro de uso: no backend
+# compartilhado fica no espaço e chave abaixo, no modo 'files' em INTERACTION_COUNTER_FILE
+INTERACTION_COUNTER_NAMESPACE = 'counters'
+INTERACTION_COUNTER_KEY = 'api_calls'
+INTERACTION_COUNTER_FILE = 'interaction_counter.json'
+
+# Dias em que as entradas completas são mantidas antes de virarem agregados (configurável por variável de ambiente)
+RETENTION_DAYS = {
+    'chat_history': int(os.environ.get('CHAT_HISTORY_RETENTION_DAYS', 30)),
+    'api_usage': int(os.environ.get('API_USAGE_RETENTION_DAYS', 30)),
+    'routing_log': int(os.environ.get('ROUTING_LOG_RETENTION_DAYS', 30)),
+}
+
+# Tempo (s) que um blob sobrevive à última entrada do uso da API que o referencia: a retenção do uso mais o dia em
+# que a partição ainda está aberta
+BLOB_TTL = (RETENTION_DAYS['api_usage'] + 1) * 86400
+
+# Definição de modelos e tokens
+MODEL_MAX_TOKENS = {
+    'mixtral-8x7b-32768': 32768,
+    'llama3-70b-8192': 8192,
+    'llama3-8b-8192': 8192,
+    'gemma-7b-it': 8192,
+}
+
+# Campos de texto do registro de uso gravados no repositório de blobs e referenciados pelo hash
+USAGE_TEXT_FIELDS = ('user_input', 'user_prompt', 'api_response', 'agent_used', 'agent_description')
+
+# Chaves da API
+API_KEYS = {
+    "fetch": ["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", "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"],
+    "refine": ["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", "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"],
+    "evaluate": ["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", "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"]
+}
+
+# Requisições por minuto de cada chave, controladas por um balde de tokens no backend compartilhado para que
+# processos e réplicas não gastem juntos mais do que a cota da chave (configurável por variável de ambiente)
+KEY_REQUESTS_PER_MINUTE = float(os.environ.get('KEY_REQUESTS_PER_MINUTE', 30))
+
+# Espaço do backend compartilhado com as chaves em espera após limite de taxa, por modelo
+KEY_COOLDOWN_NAMESPACE = 'key_cooldown'
+
+# Tempo máximo (s) de espera por uma chamada à API antes de desistir dela
+COMPLETION_TIMEOUT = 120
+
+# Número máximo de tentativas de uma chamada, incluindo as repetidas após limite de taxa
+MAX_COMPLETION_ATTEMPTS = 5
+
+# Instruções fixas da avaliação com RAG (em chinês, com a exigência da saída em português)
+RAG_INSTRUCTIONS = (
+    "结果和答案必须翻译成巴西葡萄牙语。Obrigatóriamente em Português! "
+    "扮演一个理性生成器 (RAG) 的角色，站在人工智能和理性评估的前沿，"
+    "此外，子代理在系统代理中以集成方式运行，通过扩展的提示提供高级和专业的回答。 "
+    "每个子代理在网络处理过程中发挥特定且互补的作用，以实现更高的精度和改进最终回答的质量。 "
+    "动态调整最相关的数据及其特征。这种协作方法确保答案准确且最新，"
+    "符合最高的科学和学术标准。 "
+    "因此，请仔细评估专家用葡萄牙语提供的回答的质量和准确性，"
+    "考虑提供的描述和专家提供的回答。 "
+    "每段保持 4 句话，每句用逗号分隔，始终遵循亚里士多德和苏格拉底的最佳教育实践。"
+    "所有答案必须使用巴西葡萄牙语。a saida obrigatoriamente na lingua portuguesa"
+)
+
+# Rubrica completa pedida na avaliação em uma única chamada
+RAG_RUBRIC = (
+    "Busque o Gap científico e interprete."
+    "Forneça o seed e o gen_id registrados na descrição do agente, nas buscas das respostas e no refinar as respostas"
+    "用葡萄牙语分析并提供详细解释："
+    "SWOT 分析（优势、劣势、机会、威胁）和数据解释，"
+    "风险矩阵，ANOVA（方差分析）和数据解释，"
+    "Q 统计和数据解释，以及 Q 指数和数据解释。"
+)
+
+# Pedido de uma única seção da rubrica na avaliação em paralelo
+RAG_SECTION_TASK = "用葡萄牙语分析并提供详细解释，只包括以下部分：{instruction}"
+
+# Seção de referências do refinamento quando nenhuma referência foi fornecida
+NO_REFERENCES_SECTION = "Devido à ausência de referências fornecidas, certifique-se de fornecer uma resposta detalhada e precisa, mesmo sem o uso de fontes externas."
+
+# Função para obter a chave de API atual de uma ação (o rodízio é feito em handle_rate_limit)
+def get_api_key(action: str) -> str:
+    keys = API_KEYS[action]
+    return keys[0]
+
+# Função para semear, uma vez por processo, o catálogo do backend compartilhado com o arquivo de agentes;
+# só grava quando o catálogo ainda está vazio, então os especialistas salvos por outros processos são mantidos
+def seed_agents(backend):
+    global _agents_seeded
+    with _file_lock:
+        if _agents_seeded:
+            return
+        agents = list(iter_json_records(FILEPATH)) if os.path.exists(FILEPATH) else []
+        backend.seed(AGENTS_STORE, AGENTS_PARTITION, agents)
+        _agents_seeded = True
+
+# Função para carregar os agentes do catálogo; o arquivo é lido agente a agente, e um erro de formato
+# informa a linha e a coluna assim que a leitura chega nele
+def load_agents() -> list:
+    backend = get_state_backend()
+    if backend:
+        seed_agents(backend)
+        return backend.read_partition(AGENTS_STORE, AGENTS_PARTITION)
+    if os.path.exists(FILEPATH):
+        return list(iter_json_records(FILEPATH))
+    return []
+
+# Função para obter o número máximo de tokens de um modelo
+def get_max_tokens(model_name: str) -> int:
+    return MODEL_MAX_TOKENS.get(model_name, 4096)
+
+# Função para substituir os textos de uma entrada do registro de uso pelos hashes dos blobs
+def compact_usage_entry(entry: dict) -> dict:
+    for field in USAGE_TEXT_FIELDS:
+        if field in entry:
+            entry[f'{field}_hash'] = put_blob(entry.pop(field), ttl=BLOB_TTL)
+    return entry
+
+# Função para registrar o uso da API
+def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_taken: float, user_input: str, user_prompt: str, api_response: str, agent_used: str, agent_description: str, model_name: str = "", status: str = 'ok', stage: str = "", completion_tokens: int = None, max_tokens: int = None):
+    entry = {
+        'timestamp': time.time(),
+        'action': action,
+        'stage': stage or action,
+        'interaction_number': interaction_number,
+        'tokens_used': tokens_used,
+        'time_taken': time_taken,
+        'user_input': user_input,
+        'user_prompt': user_prompt,
+        'api_response': api_response,
+        'agent_used': agent_used,
+        'agent_description': agent_description,
+        'model_name': model_name,
+        'status': status
+    }
+    if completion_tokens is not None:
+        entry['completion_tokens'] = completion_tokens
+        entry['max_tokens'] = max_tokens
+    # O contador é atualizado antes de gravar a entrada, para que a semeadura não conte esta chamada duas vezes
+    update_interaction_counter(1)
+    append_entry(API_USAGE_DIR, compact_usage_entry(entry))
+
+# Função para contar as chamadas já registradas, inclusive as que a retenção transformou em agregados;
+# usada só para iniciar o contador persistido
+def count_logged_calls() -> int:
+    return count_api_usage() + sum(rollup.get('calls', 0) for rollup in load_api_usage_rollups())
+
+# Função para somar amount ao contador persistido de chamadas e devolver o novo valor; na primeira vez, o contador
+# parte das chamadas já registradas, e a retenção nunca o faz voltar
+def update_interaction_counter(amount: int) -> int:
+    global _interaction_counter_seeded
+    backend = get_state_backend()
+    if backend:
+        with _file_lock:
+            if not _interaction_counter_seeded:
+                # Entre processos que semeiam juntos, só o primeiro incremento parte das chamadas contadas
+                if backend.get(INTERACTION_COUNTER_NAMESPACE, INTERACTION_COUNTER_KEY) is None:
+                    backend.increment(INTERACTION_COUNTER_NAMESPACE, INTERACTION_COUNTER_KEY, 0, count_logged_calls())
+                _interaction_counter_seeded = True
+        return backend.increment(INTERACTION_COUNTER_NAMESPACE, INTERACTION_COUNTER_KEY, amount)
+    with _file_lock:
+        if os.path.exists(INTERACTION_COUNTER_FILE):
+            with open(INTERACTION_COUNTER_FILE, 'r') as file:
+                count = json.load(file)[INTERACTION_COUNTER_KEY]
+            if not amount:
+                return count
+        else:
+            count = count_logged_calls()
+        temp_path = f"{INTERACTION_COUNTER_FILE}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({INTERACTION_COUNTER_KEY: count + amount}, file)
+        os.replace(temp_path, INTERACTION_COUNTER_FILE)
+        return count + amount
+
+# Função para obter o número da próxima interação, pelo contador persistido de chamadas
+def get_interaction_number() -> int:
+    return update_interaction_counter(0) + 1
+
+# Função para obter da mensagem de limite de taxa o tempo (s) de espera pedido pela API
+def parse_rate_limit_wait(error_message: str) -> float:
+    return float(error_message.split("try again in")[1].split("s.")[0].strip())
+
+# Função para lidar com limite de taxa
+def handle_rate_limit(error_message: str, action: str, on_warning: Callable = None, wait: bool = True):
+    if 'rate_limit_exceeded' in error_message:
+        wait_time = parse_rate_limit_wait(error_message)
+        if not wait:
+            # Ainda há chave não tentada nesta requisição: troca de chave sem esperar
+            API_KEYS[action].append(API_KEYS[action].pop(0))
+            return 0.0
+        message = f"Limite de taxa atingido. Aguardando {wait_time} segundos..."
+        if on_warning:
+            on_warning(message)
+        else:
+            logger.warning(message)
+        time.sleep(wait_time)
+        # Alterna para a próxima chave de API disponível
+        API_KEYS[action].append(API_KEYS[action].pop(0))
+        return wait_time
+    else:
+        raise Exception(error_message)
+
+# Função para salvar o histórico de chat
+def save_chat_history(user_input, user_prompt, expert_response, chat_history_dir=CHAT_HISTORY_DIR):
+    chat_entry = {
+        'timestamp': time.time(),
+        'user_input': user_input,
+        'user_prompt': user_prompt,
+        'expert_response': expert_response
+    }
+    append_entry(chat_history_dir, chat_entry)
+
+# Função para carregar o histórico de chat; com limit, lê apenas as partições necessárias para as últimas interações
+def load_chat_history(limit: int = None, chat_history_dir=CHAT_HISTORY_DIR):
+    return load_entries(chat_history_dir, limit)
+
+# Função para limpar o histórico de chat
+def clear_chat_history(chat_history_dir=CHAT_HISTORY_DIR):
+    clear_store(chat_history_dir)
+    clear_rollups(CHAT_HISTORY_ROLLUP_FILE)
+    if os.path.exists(CHAT_HISTORY_FILE):
+        os.remove(CHAT_HISTORY_FILE)
+
+# Função para carregar o uso da API dentro do período de retenção
+def load_api_usage():
+    return load_entries(API_USAGE_DIR)
+
+# Função para percorrer o uso da API entrada a entrada, para análises que não precisam do registro inteiro em memória
+def iter_api_usage():
+    return iter_entries(API_USAGE_DIR)
+
+# Função para contar as chamadas registradas no uso da API
+def count_api_usage() -> int:
+    return count_entries(API_USAGE_DIR)
+
+# Função para carregar os agregados diários do uso da API já removido pela retenção
+def load_api_usage_rollups():
+    return load_rollups(API_USAGE_ROLLUP_FILE)
+
+# Função para apagar todo o uso da API registrado, inclusive os agregados
+def clear_api_usage():
+    clear_store(API_USAGE_DIR)
+    clear_rollups(API_USAGE_ROLLUP_FILE)
+    if os.path.exists(API_USAGE_FILE):
+        os.remove(API_USAGE_FILE)
+    # Sem registro de uso, a numeração das interações recomeça
+    backend = get_state_backend()
+    if backend:
+        backend.delete(INTERACTION_COUNTER_NAMESPACE, INTERACTION_COUNTER_KEY)
+    elif os.path.exists(INTERACTION_COUNTER_FILE):
+        os.remove(INTERACTION_COUNTER_FILE)
+
+# Função para agregar as entradas de uso da API de um dia por ação, modelo e situação
+def rollup_api_usage(partition: str, entries: list) -> list:
+    groups = {}
+    for entry in entries:
+        key = (entry.get('action'), entry.get('model_name', ""), entry.get('status', 'ok'))
+        group = groups.setdefault(key, {'day': partition, 'action': key[0], 'model_name': key[1], 'status': key[2], 'calls': 0, 'tokens_used': 0, 'time_taken_total': 0.0, 'time_taken_max': 0.0})
+        group['calls'] += 1
+        group['tokens_used'] += entry.get('tokens_used', 0)
+        group['time_taken_total'] += entry.get('time_taken', 0.0)
+        group['time_taken_max'] = max(group['time_taken_max'], entry.get('time_taken', 0.0))
+    return list(groups.values())
+
+# Função para agregar as interações de chat de um dia
+def rollup_chat_history(partition: str, entries: list) -> list:
+    return [{'day': partition, 'turns': len(entries)}]
+
+# Função para remover os blobs que nenhuma entrada retida do uso da API referencia mais
+def sweep_usage_blobs() -> int:
+    return sweep_blobs(BLOB_TTL)
+
+# Função para migrar os arquivos únicos antigos (e, com backend compartilhado, as partições locais) e iniciar o compactador das
+# partições e a limpeza dos blobs
+def start_storage_maintenance():
+    migrate_legacy_file(API_USAGE_FILE, API_USAGE_DIR, compact_usage_entry)
+    migrate_legacy_file(CHAT_HISTORY_FILE, CHAT_HISTORY_DIR)
+    import_local_store(API_USAGE_DIR, API_USAGE_ROLLUP_FILE)
+    import_local_store(CHAT_HISTORY_DIR, CHAT_HISTORY_ROLLUP_FILE)
+    migrate_routing_log()
+    start_compactor([
+        {'store_dir': API_USAGE_DIR, 'retention_days': RETENTION_DAYS['api_usage'], 'rollup_function': rollup_api_usage, 'rollup_file': API_USAGE_ROLLUP_FILE},
+        {'store_dir': CHAT_HISTORY_DIR, 'retention_days': RETENTION_DAYS['chat_history'], 'rollup_function': rollup_chat_history, 'rollup_file': CHAT_HISTORY_ROLLUP_FILE},
+        {'store_dir': ROUTING_LOG_DIR, 'retention_days': RETENTION_DAYS['routing_log']},
+    ], sweepers=[sweep_usage_blobs])
+
+# Função para montar as mensagens de uma chamada; o prompt pode ser um texto ou uma lista de segmentos (tipo, texto),
+# ordenados do mais estável ao mais volátil para que chamadas seguidas compartilhem o maior prefixo possível
+def build_messages(prompt: Union[str, list]) -> list:
+    return layout_messages(layout_segments(prompt))
+
+# Função para estimar os tokens de uma lista de mensagens
+def estimate_messages_tokens(messages: list) -> int:
+    return sum(estimate_tokens(message['content']) for message in messages)
+
+# Função para obter uma conclusão sem streaming
+def create_completion(api_key: str, messages: list, model_name: str, temperature: float, max_tokens: int) -> dict:
+    # O cliente é recriado a cada tentativa para usar a chave atual após um rodízio
+    client = Groq(api_key=api_key, timeout=COMPLETION_TIMEOUT, http_client=get_http_client())
+    completion = client.chat.completions.create(
+        messages=messages,
+        model=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=1,
+        stop=None,
+        stream=False
+    )
+    api_response = completion.choices[0].message.content or ""
+    return {
+        'content': api_response,
+        'tokens_used': completion.usage.total_tokens,
+        'completion_tokens': completion.usage.completion_tokens,
+        'finish_reason': completion.choices[0].finish_reason,
+    }
+
+# Função para obter uma conclusão via streaming, sinalizando o primeiro token e interrompendo se cancelada
+def stream_completion(api_key: str, messages: list, model_name: str, temperature: float, max_tokens: int, stage: str, first_token, cancel, on_token: Callable = None) -> dict:
+    client = Groq(api_key=api_key, timeout=COMPLETION_TIMEOUT, http_client=get_http_client())
+    start_time = time.time()
+    stream = client.chat.completions.create(
+        messages=messages,
+        model=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=1,
+        stop=None,
+        stream=True
+    )
+    chunks = []
+    tokens_used = 0
+    completion_tokens = 0
+    finish_reason = None
+    try:
+        for chunk in stream:
+            if cancel.is_set():
+                # Chamada perdedora: estima os tokens já consumidos para a contabilidade do hedge
+                partial_response = "".join(chunks)
+                return {'content': partial_response, 'tokens_used': estimate_messages_tokens(messages) + estimate_tokens(partial_response), 'cancelled': True}
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not first_token.is_set():
+                    record_first_token(model_name, stage, time.time() - start_time)
+                    first_token.set()
+                chunks.append(chunk.choices[0].delta.content)
+                if on_token:
+                    on_token(chunk.choices[0].delta.content)
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.x_groq and chunk.x_groq.usage:
+                tokens_used = chunk.x_groq.usage.total_tokens
+                completion_tokens = chunk.x_groq.usage.completion_tokens
+    finally:
+        stream.close()
+    api_response = "".join(chunks)
+    return {
+        'content': api_response,
+        'tokens_used': tokens_used or estimate_messages_tokens(messages) + estimate_tokens(api_response),
+        'completion_tokens': completion_tokens or estimate_tokens(api_response),
+        'finish_reason': finish_reason,
+        'cancelled': False,
+    }
+
+# Função para obter as chaves de uma ação na ordem do rodízio, começando pelas que aceitam chamadas para o modelo;
+# key_offset desloca o rodízio para espalhar chamadas simultâneas da mesma ação entre as chaves
+# e deixando por último as que algum processo viu atingir o limite de taxa do modelo
+def get_available_api_keys(action: str, model_name: str, key_offset: int = 0) -> list:
+    keys = list(API_KEYS[action])
+    key_offset %= len(keys)
+    keys = keys[key_offset:] + keys[:key_offset]
+    cooled_keys = {cooldown['key_id'] for cooldown in get_key_cooldowns() if cooldown['model'] == model_name}
+    return sorted(keys, key=lambda key: (not is_available(key, model_name), key_id(key) in cooled_keys))
+
+# Função para obter o identificador de uma chave no estado compartilhado, sem expor a chave
+def key_id(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+# Função para avisar aos demais processos que uma chave atingiu o limite de taxa do modelo, pelo tempo pedido pela API
+def set_key_cooldown(api_key: str, model_name: str, wait_time: float):
+    backend = get_state_backend()
+    if backend and wait_time > 0:
+        backend.put(KEY_COOLDOWN_NAMESPACE, f"{key_id(api_key)}:{model_name}", {'key': key_label(api_key), 'key_id': key_id(api_key), 'model': model_name, 'until': time.time() + wait_time}, ttl=wait_time)
+
+# Função para obter as chaves em espera após limite de taxa, vistas por todos os processos
+def get_key_cooldowns() -> list:
+    backend = get_state_backend()
+    if backend is None:
+        return []
+    return list(backend.items(KEY_COOLDOWN_NAMESPACE).values())
+
+# Função para retirar uma requisição da cota por minuto de uma chave, compartilhada por todos os processos;
+# devolve 0 quando conseguiu ou o tempo (s) até a cota se recompor
+def consume_key_quota(backend, api_key: str) -> float:
+    return backend.consume(f"requests:{key_id(api_key)}", 1, KEY_REQUESTS_PER_MINUTE, KEY_REQUESTS_PER_MINUTE / 60)
+
+# Função para reservar uma requisição na cota por minuto da primeira chave (na ordem do rodízio) que ainda tem cota;
+# sem cota em nenhuma, espera a que se recompõe primeiro. Sem backend compartilhado, a cota fica com o limite de taxa da API
+def reserve_api_key(api_keys: list) -> str:
+    backend = get_state_backend()
+    if backend is None:
+        return api_keys[0]
+    while True:
+        wait_times = []
+        for api_key in api_keys:
+            wait_time = consume_key_quota(backend, api_key)
+            if not wait_time:
+                return api_key
+            wait_times.append(wait_time)
+        logger.info("Cota por minuto esgotada em todas as chaves; aguardando %.2f segundos", min(wait_times))
+        time.sleep(min(wait_times))
+
+# Função para reservar uma requisição na cota de uma chave já escolhida (hedge e continuações), esperando a cota se recompor
+def reserve_key_quota(api_key: str):
+    backend = get_state_backend()
+    if backend is None:
+        return
+    while True:
+        wait_time = consume_key_quota(backend, api_key)
+        if not wait_time:
+            return
+        logger.info("Cota por minuto esgotada na chave %s; aguardando %.2f segundos", key_label(api_key), wait_time)
+        time.sleep(wait_time)
+
+# Função para executar uma chamada dentro do limite de concorrência adaptativo da chave e do modelo; cada chamada
+# retira uma requisição da cota compartilhada da chave, exceto a que usa a requisição já reservada em prepaid_keys
+def call_with_limiter(api_key: str, model_name: str, function: Callable, *args, prepaid_keys: set = None, **kwargs):
+    if prepaid_keys is not None and api_key in prepaid_keys:
+        prepaid_keys.discard(api_key)
+    else:
+        reserve_key_quota(api_key)
+    with limiter_slot(api_key, model_name):
+        return function(*args, **kwargs)
+
+# Função para obter a conclusão de um prompt; requisições idênticas simultâneas compartilham uma única chamada à API.
+# Uma chamada com cancel não é compartilhada: quando cancel é acionado, a resposta deixa de ser lida e EvaluationCancelled é levantado
+def get_completion(action: str, prompt: Union[str, list], model_name: str, temperature: float, interaction_number: int, user_input: str, user_prompt: str, agent_used: str, agent_description: str, stage: str = "", hedge: bool = False, on_warning: Callable = None, on_token: Callable = None, key_offset: int = 0, cancel: threading.Event = None) -> str:
+    stage = stage or action
+    if cancel is not None:
+        return request_completion(action, prompt, model_name, temperature, interaction_number, user_input, user_prompt, agent_used, agent_description, stage, hedge, on_warning, on_token, key_offset, cancel)
+    key = request_key(action, stage, model_name, temperature, prompt_text(prompt))
+    return single_flight(key, lambda: request_completion(action, prompt, model_name, temperature, interaction_number, user_input, user_prompt, agent_used, agent_description, stage, hedge, on_warning, on_token, key_offset))
+
+# Função para requisitar a conclusão de um prompt à API, com roteamento automático de modelo e hedge opcionais
+def request_completion(action: str, prompt: Union[str, list], model_name: str, temperature: float, interaction_number: int, user_input: str, user_prompt: str, agent_used: str, agent_description: str, stage: str, hedge: bool, on_warning: Callable, on_token: Callable = None, key_offset: int = 0, cancel: threading.Event = None) -> str:
+    if model_name == AUTO_MODEL:
+        ensure_latency_table(iter_api_usage)
+        # Modelos com o disjuntor aberto em todas as chaves da ação ficam fora do roteamento
+        model_name, decision = route_model(stage, prompt_text(prompt), MODEL_MAX_TOKENS, lambda candidate: any(is_available(key, candidate) for key in API_KEYS[action]))
+        log_routing_decision(decision)
+    start_time = time.time()
+    metrics_stage = stage or action
+    # O max_tokens é previsto pelo tamanho das saídas anteriores da etapa, do modelo e do agente
+    ensure_output_history(iter_api_usage)
+    segments = layout_segments(prompt)
+    messages = layout_messages(segments)
+    record_prefix(model_name, metrics_stage, segments)
+    max_tokens, _ = predict_max_tokens(metrics_stage, model_name, agent_used, estimate_messages_tokens(messages), get_max_tokens(model_name))
+    tried_keys = set()
+    for _ in range(MAX_COMPLETION_ATTEMPTS):
+        api_keys = get_available_api_keys(action, model_name, key_offset)
+        api_key = reserve_api_key(api_keys)
+        api_keys = [api_key] + [key for key in api_keys if key != api_key]
+        tried_keys.add(api_key)
+        attempt_start = time.time()
+        # A requisição reservada na escolha da chave vale para a primeira chamada; hedge e continuações reservam a sua
+        prepaid_keys = {api_key}
+
+        def complete(call_messages: list) -> dict:
+            if hedge:
+                # Se o primeiro token não chegar até o limite dinâmico, a mesma chamada é feita com a próxima chave
+                return run_hedged(
+                    lambda hedge_key, first_token, cancel: call_with_limiter(hedge_key, model_name, stream_completion, hedge_key, call_messages, model_name, temperature, max_tokens, stage, first_token, cancel, prepaid_keys=prepaid_keys),
+                    api_keys,
+                    get_hedge_threshold(model_name, stage)
+                )
+            if on_token or cancel is not None:
+                # Streaming simples, repassando cada trecho para quem acompanha a resposta parcial e parando de ler quando cancelada
+                return call_with_limiter(api_key, model_name, stream_completion, api_key, call_messages, model_name, temperature, max_tokens, stage, threading.Event(), cancel or threading.Event(), on_token, prepaid_keys=prepaid_keys)
+            return call_with_limiter(api_key, model_name, create_completion, api_key, call_messages, model_name, temperature, max_tokens, prepaid_keys=prepaid_keys)
+
+        tokens_used = 0
+        try:
+            result = complete(messages)
+            if result.get('cancelled'):
+                tokens_used = result['tokens_used']
+                raise EvaluationCancelled("Chamada cancelada.")
+            api_response = result['content']
+            tokens_used = result['tokens_used']
+            completion_tokens = result['completion_tokens']
+            # Resposta cortada pelo limite de tokens: pede a continuação e junta as partes
+            call_messages = messages
+            if result.get('finish_reason') == 'length':
+                record_truncation()
+            for _ in range(MAX_CONTINUATIONS):
+                if result.get('finish_reason') != 'length':
+                    break
+                record_continuation()
+                call_messages = call_messages + [{"role": "assistant", "content": result['content']}, {"role": "user", "content": CONTINUATION_PROMPT}]
+                result = complete(call_messages)
+                if result.get('cancelled'):
+                    tokens_used += result['tokens_used']
+                    raise EvaluationCancelled("Chamada cancelada.")
+                api_response += result['content']
+                tokens_used += result['tokens_used']
+                completion_tokens += result['completion_tokens']
+            end_time = time.time()
+            time_taken = end_time - start_time
+            record_call(model_name, time_taken)
+            record_completion(model_name, api_key, metrics_stage, end_time - attempt_start, tokens_used)
+            record_output_tokens(metrics_stage, model_name, agent_used, completion_tokens)
+            log_api_usage(action, interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, agent_used, agent_description, model_name, stage=metrics_stage, completion_tokens=completion_tokens, max_tokens=max_tokens)
+            return api_response
+        except EvaluationCancelled:
+            # Os tokens já gerados até o cancelamento ficam no registro de uso
+            log_api_usage(action, interaction_number, tokens_used, time.time() - start_time, user_input, user_prompt, "", agent_used, agent_description, model_name, 'cancelled', stage=metrics_stage)
+            raise
+        except Exception as e:
+            status = classify_error(e)
+            time_taken = time.time() - start_time
+            record_call(model_name, time_taken, status)
+            record_completion(model_name, api_key, metrics_stage, time.time() - attempt_start, status=status)
+            log_api_usage(action, interaction_number, 0, time_taken, user_input, user_prompt, "", agent_used, agent_description, model_name, status, stage=metrics_stage)
+            if status == 'rate_limited':
+                # Os demais processos passam a evitar esta chave para o modelo até o fim da espera pedida pela API
+                set_key_cooldown(api_key, model_name, parse_rate_limit_wait(str(e)))
+            if status == 'timeout':
+                # Tempo esgotado: tenta de novo com a próxima chave, sem esperar
+                API_KEYS[action].append(API_KEYS[action].pop(0))
+                continue
+            if status == 'circuit_open':
+                # Disjuntor aberto nesta chave: segue para outra chave; se nenhuma aceitar chamadas, espera o primeiro
+                # disjuntor liberar uma chamada de teste
+                API_KEYS[action].append(API_KEYS[action].pop(0))
+                if not any(is_available(key, model_name) for key in api_keys):
+                    wait_time = min(seconds_until_available(key, model_name) for key in api_keys)
+                    logger.info("Disjuntor aberto em todas as chaves do modelo %s; aguardando %.2f segundos", model_name, wait_time)
+                    time.sleep(wait_time)
+                continue
+            # Só espera o limite de taxa quando todas as chaves disponíveis já foram tentadas nesta requisição
+            untried_keys = [key for key in api_keys if key not in tried_keys and is_available(key, model_name)]
+            wait_time = handle_rate_limit(str(e), action, on_warning, wait=not untried_keys)
+            record_rate_limit_wait(model_name, api_key, metrics_stage, wait_time)
+    raise Exception(f"Limite de {MAX_COMPLETION_ATTEMPTS} tentativas atingido para a ação '{action}'.")
+
+# Função para obter a similaridade mínima do cache semântico de um agente (campo opcional "limiar_cache" do catálogo)
+def get_cache_threshold(agent_selection: str) -> float:
+    agent_found = next((agent for agent in load_agents() if agent.get("agente") == agent_selection), None)
+    if agent_found and "limiar_cache" in agent_found:
+        return float(agent_found["limiar_cache"])
+    return DEFAULT_SIMILARITY_THRESHOLD
+
+# Função para montar o prompt da fase um da busca, que descreve o especialista ideal
+def build_phase_one_prompt(user_input: str, user_prompt: str) -> list:
+    return [
+        ('instructions', "Descreva o especialista ideal para responder a solicitação do usuário."),
+        ('request', f"Solicitação: {user_input} e {user_prompt}."),
+    ]
+
+# Função para montar o prompt da fase dois da busca, respondida pelo especialista
+def build_phase_two_prompt(expert_title: str, history_context: str, user_input: str, user_prompt: str) -> list:
+    return [
+        ('expert', f"{expert_title}, responda a solicitação do usuário de forma completa e detalhada."),
+        ('history', f"Histórico do chat:{history_context}"),
+        ('request', f"Solicitação: {user_input} e {user_prompt}."),
+    ]
+
+# Função para montar o prompt do refinamento com a reescrita completa da resposta
+def build_refine_prompt(expert_title: str, history_context: str, references_section: str, user_input: str, user_prompt: str, phase_two_response: str) -> list:
+    return [
+        ('expert', f"{expert_title}, refine a resposta do especialista para a solicitação original."),
+        ('history', f"Histórico do chat:{history_context}"),
+        ('references', references_section),
+        ('request', f"Solicitação original: {user_input} e {user_prompt}."),
+        ('response', f"Resposta a refinar: {phase_two_response}"),
+    ]
+
+# Função para montar o prompt do refinamento no modo 'delta', com os parágrafos numerados
+def build_delta_prompt(expert_title: str, history_context: str, references_section: str, user_input: str, user_prompt: str, paragraphs: list) -> list:
+    return [
+        ('expert', f"{expert_title}, refine a resposta do especialista para a solicitação original."),
+        ('history', f"Histórico do chat:{history_context}"),
+        ('references', references_section),
+        ('request', f"Solicitação original: {user_input} e {user_prompt}."),
+        ('response', f"Resposta, dividida em parágrafos numerados:\n{number_paragraphs(paragraphs)}"),
+        ('task', DELTA_INSTRUCTIONS),
+    ]
+
+# Função para buscar resposta do assistente; com semantic_cache em 'answer' ou 'expert', perguntas parecidas
+# já respondidas reaproveitam a resposta inteira ou apenas o especialista gerado, e on_cache_hit recebe a entrada usada
+def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str, temperature: float, agent_selection: str, chat_history: list, interaction_number: int, hedge: bool = False, on_warning: Callable = None, on_token: Callable = None, semantic_cache: str = 'off', on_cache_hit: Callable = None, key_offset: int = 0) -> Tuple[str, str]:
+    expert_title = ""
+    expert_description = ""
+    cache_hit = None
+    # No modo 'expert', só o especialista gerado é reaproveitado; com um agente do catálogo não há o que reaproveitar
+    use_cache = semantic_cache == 'answer' or semantic_cache == 'expert' and agent_selection == "Escolher um especialista..."
+    if use_cache:
+        cache_hit = lookup_answer(user_input, user_prompt, agent_selection, get_cache_threshold(agent_selection))
+    if cache_hit:
+        if on_cache_hit:
+            on_cache_hit(cache_hit)
+        if semantic_cache == 'answer':
+            log_api_usage('fetch', interaction_number, 0, 0.0, user_input, user_prompt, cache_hit['response'], cache_hit['expert_title'], cache_hit['expert_description'], "", 'cache_hit')
+            return cache_hit['expert_title'], cache_hit['response']
+
+    if cache_hit and agent_selection == "Escolher um especialista...":
+        # Reaproveita o especialista gerado para a pergunta parecida, sem a chamada da fase um
+        expert_title = cache_hit['expert_title']
+        expert_description = cache_hit['expert_description']
+        log_api_usage('fetch', interaction_number, 0, 0.0, user_input, user_prompt, "", expert_title, expert_description, "", 'cache_hit')
+    elif agent_selection == "Escolher um especialista...":
+        phase_one_prompt = build_phase_one_prompt(user_input, user_prompt)
+        phase_one_response = get_completion('fetch', phase_one_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, expert_description, stage='fetch_expert', hedge=hedge, on_warning=on_warning)
+        first_period_index = phase_one_response.find(".")
+        expert_title = phase_one_response[:first_period_index].strip()
+        expert_description = phase_one_response[first_period_index + 1:].strip()
+        save_expert(expert_title, expert_description)
+    else:
+        agent_found = next((agent for agent in load_agents() if agent.get("agente") == agent_selection), None)
+        if agent_found:
+            expert_title = agent_found["agente"]
+            expert_description = agent_found["descricao"]
+        else:
+            raise ValueError("Especialista selecionado não encontrado no arquivo.")
+
+    history_context = ""
+    for entry in chat_history:
+        history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
+
+    phase_two_prompt = build_phase_two_prompt(expert_title, history_context, user_input, user_prompt)
+    phase_two_response = get_completion('fetch', phase_two_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, expert_description, hedge=hedge, on_warning=on_warning, on_token=on_token, key_offset=key_offset)
+
+    # Uma pergunta que já teve um acerto no cache não grava outra entrada quase igual
+    if use_cache and not cache_hit:
+        store_answer(user_input, user_prompt, agent_selection, expert_title, expert_description, phase_two_response)
+    return expert_title, phase_two_response
+
+# Função para refinar resposta; no modo 'delta' o modelo devolve apenas edições por parágrafo, aplicadas localmente,
+# e a reescrita completa só é pedida quando as edições não puderem ser lidas ou aplicadas
+def refine_response(expert_title: str, phase_two_response: str, user_input: str, user_prompt: str, model_name: str, temperature: float, references: list, chat_history: list, interaction_number: int, hedge: bool = False, on_warning: Callable = None, on_token: Callable = None, mode: str = 'full') -> str:
+    history_context = ""
+    for entry in chat_history:
+        history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
+
+    if references:
+        # Apenas os trechos mais relevantes e não redundantes entram no prompt, dentro do orçamento da etapa
+        references_context, _ = pack_context(references, f"{user_input} {user_prompt} {phase_two_response}", 'refine')
+        references_section = f"Referências:{references_context}"
+    else:
+        references_section = NO_REFERENCES_SECTION
+
+    if mode == 'delta':
+        paragraphs = split_paragraphs(phase_two_response)
+        delta_prompt = build_delta_prompt(expert_title, history_context, references_section, user_input, user_prompt, paragraphs)
+        # As edições não são repassadas em streaming: o texto parcial seria o JSON, não a resposta
+        delta_response = get_completion('refine', delta_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, "", stage='refine_delta', hedge=hedge, on_warning=on_warning)
+        try:
+            edits = parse_edits(delta_response)
+            refined_response = apply_edits(paragraphs, edits)
+        except ValueError as e:
+            logger.warning("Edições do refinamento descartadas (%s); refazendo com a reescrita completa", e)
+            record_delta_result(len(paragraphs))
+            if on_warning:
+                on_warning("As edições do refinamento não puderam ser aplicadas. Refazendo com a reescrita completa da resposta.")
+        else:
+            record_delta_result(len(paragraphs), edits)
+            if on_token:
+                on_token(refined_response)
+            return refined_response
+
+    refine_prompt = build_refine_prompt(expert_title, history_context, references_section, user_input, user_prompt, phase_two_response)
+    refined_response = get_completion('refine', refine_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, "", hedge=hedge, on_warning=on_warning, on_token=on_token)
+    return refined_response
+
+# Função para montar os segmentos comuns do prompt de avaliação; o que é igual em todas as avaliações vem primeiro
+# e a descrição, a pergunta e a resposta avaliada vêm por último
+def build_rag_segments(expert_description: str, user_input: str, user_prompt: str, assistant_response: str) -> list:
+    return [
+        ('instructions', RAG_INSTRUCTIONS),
+        ('expert', f"以下是专家的详细描述，突出他们的资历和经验：{expert_description}。"),
+        ('request', f"原始问题如下：{user_input} 和 {user_prompt}。"),
+        ('response', f"专家用葡萄牙语提供的回答如下：{assistant_response}。"),
+    ]
+
+# Função para avaliar resposta com RAG; com fan_out, cada seção da rubrica é pedida em uma chamada própria,
+# em paralelo e espalhada entre as chaves, e on_token recebe cada seção assim que ela termina. Cada seção repete
+# todo o contexto, então fan_out custa cerca de 5,4 vezes os tokens de prompt da chamada única e só é usado
+# quando pedido; cancel interrompe as chamadas em andamento e as que ainda não começaram
+def evaluate_response_with_rag(user_input: str, user_prompt: str, expert_title: str, expert_description: str, assistant_response: str, model_name: str, temperature: float, chat_history: list, interaction_number: int, hedge: bool = False, on_warning: Callable = None, on_token: Callable = None, references: list = None, fan_out: bool = False, cancel: threading.Event = None) -> str:
+    history_context = ""
+    for entry in chat_history:
+        history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
+
+    rag_segments = build_rag_segments(expert_description, user_input, user_prompt, assistant_response)
+
+    if references:
+        references_context, _ = pack_context(references, f"{user_input} {user_prompt} {assistant_response}", 'evaluate')
+        rag_segments.append(('references', f"参考资料：{references_context}"))
+
+    if fan_out:
+        def run_section(index: int, section_id: str, instruction: str) -> str:
+            # Só a seção pedida muda entre as chamadas, então ela fica no fim e as seções compartilham todo o prefixo
+            section_prompt = rag_segments + [('task', RAG_SECTION_TASK.format(instruction=instruction))]
+            # Cada seção começa o rodízio por uma chave diferente, para dividir a carga entre as chaves
+            return get_completion('evaluate', section_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, expert_description, stage=f"evaluate_{section_id}", hedge=hedge, on_warning=on_warning, key_offset=index, cancel=cancel)
+
+        return run_sections(run_section, on_token, cancel=cancel)
+
+    rag_prompt = rag_segments + [('instructions', RAG_RUBRIC)]
+
+    rag_response = get_completion('evaluate', rag_prompt, model_name, temperature, interaction_number, user_input, user_prompt, expert_title, expert_description, hedge=hedge, on_warning=on_warning, on_token=on_token, cancel=cancel)
+    return rag_response
+
+# Função para salvar o especialista gerado
+def save_expert(expert_title: str, expert_description: str):
+    new_expert = {
+        "agente": expert_title,
+        "descricao": expert_description
+    }
+    backend = get_state_backend()
+    if backend:
+        seed_agents(backend)
+        backend.append(AGENTS_STORE, AGENTS_PARTITION, [new_expert])
+        return
+    with _file_lock:
+        if os.path.exists(FILEPATH):
+            with open(FILEPATH, 'r+') as file:
+                agents = list(iter_json_records(file))
+                agents.append(new_expert)
+                file.seek(0)
+                json.dump(agents, file, indent=4)
+        else:
+            with open(FILEPATH, 'w') as file:
+                json.dump([new_expert], file, indent=4)
+
@@ -0,0 +1,214 @@
+import argparse
+import ast
+import glob
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from pipeline import MODEL_MAX_TOKENS, API_KEYS, RAG_RUBRIC, RAG_SECTION_TASK, NO_REFERENCES_SECTION, build_phase_one_prompt, build_phase_two_prompt, build_refine_prompt, build_delta_prompt, build_rag_segments, build_messages, create_completion
+from refine_delta import split_paragraphs
+from evaluation_sections import EVALUATION_SECTIONS
+from model_router import estimate_tokens, percentile
+
+# Diretório onde os resultados de cada execução são salvos para comparar versões dos prompts
+PROMPT_BENCHMARK_RESULTS_DIR = 'prompt_benchmark_results'
+
+# Arquivos com as variantes dos mesmos prompts: chinês (versão original), português e a versão mista usada por run.py
+PROMPT_SOURCES = {
+    'chinês': 'run_original',
+    'português': 'runBR.py',
+}
+
+# Variáveis dos prompts de cada etapa nos arquivos de origem
+PROMPT_VARIABLES = {
+    'fetch_expert': 'phase_one_prompt',
+    'fetch': 'phase_two_prompt',
+    'refine': 'refine_prompt',
+    'evaluate': 'rag_prompt',
+}
+
+# Tokenizadores publicados de cada modelo (arquivo tokenizer.json no Hugging Face)
+MODEL_TOKENIZERS = {
+    'mixtral-8x7b-32768': 'mistralai/Mixtral-8x7B-Instruct-v0.1',
+    'llama3-70b-8192': 'meta-llama/Meta-Llama-3-70B-Instruct',
+    'llama3-8b-8192': 'meta-llama/Meta-Llama-3-8B-Instruct',
+    'gemma-7b-it': 'google/gemma-7b-it',
+}
+
+# Diretório local com os tokenizadores já baixados, um subdiretório por repositório com "/" trocado por "--"
+TOKENIZERS_DIR = os.environ.get('TOKENIZERS_DIR', 'tokenizers')
+
+# Preço (US$ por milhão de tokens de entrada) de cada modelo na Groq; ajuste se a tabela de preços mudar
+MODEL_INPUT_PRICES = {
+    'mixtral-8x7b-32768': 0.24,
+    'llama3-70b-8192': 0.59,
+    'llama3-8b-8192': 0.05,
+    'gemma-7b-it': 0.07,
+}
+
+# Valores usados no lugar das variáveis dos prompts
+SAMPLE_VALUES = {
+    'user_input': "Explique o processo de fotossíntese e sua importância para os ecossistemas.",
+    'user_prompt': "",
+    'expert_title': "Biólogo especialista em fisiologia vegetal",
+    'expert_description': "Doutor em biologia vegetal com vinte anos de pesquisa em fotossíntese e ecologia de ecossistemas.",
+    'phase_two_response': "A fotossíntese converte luz em energia química nos cloroplastos, produzindo glicose e oxigênio a partir de água e gás carbônico. " * 8,
+    'assistant_response': "A fotossíntese converte luz em energia química nos cloroplastos, produzindo glicose e oxigênio a partir de água e gás carbônico. " * 8,
+}
+
+# Tokens de saída pedidos em cada chamada de latência, para que o tempo medido seja dominado pelo prompt
+LATENCY_MAX_TOKENS = 16
+
+# Namespace que responde às variáveis dos prompts com os valores de exemplo (ou vazio, para medir só as instruções)
+class PromptNamespace(dict):
+    def __missing__(self, name: str) -> str:
+        return ""
+
+# Função para extrair de um arquivo o primeiro valor atribuído a cada variável de prompt, com as variáveis preenchidas
+def extract_prompts(path: str, values: dict) -> dict:
+    with open(path, 'r', encoding='utf-8') as file:
+        tree = ast.parse(file.read(), filename=path)
+    prompts = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            continue
+        for stage, variable in PROMPT_VARIABLES.items():
+            if node.targets[0].id == variable and stage not in prompts:
+                expression = compile(ast.Expression(node.value), path, 'eval')
+                prompts[stage] = eval(expression, {'__builtins__': {}}, PromptNamespace(values))
+    return prompts
+
+# Função para montar as variantes de cada etapa: um prompt ou, na avaliação em paralelo, uma lista de prompts;
+# as de pipeline.py são montadas pelas mesmas funções que montam os prompts enviados, sem histórico nem referências
+def build_variants(values: dict) -> dict:
+    variants = {}
+    for language, path in PROMPT_SOURCES.items():
+        for stage, prompt in extract_prompts(path, values).items():
+            variants[(stage, f"{language} ({path})")] = [prompt]
+    user_input, user_prompt, expert_title = values.get('user_input', ""), values.get('user_prompt', ""), values.get('expert_title', "")
+    variants[('fetch_expert', "português (pipeline.py)")] = [build_phase_one_prompt(user_input, user_prompt)]
+    variants[('fetch', "português (pipeline.py)")] = [build_phase_two_prompt(expert_title, "", user_input, user_prompt)]
+    variants[('refine', "português (pipeline.py)")] = [build_refine_prompt(expert_title, "", NO_REFERENCES_SECTION, user_input, user_prompt, values.get('phase_two_response', ""))]
+    variants[('refine', "português em edições (pipeline.py)")] = [build_delta_prompt(expert_title, "", NO_REFERENCES_SECTION, user_input, user_prompt, split_paragraphs(values.get('phase_two_response', "")))]
+    rag_segments = build_rag_segments(values.get('expert_description', ""), values.get('user_input', ""), values.get('user_prompt', ""), values.get('assistant_response', ""))
+    variants[('evaluate', "misto (pipeline.py)")] = [rag_segments + [('instructions', RAG_RUBRIC)]]
+    variants[('evaluate', "misto em seções (pipeline.py)")] = [rag_segments + [('task', RAG_SECTION_TASK.format(instruction=instruction))] for _, _, instruction in EVALUATION_SECTIONS]
+    return variants
+
+# Função para carregar o tokenizador de um modelo: do diretório local ou do Hugging Face; sem a biblioteca
+# tokenizers ou sem acesso ao arquivo, devolve None e os tokens são estimados
+def load_tokenizer(model_name: str):
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        return None
+    repository = MODEL_TOKENIZERS[model_name]
+    local_path = os.path.join(TOKENIZERS_DIR, repository.replace("/", "--"), 'tokenizer.json')
+    try:
+        if os.path.exists(local_path):
+            return Tokenizer.from_file(local_path)
+        return Tokenizer.from_pretrained(repository)
+    except Exception as e:
+        print(f"Tokenizador de {model_name} indisponível ({e}); usando a estimativa de tokens.")
+        return None
+
+# Função para contar os tokens das mensagens de um prompt com o tokenizador do modelo, ou pela estimativa
+def count_tokens(tokenizer, prompt) -> int:
+    texts = [message['content'] for message in build_messages(prompt)]
+    if tokenizer is None:
+        return sum(estimate_tokens(text) for text in texts)
+    return sum(len(tokenizer.encode(text, add_special_tokens=False).ids) for text in texts)
+
+# Função para iniciar em uma thread o servidor simulado do teste de carga, sem latência própria
+def start_mock_server() -> str:
+    from load_test import MockCompletionHandler
+    MockCompletionHandler.latency = 0.0
+    MockCompletionHandler.rate_limit_rate = 0.0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+# Função para medir a latência (mediana, s) e os tokens de prompt informados pela API para as mensagens de um prompt
+def measure_latency(prompts: list, model_name: str, repeats: int) -> dict:
+    api_key = os.environ.get('GROQ_API_KEY') or API_KEYS['evaluate'][0]
+    times = []
+    api_prompt_tokens = 0
+    for _ in range(repeats):
+        start_time = time.time()
+        api_prompt_tokens = 0
+        for prompt in prompts:
+            result = create_completion(api_key, build_messages(prompt), model_name, 0.0, LATENCY_MAX_TOKENS)
+            api_prompt_tokens += result['tokens_used'] - result['completion_tokens']
+        times.append(time.time() - start_time)
+    return {'latency_p50': round(percentile(times, 0.5), 3), 'api_prompt_tokens': api_prompt_tokens}
+
+# Função para executar o benchmark: tokens de cada variante (com os valores de exemplo e só as instruções), custo estimado e latência
+def run_benchmark(models: list, repeats: int, measure: bool) -> list:
+    variants = build_variants(SAMPLE_VALUES)
+    instruction_variants = build_variants({})
+    rows = []
+    for model_name in models:
+        tokenizer = load_tokenizer(model_name)
+        for (stage, variant), prompts in sorted(variants.items()):
+            prompt_tokens = sum(count_tokens(tokenizer, prompt) for prompt in prompts)
+            row = {
+                'stage': stage,
+                'variant': variant,
+                'model': model_name,
+                'tokenizer': MODEL_TOKENIZERS[model_name] if tokenizer else 'estimativa',
+                'calls': len(prompts),
+                'prompt_tokens': prompt_tokens,
+                'instruction_tokens': sum(count_tokens(tokenizer, prompt) for prompt in instruction_variants[(stage, variant)]),
+                'cost_per_1k_calls_usd': round(prompt_tokens * MODEL_INPUT_PRICES[model_name] / 1000, 4),
+            }
+            if measure:
+                row.update(measure_latency(prompts, model_name, repeats))
+            rows.append(row)
+    return rows
+
+# Função para exibir os resultados em tabela
+def print_rows(rows: list):
+    if not rows:
+        return
+    columns = list(rows[0])
+    widths = {column: max(len(column), *(len(str(row.get(column, ""))) for row in rows)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row.get(column, "")).ljust(widths[column]) for column in columns))
+
+# Função para salvar os resultados de uma execução
+def save_results(rows: list, label: str) -> str:
+    os.makedirs(PROMPT_BENCHMARK_RESULTS_DIR, exist_ok=True)
+    path = os.path.join(PROMPT_BENCHMARK_RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}.json")
+    with open(path, 'w') as file:
+        json.dump(rows, file, ensure_ascii=False, indent=4)
+    return path
+
+# Função para exibir os resultados salvos, lado a lado por variante, etapa e modelo
+def compare_results():
+    for path in sorted(glob.glob(os.path.join(PROMPT_BENCHMARK_RESULTS_DIR, '*.json'))):
+        with open(path, 'r') as file:
+            rows = json.load(file)
+        print(f"\n{os.path.basename(path)}")
+        print_rows(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de eficiência de tokens das variantes (chinês, português e mista) dos prompts, por modelo.")
+    parser.add_argument('--models', default=','.join(MODEL_MAX_TOKENS), help="Modelos avaliados, separados por vírgula.")
+    parser.add_argument('--repeats', type=int, default=5, help="Repetições de cada chamada na medição de latência.")
+    parser.add_argument('--no-latency', action='store_true', help="Apenas conta os tokens, sem chamadas.")
+    parser.add_argument('--base-url', default=None, help="Servidor das chamadas de latência; por padrão, o servidor simulado do teste de carga.")
+    parser.add_argument('--label', default='prompts', help="Rótulo do arquivo de resultados.")
+    parser.add_argument('--compare', action='store_true', help="Apenas exibe os resultados salvos.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results()
+    else:
+        if not args.no_latency:
+            os.environ['GROQ_BASE_URL'] = args.base_url or start_mock_server()
+        rows = run_benchmark(args.models.split(','), args.repeats, not args.no_latency)
+        print_rows(rows)
+        print(f"\nResultados salvos em {save_results(rows, args.label)}")
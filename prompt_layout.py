@@ -0,0 +1,86 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from model_router import estimate_tokens
+
+# Tipos de segmento de um prompt, do mais estável (igual em todas as chamadas) ao mais volátil (único por chamada)
+SEGMENT_ORDER = ('instructions', 'expert', 'history', 'references', 'request', 'response', 'task')
+
+# Segmentos enviados na mensagem de sistema; os demais vão na mensagem do usuário
+SYSTEM_SEGMENTS = ('instructions', 'expert')
+
+# Mensagem de sistema base, sempre o primeiro segmento
+SYSTEM_PROMPT = "Você é um assistente útil."
+
+# Separador entre os segmentos de uma mesma mensagem
+SEGMENT_SEPARATOR = "\n\n"
+
+# Quantidade de prefixos lembrados por modelo para medir o reaproveitamento (os caches de prefixo são por modelo)
+PREFIX_CACHE_ENTRIES = 2000
+
+_lock = threading.Lock()
+_recent_prefixes = {}
+_prefix_stats = {}
+
+# Função para ordenar os segmentos (tipo, texto) do mais estável ao mais volátil, mantendo a ordem entre os do mesmo tipo;
+# um prompt em texto simples vira um único segmento de solicitação
+def layout_segments(prompt: Union[str, list]) -> list:
+    segments = [('request', prompt)] if isinstance(prompt, str) else prompt
+    ordered = sorted((segment for segment in segments if segment[1]), key=lambda segment: SEGMENT_ORDER.index(segment[0]))
+    return [('instructions', SYSTEM_PROMPT)] + ordered
+
+# Função para montar as mensagens de sistema e do usuário a partir dos segmentos já ordenados
+def layout_messages(segments: list) -> list:
+    return [
+        {"role": "system", "content": SEGMENT_SEPARATOR.join(text for kind, text in segments if kind in SYSTEM_SEGMENTS)},
+        {"role": "user", "content": SEGMENT_SEPARATOR.join(text for kind, text in segments if kind not in SYSTEM_SEGMENTS)},
+    ]
+
+# Função para obter o texto completo de um prompt, na ordem em que é enviado
+def prompt_text(prompt: Union[str, list]) -> str:
+    return prompt if isinstance(prompt, str) else SEGMENT_SEPARATOR.join(text for _, text in layout_segments(prompt)[1:])
+
+# Função para calcular o hash acumulado e os tokens de cada prefixo (segmento a segmento) de um prompt;
+# hashes iguais na posição i indicam que todos os segmentos até i são idênticos
+def prefix_chain(segments: list) -> list:
+    chain = []
+    digest = hashlib.sha256()
+    tokens = 0
+    for kind, text in segments:
+        role = 'system' if kind in SYSTEM_SEGMENTS else 'user'
+        digest.update(f"{role}\x1f{text}\x1e".encode('utf-8'))
+        tokens += estimate_tokens(text)
+        chain.append((digest.copy().hexdigest(), tokens))
+    return chain
+
+# Função para registrar o prompt de uma chamada e medir quantos tokens iniciais já apareceram em uma chamada anterior
+# ao mesmo modelo (o trecho que um cache de prefixo do provedor ou local poderia reaproveitar)
+def record_prefix(model_name: str, stage: str, segments: list) -> int:
+    chain = prefix_chain(segments)
+    with _lock:
+        prefixes = _recent_prefixes.setdefault(model_name, OrderedDict())
+        shared_tokens = 0
+        for prefix_hash, tokens in chain:
+            if prefix_hash not in prefixes:
+                break
+            shared_tokens = tokens
+        for prefix_hash, tokens in chain:
+            prefixes[prefix_hash] = tokens
+            prefixes.move_to_end(prefix_hash)
+        while len(prefixes) > PREFIX_CACHE_ENTRIES:
+            prefixes.popitem(last=False)
+        stats = _prefix_stats.setdefault(stage, {'calls': 0, 'prompt_tokens': 0, 'shared_prefix_tokens': 0})
+        stats['calls'] += 1
+        stats['prompt_tokens'] += chain[-1][1] if chain else 0
+        stats['shared_prefix_tokens'] += shared_tokens
+    return shared_tokens
+
+# Função para obter, por etapa, a proporção dos tokens de prompt que repetem o prefixo de uma chamada anterior
+def get_prefix_stats() -> dict:
+    with _lock:
+        stats = {stage: dict(values) for stage, values in _prefix_stats.items()}
+    for values in stats.values():
+        values['shared_prefix_ratio'] = round(values['shared_prefix_tokens'] / values['prompt_tokens'], 3) if values['prompt_tokens'] else 0.0
+    return stats
@@ -0,0 +1,230 @@
+import hashlib
+import os
+import re
+import time
+from collections import Counter
+from typing import Iterable
+
+from context_packer import STAGE_REFERENCE_BUDGET, cosine_similarity
+from model_router import estimate_tokens
+from partitioned_store import append_entry, iter_entries
+from reference_ingest import REFERENCE_TOP_K, tokenize_terms, retrieve_chunks
+from refine_delta import REFINE_STAGES, answer_similarity
+
+# Modos do filtro de qualidade aplicado antes do refinamento
+QUALITY_GATE_MODES = {
+    'off': "Desligado",
+    'recommend': "Apenas indicar quando o refinamento é dispensável",
+    'skip': "Pular o refinamento dispensável",
+}
+
+# Nota local mínima (0 a 1) para considerar a resposta completa; ajuste comparando com as avaliações registradas
+QUALITY_GATE_THRESHOLD = float(os.environ.get('QUALITY_GATE_THRESHOLD', 0.75))
+
+# Peso de cada sinal na nota; sinais indisponíveis (sem referências, por exemplo) ficam fora da média
+QUALITY_WEIGHTS = {
+    'coverage': 0.3,
+    'reference_overlap': 0.2,
+    'complete': 0.2,
+    'language': 0.15,
+    'structure': 0.15,
+}
+
+# Prefixo comparado entre os termos da pergunta e da resposta, para aceitar variações como plural e gênero
+TERM_STEM_LENGTH = 6
+
+# Similaridade de cosseno com os trechos recuperados a partir da qual a sobreposição com as referências conta como total
+REFERENCE_OVERLAP_TARGET = 0.3
+
+# Palavras funcionais do português, usadas para identificar o idioma da resposta
+PORTUGUESE_STOPWORDS = frozenset((
+    'de', 'a', 'o', 'que', 'e', 'do', 'da', 'em', 'um', 'para', 'é', 'com', 'não', 'uma', 'os', 'no', 'se', 'na', 'por',
+    'mais', 'as', 'dos', 'como', 'mas', 'ao', 'das', 'à', 'seu', 'sua', 'ou', 'quando', 'muito', 'nos', 'já', 'também',
+    'pelo', 'pela', 'até', 'isso', 'entre', 'sobre', 'são', 'pode', 'ser', 'está', 'essa', 'esse', 'este', 'esta',
+))
+
+# Verbos e palavras de pedido, que não precisam aparecer na resposta
+REQUEST_WORDS = frozenset((
+    'explique', 'explicar', 'descreva', 'descrever', 'defina', 'definir', 'liste', 'listar', 'compare', 'comparar',
+    'analise', 'analisar', 'resuma', 'resumir', 'diga', 'fale', 'mostre', 'qual', 'quais', 'quem', 'onde', 'porque',
+    'favor', 'gostaria', 'poderia', 'preciso', 'quero',
+))
+
+# Proporção de palavras funcionais do português a partir da qual o idioma conta como correto
+LANGUAGE_STOPWORD_RATIO = 0.2
+
+# Ideogramas e silabários (o prompt original em chinês às vezes vaza para a resposta)
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+
+# Finais de texto que indicam uma resposta encerrada, e não cortada pelo limite de tokens
+TERMINAL_ENDINGS = ('.', '!', '?', '…', ')', '"', '”', '»', ']', '*', '`', '|')
+
+# Marcadores de lista, tabela e título no início de uma linha
+STRUCTURE_MARKER_PATTERN = re.compile(r'^\s*(?:[-*•]|\d+[.)]|#+|\|)\s*', re.MULTILINE)
+
+# Parágrafos e tamanho (tokens) esperados de uma resposta completa
+STRUCTURE_PARAGRAPHS = 3
+TARGET_ANSWER_TOKENS = 300
+
+# Diretório das decisões do filtro e dos resultados de refinamentos e avaliações das mesmas respostas
+QUALITY_GATE_DIR = 'quality_gate'
+
+# Caracteres da avaliação guardados junto à decisão, para comparar a nota local com o resultado da avaliação
+EVALUATION_EXCERPT_CHARS = 500
+
+# Função para identificar uma resposta nos registros do filtro
+def answer_hash(answer: str) -> str:
+    return hashlib.sha256(answer.encode('utf-8')).hexdigest()[:16]
+
+# Função para reduzir os termos de um texto aos prefixos comparados
+def term_stems(text: str) -> set:
+    return {term[:TERM_STEM_LENGTH] for term in tokenize_terms(text) if term not in PORTUGUESE_STOPWORDS and term not in REQUEST_WORDS}
+
+# Função para medir a parte dos termos da pergunta que aparece na resposta; None quando a pergunta não tem termos
+def query_coverage(answer: str, query: str) -> float:
+    query_stems = term_stems(query)
+    if not query_stems:
+        return None
+    return len(query_stems & term_stems(answer)) / len(query_stems)
+
+# Função para medir a sobreposição da resposta com os trechos de referência mais próximos da pergunta;
+# None sem referências
+def reference_overlap(answer: str, query: str, references: list) -> float:
+    chunks = retrieve_chunks(references, query, REFERENCE_TOP_K) if references else []
+    if not chunks:
+        return None
+    similarity = cosine_similarity(Counter(tokenize_terms(answer)), Counter(tokenize_terms(" ".join(chunk['text'] for chunk in chunks))))
+    return min(1.0, similarity / REFERENCE_OVERLAP_TARGET)
+
+# Função para verificar se a resposta terminou: blocos de código fechados e o texto encerrado por pontuação,
+# ou por um item de lista ou linha de tabela
+def is_complete(answer: str) -> bool:
+    text = answer.strip()
+    if not text or text.count('```') % 2:
+        return False
+    last_line = text.splitlines()[-1]
+    return text.endswith(TERMINAL_ENDINGS) or bool(STRUCTURE_MARKER_PATTERN.match(last_line))
+
+# Função para medir se a resposta está em português: proporção de palavras funcionais, descontados os ideogramas
+def language_score(answer: str) -> float:
+    words = re.findall(r"[^\W\d_]+", answer.lower())
+    if not words:
+        return 0.0
+    stopword_ratio = sum(word in PORTUGUESE_STOPWORDS for word in words) / len(words)
+    characters = [character for character in answer if not character.isspace()]
+    cjk_ratio = sum(bool(CJK_PATTERN.match(character)) for character in characters) / len(characters)
+    return min(1.0, stopword_ratio / LANGUAGE_STOPWORD_RATIO) * (1.0 - cjk_ratio)
+
+# Função para medir a estrutura da resposta: parágrafos (ou itens de lista) e tamanho frente ao esperado
+def structure_score(answer: str) -> float:
+    paragraphs = len([paragraph for paragraph in re.split(r'\n\s*\n', answer) if paragraph.strip()])
+    blocks = max(paragraphs, len(STRUCTURE_MARKER_PATTERN.findall(answer)))
+    return 0.5 * min(1.0, blocks / STRUCTURE_PARAGRAPHS) + 0.5 * min(1.0, estimate_tokens(answer) / TARGET_ANSWER_TOKENS)
+
+# Função para dar uma nota local (0 a 1) à resposta da segunda fase, sem chamadas à API; uma resposta cortada
+# nunca passa, qualquer que seja a nota
+def check_answer(answer: str, user_input: str, user_prompt: str, references: list = None, threshold: float = QUALITY_GATE_THRESHOLD) -> dict:
+    query = f"{user_input} {user_prompt}"
+    signals = {
+        'coverage': query_coverage(answer, query),
+        'reference_overlap': reference_overlap(answer, query, references),
+        'complete': 1.0 if is_complete(answer) else 0.0,
+        'language': language_score(answer),
+        'structure': structure_score(answer),
+    }
+    available = {name: value for name, value in signals.items() if value is not None}
+    total_weight = sum(QUALITY_WEIGHTS[name] for name in available)
+    score = sum(QUALITY_WEIGHTS[name] * value for name, value in available.items()) / total_weight
+    return {
+        'score': round(score, 3),
+        'signals': {name: None if value is None else round(value, 3) for name, value in signals.items()},
+        'threshold': threshold,
+        'passed': score >= threshold and signals['complete'] == 1.0,
+    }
+
+# Função para estimar os tokens de um refinamento (prompt com resposta, pergunta, histórico e referências, e a
+# resposta reescrita na saída)
+def estimate_refine_tokens(answer: str, user_input: str, user_prompt: str, references: list = None, chat_history: list = None) -> int:
+    history_tokens = sum(estimate_tokens(" ".join(str(value) for value in entry.values())) for entry in chat_history or [])
+    reference_tokens = min(STAGE_REFERENCE_BUDGET['refine'], sum(estimate_tokens(reference['text']) for reference in references or []))
+    return 2 * estimate_tokens(answer) + estimate_tokens(f"{user_input} {user_prompt}") + history_tokens + reference_tokens
+
+# Função para decidir se o refinamento de uma resposta pode ser pulado: no modo 'skip', uma resposta aprovada não é
+# refinada, a menos que override peça o refinamento; no modo 'recommend', a decisão só é indicada. A decisão é
+# registrada com as chamadas e os tokens evitados
+def gate_refine(answer: str, user_input: str, user_prompt: str, references: list = None, chat_history: list = None, mode: str = 'skip', override: bool = False, threshold: float = QUALITY_GATE_THRESHOLD) -> dict:
+    if mode not in QUALITY_GATE_MODES:
+        raise ValueError(f"Modo do filtro de qualidade desconhecido: {mode}. Use um de {', '.join(QUALITY_GATE_MODES)}.")
+    if mode == 'off':
+        return {'skip': False, 'passed': False, 'score': None}
+    check = check_answer(answer, user_input, user_prompt, references, threshold)
+    check['skip'] = mode == 'skip' and check['passed'] and not override
+    estimated_tokens = estimate_refine_tokens(answer, user_input, user_prompt, references, chat_history)
+    append_entry(QUALITY_GATE_DIR, {
+        'event': 'gate',
+        'timestamp': time.time(),
+        'answer_hash': answer_hash(answer),
+        'mode': mode,
+        'override': override,
+        'score': check['score'],
+        'signals': check['signals'],
+        'threshold': threshold,
+        'passed': check['passed'],
+        'decision': 'skipped' if check['skip'] else 'refined',
+        'avoided_calls': 1 if check['skip'] else 0,
+        'avoided_tokens': estimated_tokens if check['skip'] else 0,
+        'estimated_refine_tokens': estimated_tokens,
+    })
+    return check
+
+# Função para registrar quanto o refinamento mudou uma resposta que passou pelo filtro
+def record_refine_result(answer: str, refined: str):
+    append_entry(QUALITY_GATE_DIR, {'event': 'refine', 'timestamp': time.time(), 'answer_hash': answer_hash(answer), 'similarity': round(answer_similarity(answer, refined), 3)})
+
+# Função para registrar a avaliação de uma resposta que passou pelo filtro
+def record_evaluation(answer: str, evaluation: str):
+    append_entry(QUALITY_GATE_DIR, {'event': 'evaluation', 'timestamp': time.time(), 'answer_hash': answer_hash(answer), 'evaluation': evaluation[:EVALUATION_EXCERPT_CHARS]})
+
+# Função para juntar, por resposta, a decisão do filtro, a semelhança do refinamento e o trecho da avaliação,
+# da mais recente para a mais antiga; é a base para ajustar o limiar
+def get_gate_report(limit: int = 50) -> list:
+    rows = {}
+    for entry in iter_entries(QUALITY_GATE_DIR):
+        row = rows.setdefault(entry['answer_hash'], {'answer_hash': entry['answer_hash']})
+        if entry['event'] == 'gate':
+            row.update({name: entry[name] for name in ('timestamp', 'mode', 'score', 'passed', 'decision', 'override', 'avoided_tokens')})
+            row.update(entry['signals'])
+        elif entry['event'] == 'refine':
+            row['refine_similarity'] = entry['similarity']
+        else:
+            row['evaluation'] = entry['evaluation']
+    gated = sorted((row for row in rows.values() if 'decision' in row), key=lambda row: row['timestamp'], reverse=True)
+    return gated[:limit]
+
+# Função para resumir o filtro: decisões, chamadas e tokens evitados (estimados e pela média dos refinamentos
+# registrados no uso da API) e a semelhança média do refinamento para respostas aprovadas e reprovadas
+def get_gate_stats(usage_entries: Iterable) -> dict:
+    stats = {'decisions': 0, 'passed': 0, 'skipped': 0, 'avoided_calls': 0, 'avoided_tokens_estimated': 0}
+    similarities = {True: [], False: []}
+    passed_hashes = {}
+    for entry in iter_entries(QUALITY_GATE_DIR):
+        if entry['event'] == 'gate':
+            stats['decisions'] += 1
+            stats['passed'] += entry['passed']
+            stats['skipped'] += entry['decision'] == 'skipped'
+            stats['avoided_calls'] += entry['avoided_calls']
+            stats['avoided_tokens_estimated'] += entry['avoided_tokens']
+            passed_hashes[entry['answer_hash']] = entry['passed']
+        elif entry['event'] == 'refine' and entry['answer_hash'] in passed_hashes:
+            similarities[passed_hashes[entry['answer_hash']]].append(entry['similarity'])
+    # O registro de uso só é lido quando houve refinamento evitado, e só os refinamentos concluídos entram na média
+    # (pela etapa; entradas antigas sem etapa usam a ação)
+    refine_tokens = []
+    if stats['avoided_calls']:
+        refine_stages = set(REFINE_STAGES.values())
+        refine_tokens = [entry.get('tokens_used', 0) for entry in usage_entries if entry.get('stage', entry.get('action')) in refine_stages and entry.get('status', 'ok') == 'ok']
+    mean_refine_tokens = sum(refine_tokens) / len(refine_tokens) if refine_tokens else 0
+    stats['avoided_tokens_measured'] = round(stats['avoided_calls'] * mean_refine_tokens)
+    stats['refine_similarity_passed'] = round(sum(similarities[True]) / len(similarities[True]), 3) if similarities[True] else None
+    stats['refine_similarity_failed'] = round(sum(similarities[False]) / len(similarities[False]), 3) if similarities[False] else None
+    return stats
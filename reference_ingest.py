@@ -0,0 +1,286 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable
+
+from json_stream import JSON_STREAM_BLOCK_SIZE, iter_json_records
+
+# Diretório onde os trechos extraídos de cada arquivo são guardados, endereçados pelo hash do conteúdo
+REFERENCE_CACHE_DIR = 'reference_cache'
+
+# Quantidade de processos que extraem o texto das referências (configurável por variável de ambiente)
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 2))
+
+# Tamanho (caracteres) de cada trecho e sobreposição entre trechos vizinhos
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 200
+
+# Quantidade de trechos mais relevantes recuperados para o prompt
+REFERENCE_TOP_K = 4
+
+# Extensões aceitas no upload de referências
+REFERENCE_TYPES = ["pdf", "html", "htm", "json"]
+
+_lock = threading.Lock()
+_pool = None
+
+# Leitores de PDF abertos em cada processo de extração, para não reinterpretar o arquivo a cada página
+_pdf_readers = {}
+
+# Função para obter o pool de processos de extração, criado uma única vez por processo
+def get_ingest_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return _pool
+
+# Função para normalizar o texto extraído: unifica caracteres, junta palavras hifenizadas e espaços
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text)
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+# Função para dividir o texto em trechos com sobreposição, respeitando o limite das palavras
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list:
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start, end)
+            if space > start:
+                end = space
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Recomeça no início de uma palavra
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+    return [chunk for chunk in chunks if chunk]
+
+# Função para obter o caminho onde o arquivo enviado fica salvo enquanto os processos de extração o leem
+def source_path(content_hash: str, extension: str, cache_dir=REFERENCE_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f"{content_hash}.source.{extension}")
+
+# Função para calcular o hash e o tamanho de uma referência; data são bytes ou um arquivo binário, lido em blocos
+def hash_reference(data) -> tuple:
+    if isinstance(data, (bytes, bytearray)):
+        return hashlib.sha256(data).hexdigest(), len(data)
+    digest = hashlib.sha256()
+    size = 0
+    data.seek(0)
+    for block in iter(lambda: data.read(JSON_STREAM_BLOCK_SIZE), b""):
+        digest.update(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+# Função para salvar a referência no cache, em blocos, para que os processos de extração leiam do disco em vez de
+# receberem o arquivo inteiro
+def save_reference_source(data, path: str):
+    if os.path.exists(path):
+        return
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as file:
+        if isinstance(data, (bytes, bytearray)):
+            file.write(data)
+        else:
+            data.seek(0)
+            shutil.copyfileobj(data, file, JSON_STREAM_BLOCK_SIZE)
+    os.replace(temp_path, path)
+
+# Tarefa executada no pool: extrai o texto de uma página de um PDF salvo no cache
+def extract_pdf_page(path: str, page_number: int) -> str:
+    from PyPDF2 import PdfReader
+    if path not in _pdf_readers:
+        _pdf_readers.clear()
+        _pdf_readers[path] = PdfReader(path)
+    return _pdf_readers[path].pages[page_number].extract_text() or ""
+
+# Tarefa executada no pool: extrai o texto visível de uma página HTML salva no cache
+def extract_html_text(path: str) -> str:
+    from bs4 import BeautifulSoup
+    with open(path, 'rb') as file:
+        soup = BeautifulSoup(file, 'html.parser')
+    for element in soup(['script', 'style', 'noscript']):
+        element.decompose()
+    return soup.get_text(" ")
+
+# Tarefa executada no pool: extrai os textos de um arquivo JSON de referências salvo no cache, lido registro a registro
+# (elementos da lista ou valores do objeto no nível superior) para que o arquivo nunca fique inteiro em memória
+def extract_json_text(path: str) -> str:
+    texts = []
+
+    def collect(value):
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+
+    for record in iter_json_records(path):
+        collect(record[1] if isinstance(record, tuple) else record)
+    return "\n".join(texts)
+
+# Função para obter o caminho do cache dos trechos de um arquivo
+def cache_path(content_hash: str, cache_dir=REFERENCE_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f"{content_hash}.json")
+
+# Função para ler os trechos de um arquivo já extraído
+def load_cached_chunks(content_hash: str, cache_dir=REFERENCE_CACHE_DIR):
+    path = cache_path(content_hash, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return json.load(file)
+
+# Função para gravar os trechos de um arquivo no cache
+def save_cached_chunks(content_hash: str, chunks: list, cache_dir=REFERENCE_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(content_hash, cache_dir)
+    # Grava em arquivo temporário e renomeia, para que outras sessões nunca leiam um cache incompleto
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(chunks, file, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+# Função para extrair, normalizar e dividir em trechos um conjunto de referências.
+# files é uma lista de pares (nome, bytes ou arquivo binário); o arquivo é salvo no cache em blocos e cada página
+# de PDF ou arquivo HTML/JSON vira uma tarefa do pool, que lê do disco. As tarefas de todos os arquivos são
+# enviadas juntas, então arquivos diferentes são extraídos em paralelo.
+# on_progress(concluídas, total, nome) é chamada a cada tarefa terminada. Qualquer falha ao ler um arquivo vira um
+# ValueError com o nome dele.
+def ingest_references(files: list, on_progress: Callable = None, cache_dir=REFERENCE_CACHE_DIR) -> dict:
+    # Trechos de cada arquivo na posição em que foi enviado, vindos do cache ou da extração
+    file_chunks = [None] * len(files)
+    metrics = []
+    pending = []
+    for position, (name, data) in enumerate(files):
+        start_time = time.time()
+        content_hash, size = hash_reference(data)
+        cached = load_cached_chunks(content_hash, cache_dir)
+        if cached is not None:
+            file_chunks[position] = cached
+            metrics.append({'file': name, 'cached': True, 'pages': len({chunk['page'] for chunk in cached}), 'chunks': len(cached), 'bytes': size, 'seconds': time.time() - start_time})
+        else:
+            pending.append((position, name, data, content_hash, size))
+
+    # Tarefas de cada arquivo a extrair, para o progresso e as métricas
+    tasks = []
+    # Arquivos iguais enviados juntos compartilham o arquivo salvo, removido após a última extração
+    path_uses = Counter()
+    futures = {}
+    start_time = time.time()
+    try:
+        for position, name, data, content_hash, size in pending:
+            extension = os.path.splitext(name)[1].lower().lstrip('.')
+            if extension not in REFERENCE_TYPES:
+                raise ValueError(f"Tipo de referência não suportado: {name}")
+            os.makedirs(cache_dir, exist_ok=True)
+            path = source_path(content_hash, extension, cache_dir)
+            save_reference_source(data, path)
+            path_uses[path] += 1
+            if extension == 'pdf':
+                from PyPDF2 import PdfReader
+                try:
+                    page_count = len(PdfReader(path).pages)
+                except Exception as e:
+                    raise ValueError(f"Não foi possível ler a referência {name}: {e}") from e
+                tasks.append((position, name, path, content_hash, size, [(extract_pdf_page, (path, page)) for page in range(page_count)]))
+            elif extension in ('html', 'htm'):
+                tasks.append((position, name, path, content_hash, size, [(extract_html_text, (path,))]))
+            else:
+                tasks.append((position, name, path, content_hash, size, [(extract_json_text, (path,))]))
+
+        total = sum(len(file_tasks) for *_, file_tasks in tasks)
+        pool = get_ingest_pool()
+        for index, (*_, file_tasks) in enumerate(tasks):
+            for page, (function, args) in enumerate(file_tasks):
+                futures[pool.submit(function, *args)] = (index, page)
+
+        # As páginas chegam de todos os arquivos misturadas; cada arquivo é fechado quando a sua última página chega
+        pages = [{} for _ in tasks]
+        completed = 0
+        for future in as_completed(futures):
+            index, page = futures[future]
+            position, name, path, content_hash, size, file_tasks = tasks[index]
+            try:
+                pages[index][page] = future.result()
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Referência {name} com JSON inválido: {e}") from e
+            except Exception as e:
+                # PDF corrompido, HTML ilegível ou o pool de extração interrompido: o erro informa o arquivo
+                raise ValueError(f"Não foi possível ler a referência {name}: {e}") from e
+            completed += 1
+            if on_progress:
+                on_progress(completed, total, name)
+            if len(pages[index]) < len(file_tasks):
+                continue
+
+            # O arquivo salvo só serve à extração; o que fica no cache são os trechos
+            path_uses[path] -= 1
+            if not path_uses[path] and os.path.exists(path):
+                os.remove(path)
+            file_chunks[position] = []
+            for page_number in sorted(pages[index]):
+                for text in chunk_text(normalize_text(pages[index][page_number])):
+                    file_chunks[position].append({'source': name, 'page': page_number + 1, 'text': text})
+            save_cached_chunks(content_hash, file_chunks[position], cache_dir)
+
+            # Os arquivos são extraídos juntos, então o tempo de cada um conta desde o início da extração
+            seconds = time.time() - start_time
+            metrics.append({
+                'file': name,
+                'cached': False,
+                'pages': len(file_tasks),
+                'chunks': len(file_chunks[position]),
+                'bytes': size,
+                'seconds': seconds,
+                'pages_per_second': len(file_tasks) / seconds if seconds > 0 else 0.0,
+                'mb_per_second': size / 1e6 / seconds if seconds > 0 else 0.0,
+            })
+    finally:
+        # Em caso de erro, as tarefas que ainda não começaram são descartadas e nenhum arquivo salvo fica para trás
+        for future in futures:
+            future.cancel()
+        for path, uses in path_uses.items():
+            if uses and os.path.exists(path):
+                os.remove(path)
+
+    # Os trechos seguem a ordem dos arquivos enviados, estejam eles no cache ou não
+    chunks = [chunk for extracted in file_chunks for chunk in extracted]
+    return {'chunks': chunks, 'metrics': metrics}
+
+# Função para separar um texto em termos para a recuperação
+def tokenize_terms(text: str) -> list:
+    return re.findall(r"\w{3,}", text.lower())
+
+# Função para recuperar os trechos mais relevantes para a consulta (similaridade de cosseno com pesos TF-IDF)
+def retrieve_chunks(chunks: list, query: str, top_k: int = REFERENCE_TOP_K) -> list:
+    if not chunks:
+        return []
+    chunk_terms = [Counter(tokenize_terms(chunk['text'])) for chunk in chunks]
+    document_frequency = Counter(term for terms in chunk_terms for term in terms)
+    idf = {term: math.log((1 + len(chunks)) / (1 + count)) + 1 for term, count in document_frequency.items()}
+    query_terms = Counter(tokenize_terms(query))
+
+    def score(terms: Counter) -> float:
+        dot = sum(count * terms.get(term, 0) * idf.get(term, 0) ** 2 for term, count in query_terms.items())
+        norm = math.sqrt(sum((count * idf[term]) ** 2 for term, count in terms.items())) or 1.0
+        return dot / norm
+
+    ranked = sorted(range(len(chunks)), key=lambda index: score(chunk_terms[index]), reverse=True)
+    return [chunks[index] for index in ranked[:top_k]]
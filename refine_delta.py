@@ -0,0 +1,136 @@
+import json
+import re
+import threading
+from difflib import SequenceMatcher
+from typing import Iterable
+
+from model_router import percentile
+
+# Modos de refinamento: reescrever a resposta inteira ou pedir apenas edições por parágrafo
+REFINE_MODES = {
+    'full': "Reescrever a resposta inteira",
+    'delta': "Aplicar edições por parágrafo",
+}
+
+# Operações de edição aceitas na resposta do modelo
+EDIT_OPERATIONS = ('replace', 'insert', 'delete')
+
+# Instruções do formato das edições, anexadas ao prompt do modo 'delta'
+DELTA_INSTRUCTIONS = (
+    "Não reescreva a resposta inteira. Responda somente com um JSON no formato "
+    '{"edits": [{"op": "replace", "id": 2, "text": "novo parágrafo"}, {"op": "insert", "id": 3, "text": "parágrafo inserido após o 3"}, {"op": "delete", "id": 5}]}, '
+    "usando os números [P..] dos parágrafos acima (\"insert\" com id 0 insere no início). "
+    "Inclua apenas os parágrafos que precisam mudar; se nada precisar mudar, responda {\"edits\": []}."
+)
+
+# Etapas do registro de uso comparadas entre os dois modos
+REFINE_STAGES = {'full': 'refine', 'delta': 'refine_delta'}
+
+_lock = threading.Lock()
+_delta_stats = {
+    'calls': 0,
+    'applied': 0,
+    'fallbacks': 0,
+    'edits': 0,
+    'paragraphs_changed': 0,
+    'paragraphs_total': 0,
+}
+
+# Função para dividir uma resposta em parágrafos (blocos separados por linha em branco)
+def split_paragraphs(text: str) -> list:
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n", text.strip()) if paragraph.strip()]
+
+# Função para medir a semelhança entre duas respostas pela proporção de parágrafos preservados
+def answer_similarity(draft: str, refined: str) -> float:
+    return SequenceMatcher(None, split_paragraphs(draft), split_paragraphs(refined)).ratio()
+
+# Função para numerar os parágrafos para o prompt, de 1 em diante
+def number_paragraphs(paragraphs: list) -> str:
+    return "\n\n".join(f"[P{index}] {paragraph}" for index, paragraph in enumerate(paragraphs, start=1))
+
+# Função para ler as edições da resposta do modelo; levanta ValueError quando o formato não é válido
+def parse_edits(response: str) -> list:
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("A resposta não contém um objeto JSON de edições.")
+    try:
+        payload = json.loads(response[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON de edições inválido: {e}")
+    edits = payload.get('edits') if isinstance(payload, dict) else None
+    if not isinstance(edits, list):
+        raise ValueError("O campo 'edits' deve ser uma lista.")
+    for edit in edits:
+        # bool é subclasse de int em Python, mas true/false no JSON não são números de parágrafo
+        if not isinstance(edit, dict) or edit.get('op') not in EDIT_OPERATIONS or not isinstance(edit.get('id'), int) or isinstance(edit.get('id'), bool):
+            raise ValueError(f"Edição inválida: {edit}")
+        if edit['op'] != 'delete' and not isinstance(edit.get('text'), str):
+            raise ValueError(f"Edição sem texto: {edit}")
+    return edits
+
+# Função para aplicar as edições aos parágrafos originais; os ids sempre se referem à numeração original
+def apply_edits(paragraphs: list, edits: list) -> str:
+    replaced = {}
+    deleted = set()
+    inserted = {}
+    for edit in edits:
+        paragraph_id = edit['id']
+        lowest_id = 0 if edit['op'] == 'insert' else 1
+        if not lowest_id <= paragraph_id <= len(paragraphs):
+            raise ValueError(f"Parágrafo inexistente na edição: {edit}")
+        if edit['op'] == 'insert':
+            inserted.setdefault(paragraph_id, []).append(edit['text'].strip())
+            continue
+        if paragraph_id in replaced or paragraph_id in deleted:
+            raise ValueError(f"Parágrafo {paragraph_id} editado mais de uma vez.")
+        if edit['op'] == 'replace':
+            replaced[paragraph_id] = edit['text'].strip()
+        else:
+            deleted.add(paragraph_id)
+    result = list(inserted.get(0, []))
+    for paragraph_id, paragraph in enumerate(paragraphs, start=1):
+        if paragraph_id not in deleted:
+            result.append(replaced.get(paragraph_id, paragraph))
+        result.extend(inserted.get(paragraph_id, []))
+    return "\n\n".join(paragraph for paragraph in result if paragraph)
+
+# Função para registrar o resultado de um refinamento por edições (aplicado ou substituído pela reescrita completa)
+def record_delta_result(paragraphs_total: int, edits: list = None):
+    with _lock:
+        _delta_stats['calls'] += 1
+        _delta_stats['paragraphs_total'] += paragraphs_total
+        if edits is None:
+            _delta_stats['fallbacks'] += 1
+            return
+        _delta_stats['applied'] += 1
+        _delta_stats['edits'] += len(edits)
+        _delta_stats['paragraphs_changed'] += len({edit['id'] for edit in edits if edit['op'] != 'insert'})
+
+# Função para obter as estatísticas do refinamento por edições
+def get_delta_stats() -> dict:
+    with _lock:
+        stats = dict(_delta_stats)
+    stats['fallback_rate'] = stats['fallbacks'] / stats['calls'] if stats['calls'] else 0.0
+    return stats
+
+# Função para comparar os dois modos pelo registro de uso: tokens de saída e latência das chamadas concluídas
+def get_refine_comparison(usage_entries: Iterable) -> dict:
+    # Uma única passada, para aceitar o registro percorrido entrada a entrada
+    stage_entries = {stage: [] for stage in REFINE_STAGES.values()}
+    for entry in usage_entries:
+        if entry.get('stage') in stage_entries and entry.get('status', 'ok') == 'ok':
+            stage_entries[entry['stage']].append({'completion_tokens': entry.get('completion_tokens'), 'time_taken': entry['time_taken']})
+    comparison = {}
+    for mode, stage in REFINE_STAGES.items():
+        entries = stage_entries[stage]
+        if not entries:
+            continue
+        completion_tokens = [entry['completion_tokens'] for entry in entries if entry.get('completion_tokens') is not None]
+        times = [entry['time_taken'] for entry in entries]
+        comparison[REFINE_MODES[mode]] = {
+            'calls': len(entries),
+            'mean_completion_tokens': round(sum(completion_tokens) / len(completion_tokens), 1) if completion_tokens else None,
+            'mean_time_taken': round(sum(times) / len(times), 2),
+            'p95_time_taken': round(percentile(times, 0.95), 2),
+        }
+    return comparison
@@ -1,13 +1,37 @@
 import json
-import os
-import time
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import streamlit as st
-from typing import Tuple
-from groq import Groq
 import base64
+import hashlib
+from pipeline import MODEL_MAX_TOKENS, load_agents, get_key_cooldowns, load_api_usage, iter_api_usage, get_interaction_number, load_chat_history, save_chat_history, clear_chat_history, clear_api_usage, start_storage_maintenance, fetch_assistant_response, refine_response, evaluate_response_with_rag
+from model_router import AUTO_MODEL, ensure_latency_table, load_routing_log, clear_routing_log, get_latency_table, load_latency_table
+from hedging import get_hedge_stats
+from singleflight import get_single_flight_stats
+from reference_ingest import REFERENCE_TYPES, ingest_references
+from context_packer import get_packing_log
+from latency_metrics import METRICS_WINDOWS, get_metrics_table, clear_metrics
+from adaptive_limiter import get_limiter_state
+from semantic_cache import SEMANTIC_CACHE_MODES
+from output_predictor import get_predictor_stats
+from refine_delta import REFINE_MODES, get_delta_stats, get_refine_comparison
+from evaluation_sections import get_evaluation_log
+from full_pipeline import run_full_pipeline, get_pipeline_log
+from expert_fanout import EXPERT_FAN_OUT_SIZE, MIN_EXPERT_FAN_OUT, MAX_EXPERT_FAN_OUT, compare_experts, get_fan_out_log
+from prompt_layout import get_prefix_stats
+from quality_gate import QUALITY_GATE_MODES, check_answer, gate_refine, record_refine_result, record_evaluation, get_gate_stats, get_gate_report
+from shared_state import STATE_BACKEND
+from job_queue import submit_job, get_job, is_job_active, get_queue_metrics
+
+# Intervalo (s) de atualização da tela enquanto houver tarefas em segundo plano
+JOB_POLL_INTERVAL = 2
+
+# Interações do histórico exibidas por página
+HISTORY_PAGE_SIZE = 5
+
+# Caracteres da resposta exibidos enquanto a interação está recolhida
+HISTORY_PREVIEW_CHARS = 300
 
 # Configurações da página do Streamlit
 st.set_page_config(
@@ -17,119 +41,42 @@ st.set_page_config(
     
 )
 
-# Definição de caminhos para arquivos
-FILEPATH = "agents.json"
-CHAT_HISTORY_FILE = 'chat_history.json'
-API_USAGE_FILE = 'api_usage.json'
-
-# Definição de modelos e tokens
-MODEL_MAX_TOKENS = {
-    'mixtral-8x7b-32768': 32768,
-    'llama3-70b-8192': 8192,
-    'llama3-8b-8192': 8192,
-    'gemma-7b-it': 8192,
-}
-
-# Chaves da API
-API_KEYS = {
-    "fetch": ["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", "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"],
-    "refine": ["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", "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"],
-    "evaluate": ["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", "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"]
-}
-
-# Função para obter a próxima chave de API disponível
-def get_api_key(action: str) -> str:
-    keys = API_KEYS[action]
-    return keys.pop(0)
+# Função para gerar o identificador de uma interação do histórico a partir do seu conteúdo
+def history_entry_hash(entry: dict) -> str:
+    return hashlib.sha256(json.dumps(entry, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# Função para montar o markdown de uma interação, recolhida (prévia da resposta) ou completa
+def render_history_entry(user_input: str, user_prompt: str, expert_response: str, expanded: bool) -> str:
+    response = expert_response
+    if not expanded and len(response) > HISTORY_PREVIEW_CHARS:
+        response = response[:HISTORY_PREVIEW_CHARS] + "…"
+    return f"**Entrada do Usuário:** {user_input}\n\n**Prompt do Usuário:** {user_prompt}\n\n**Resposta do Especialista:** {response}"
+
+# Função para exibir uma página do histórico, da interação mais recente para a mais antiga;
+# apenas a página atual é enviada ao navegador, e cada resposta completa só é exibida quando pedida
+def show_chat_history(chat_history: list):
+    page_count = max(1, -(-len(chat_history) // HISTORY_PAGE_SIZE))
+    page = st.number_input(f"Página do histórico (de {page_count})", min_value=1, max_value=page_count, value=1, step=1, key="pagina_historico") if page_count > 1 else 1
+    newest_first = range(len(chat_history) - 1, -1, -1)
+    for index in newest_first[(page - 1) * HISTORY_PAGE_SIZE:page * HISTORY_PAGE_SIZE]:
+        entry = chat_history[index]
+        expanded = False
+        if len(entry['expert_response']) > HISTORY_PREVIEW_CHARS:
+            # A posição no histórico entra na chave, pois interações iguais (mesmo conteúdo) podem se repetir
+            expanded = st.toggle("Mostrar resposta completa", key=f"historico_{index}_{history_entry_hash(entry)[:16]}")
+        st.markdown(render_history_entry(entry['user_input'], entry['user_prompt'], entry['expert_response'], expanded))
+        st.markdown("---")
 
 # Função para carregar opções de agentes
 def load_agent_options() -> list:
     agent_options = ['Escolher um especialista...']
-    if os.path.exists(FILEPATH):
-        with open(FILEPATH, 'r') as file:
-            try:
-                agents = json.load(file)
-                agent_options.extend([agent["agente"] for agent in agents if "agente" in agent])
-            except json.JSONDecodeError:
-                st.error("Erro ao ler o arquivo de Agentes. Por favor, verifique o formato.")
+    try:
+        agents = load_agents()
+        agent_options.extend([agent["agente"] for agent in agents if "agente" in agent])
+    except json.JSONDecodeError as e:
+        st.error(f"Erro ao ler o arquivo de Agentes ({e}). Por favor, verifique o formato.")
     return agent_options
 
-# Função para obter o número máximo de tokens de um modelo
-def get_max_tokens(model_name: str) -> int:
-    return MODEL_MAX_TOKENS.get(model_name, 4096)
-
-# Função para registrar o uso da API
-def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_taken: float, user_input: str, user_prompt: str, api_response: str, agent_used: str, agent_description: str):
-    entry = {
-        'action': action,
-        'interaction_number': interaction_number,
-        'tokens_used': tokens_used,
-        'time_taken': time_taken,
-        'user_input': user_input,
-        'user_prompt': user_prompt,
-        'api_response': api_response,
-        'agent_used': agent_used,
-        'agent_description': agent_description
-    }
-    if os.path.exists(API_USAGE_FILE):
-        with open(API_USAGE_FILE, 'r+') as file:
-            api_usage = json.load(file)
-            api_usage.append(entry)
-            file.seek(0)
-            json.dump(api_usage, file, indent=4)
-    else:
-        with open(API_USAGE_FILE, 'w') as file:
-            json.dump([entry], file, indent=4)
-
-# Função para lidar com limite de taxa
-def handle_rate_limit(error_message: str, action: str):
-    if 'rate_limit_exceeded' in error_message:
-        wait_time = float(error_message.split("try again in")[1].split("s.")[0].strip())
-        st.warning(f"Limite de taxa atingido. Aguardando {wait_time} segundos...")
-        time.sleep(wait_time)
-        # Alterna para a próxima chave de API disponível
-        API_KEYS[action].append(API_KEYS[action].pop(0))
-    else:
-        raise Exception(error_message)
-
-# Função para salvar o histórico de chat
-def save_chat_history(user_input, user_prompt, expert_response, chat_history_file=CHAT_HISTORY_FILE):
-    chat_entry = {
-        'user_input': user_input,
-        'user_prompt': user_prompt,
-        'expert_response': expert_response
-    }
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r+') as file:
-            chat_history = json.load(file)
-            chat_history.append(chat_entry)
-            file.seek(0)
-            json.dump(chat_history, file, indent=4)
-    else:
-        with open(chat_history_file, 'w') as file:
-            json.dump([chat_entry], file, indent=4)
-
-# Função para carregar o histórico de chat
-def load_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r') as file:
-            chat_history = json.load(file)
-        return chat_history
-    return []
-
-# Função para limpar o histórico de chat
-def clear_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        os.remove(chat_history_file)
-
-# Função para carregar o uso da API
-def load_api_usage():
-    if os.path.exists(API_USAGE_FILE):
-        with open(API_USAGE_FILE, 'r') as file:
-            api_usage = json.load(file)
-        return api_usage
-    return []
-
 # Função para plotar o uso da API
 def plot_api_usage(api_usage):
     df = pd.DataFrame(api_usage)
@@ -138,6 +85,10 @@ def plot_api_usage(api_usage):
         st.error("A coluna 'action' não foi encontrada no dataframe de uso da API.")
         return
 
+    # Chamadas com erro não têm tokens nem tempo de resposta válidos
+    if 'status' in df.columns:
+        df = df[df['status'].fillna('ok') == 'ok']
+
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8))
 
     sns.histplot(df[df['action'] == 'fetch']['tokens_used'], bins=20, color='blue', label='Fetch', ax=ax1, kde=True)
@@ -164,208 +115,14 @@ def plot_api_usage(api_usage):
 
 # Função para resetar o uso da API
 def reset_api_usage():
-    if os.path.exists(API_USAGE_FILE):
-        os.remove(API_USAGE_FILE)
+    clear_api_usage()
+    clear_routing_log()
+    load_latency_table([])
+    clear_metrics()
     st.success("Os dados de uso da API foram resetados.")
 
-# Função para buscar resposta do assistente
-def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str, temperature: float, agent_selection: str, chat_history: list, interaction_number: int) -> Tuple[str, str]:
-    phase_two_response = ""
-    expert_title = ""
-    expert_description = ""
-    try:
-        client = Groq(api_key=get_api_key('fetch'))
-
-        def get_completion(prompt: str) -> str:
-            start_time = time.time()
-            while True:
-                try:
-                    completion = client.chat.completions.create(
-                        messages=[
-                            {"role": "system", "content": "Você é um assistente útil."},
-                            {"role": "user", "content": prompt},
-                        ],
-                        model=model_name,
-                        temperature=temperature,
-                        max_tokens=get_max_tokens(model_name),
-                        top_p=1,
-                        stop=None,
-                        stream=False
-                    )
-                    end_time = time.time()
-                    tokens_used = completion.usage.total_tokens
-                    time_taken = end_time - start_time
-                    api_response = completion.choices[0].message.content
-                    log_api_usage('fetch', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description)
-                    return api_response
-                except Exception as e:
-                    handle_rate_limit(str(e), 'fetch')
-
-        if agent_selection == "Escolher um especialista...":
-            phase_one_prompt = (
-                f"Descreva o especialista ideal para responder a seguinte solicitação: {user_input} e {user_prompt}."
-            )
-            phase_one_response = get_completion(phase_one_prompt)
-            first_period_index = phase_one_response.find(".")
-            expert_title = phase_one_response[:first_period_index].strip()
-            expert_description = phase_one_response[first_period_index + 1:].strip()
-            save_expert(expert_title, expert_description)
-        else:
-            with open(FILEPATH, 'r') as file:
-                agents = json.load(file)
-                agent_found = next((agent for agent in agents if agent["agente"] == agent_selection), None)
-                if agent_found:
-                    expert_title = agent_found["agente"]
-                    expert_description = agent_found["descricao"]
-                else:
-                    raise ValueError("Especialista selecionado não encontrado no arquivo.")
-
-        history_context = ""
-        for entry in chat_history:
-            history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
-
-        phase_two_prompt = (
-            f"{expert_title}, responda a seguinte solicitação de forma completa e detalhada: {user_input} e {user_prompt}."
-            f"\n\nHistórico do chat:{history_context}"
-        )
-        phase_two_response = get_completion(phase_two_prompt)
-
-    except Exception as e:
-        st.error(f"Ocorreu um erro: {e}")
-        return "", ""
-
-    return expert_title, phase_two_response
-
-# Função para refinar resposta
-def refine_response(expert_title: str, phase_two_response: str, user_input: str, user_prompt: str, model_name: str, temperature: float, references_file: str, chat_history: list, interaction_number: int) -> str:
-    try:
-        client = Groq(api_key=get_api_key('refine'))
-
-        def get_completion(prompt: str) -> str:
-            start_time = time.time()
-            while True:
-                try:
-                    completion = client.chat.completions.create(
-                        messages=[
-                            {"role": "system", "content": "Você é um assistente útil."},
-                            {"role": "user", "content": prompt},
-                        ],
-                        model=model_name,
-                        temperature=temperature,
-                        max_tokens=get_max_tokens(model_name),
-                        top_p=1,
-                        stop=None,
-                        stream=False
-                    )
-                    end_time = time.time()
-                    tokens_used = completion.usage.total_tokens
-                    time_taken = end_time - start_time
-                    api_response = completion.choices[0].message.content
-                    log_api_usage('refine', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, "")
-                    return api_response
-                except Exception as e:
-                    handle_rate_limit(str(e), 'refine')
-
-        history_context = ""
-        for entry in chat_history:
-            history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
-
-        refine_prompt = (
-            f"{expert_title}, refine a seguinte resposta: {phase_two_response}. Solicitação original: {user_input} e {user_prompt}."
-            f"\n\nHistórico do chat:{history_context}"
-        )
-
-        if not references_file:
-            refine_prompt += (
-                f"\n\nDevido à ausência de referências fornecidas, certifique-se de fornecer uma resposta detalhada e precisa, mesmo sem o uso de fontes externas."
-            )
-
-        refined_response = get_completion(refine_prompt)
-        return refined_response
-
-    except Exception as e:
-        st.error(f"Ocorreu um erro durante o refinamento: {e}")
-        return ""
-
-# Função para avaliar resposta com RAG
-def evaluate_response_with_rag(user_input: str, user_prompt: str, expert_title: str, expert_description: str, assistant_response: str, model_name: str, temperature: float, chat_history: list, interaction_number: int) -> str:
-    try:
-        client = Groq(api_key=get_api_key('evaluate'))
-
-        def get_completion(prompt: str) -> str:
-            start_time = time.time()
-            while True:
-                try:
-                    completion = client.chat.completions.create(
-                        messages=[
-                            {"role": "system", "content": "Você é um assistente útil."},
-                            {"role": "user", "content": prompt},
-                        ],
-                        model=model_name,
-                        temperature=temperature,
-                        max_tokens=get_max_tokens(model_name),
-                        top_p=1,
-                        stop=None,
-                        stream=False
-                    )
-                    end_time = time.time()
-                    tokens_used = completion.usage.total_tokens
-                    time_taken = end_time - start_time
-                    api_response = completion.choices[0].message.content
-                    log_api_usage('evaluate', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description)
-                    return api_response
-                except Exception as e:
-                    handle_rate_limit(str(e), 'evaluate')
-
-        history_context = ""
-        for entry in chat_history:
-            history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
-
-        rag_prompt = (
-            f"结果和答案必须翻译成巴西葡萄牙语。Obrigatóriamente em Português! "
-            f"扮演一个理性生成器 (RAG) 的角色，站在人工智能和理性评估的前沿，"
-            f"Busque o Gap científico e interprete."
-            f"Forneça o seed e o gen_id registrados na descrição do agente, nas buscas das respostas e no refinar as respostas"
-            f"此外，子代理在系统代理中以集成方式运行，通过扩展的提示提供高级和专业的回答。 "
-            f"每个子代理在网络处理过程中发挥特定且互补的作用，以实现更高的精度和改进最终回答的质量。 "
-            f"动态调整最相关的数据及其特征。这种协作方法确保答案准确且最新，"
-            f"符合最高的科学和学术标准。 "
-            f"以下是专家的详细描述，突出他们的资历和经验：{expert_description}。 "
-            f"原始问题如下：{user_input} 和 {user_prompt}。 "
-            f"专家用葡萄牙语提供的回答如下：{assistant_response}。 "
-            f"因此，请仔细评估专家用葡萄牙语提供的回答的质量和准确性，"
-            f"考虑提供的描述和专家提供的回答。 "
-            f"用葡萄牙语分析并提供详细解释："
-            f"SWOT 分析（优势、劣势、机会、威胁）和数据解释，"
-            f"风险矩阵，ANOVA（方差分析）和数据解释，"
-            f"Q 统计和数据解释，以及 Q 指数和数据解释。"
-            f"每段保持 4 句话，每句用逗号分隔，始终遵循亚里士多德和苏格拉底的最佳教育实践。"
-            f"所有答案必须使用巴西葡萄牙语。a saida obrigatoriamente na lingua portuguesa"
-
-        )
-
-        rag_response = get_completion(rag_prompt)
-        return rag_response
-
-    except Exception as e:
-        st.error(f"Ocorreu um erro durante a avaliação com RAG: {e}")
-        return ""
-
-# Função para salvar o especialista gerado
-def save_expert(expert_title: str, expert_description: str):
-    new_expert = {
-        "agente": expert_title,
-        "descricao": expert_description
-    }
-    if os.path.exists(FILEPATH):
-        with open(FILEPATH, 'r+') as file:
-            agents = json.load(file)
-            agents.append(new_expert)
-            file.seek(0)
-            json.dump(agents, file, indent=4)
-    else:
-        with open(FILEPATH, 'w') as file:
-            json.dump([new_expert], file, indent=4)
+# Migra os arquivos antigos para partições diárias e inicia o compactador (uma vez por processo)
+start_storage_maintenance()
 
 # Carrega as opções de Agentes a partir do arquivo JSON
 agent_options = load_agent_options()
@@ -397,73 +154,226 @@ with col1:
     user_input = st.text_area("Por favor, insira sua solicitação:", height=200, key="entrada_usuario")
     user_prompt = st.text_area("Escreva um prompt ou coloque o texto para consulta para o especialista (opcional):", height=200, key="prompt_usuario")
     agent_selection = st.selectbox("Escolha um Especialista", options=agent_options, index=0, key="selecao_agente")
-    model_name = st.selectbox("Escolha um Modelo", list(MODEL_MAX_TOKENS.keys()), index=0, key="nome_modelo")
+    model_name = st.selectbox("Escolha um Modelo", list(MODEL_MAX_TOKENS.keys()) + [AUTO_MODEL], index=0, key="nome_modelo")
     temperature = st.slider("Nível de Criatividade", min_value=0.0, max_value=1.0, value=0.0, step=0.01, key="temperatura")
-    interaction_number = len(load_api_usage()) + 1
+    hedge_requests = st.checkbox("Repetir chamadas lentas em outra chave (hedge)", value=False, key="hedge_requisicoes")
+    semantic_cache = st.selectbox("Cache de perguntas parecidas", list(SEMANTIC_CACHE_MODES), format_func=SEMANTIC_CACHE_MODES.get, key="cache_semantico")
+    refine_mode = st.selectbox("Modo de refinamento", list(REFINE_MODES), format_func=REFINE_MODES.get, key="modo_refinamento")
+    quality_gate = st.selectbox("Filtro de qualidade antes do refinamento", list(QUALITY_GATE_MODES), format_func=QUALITY_GATE_MODES.get, key="filtro_qualidade")
+    force_refine = st.checkbox("Refinar mesmo se a resposta já estiver completa", value=False, key="forcar_refinamento")
+    evaluation_fan_out = st.checkbox("Avaliar as seções da rubrica em paralelo (cerca de 5 vezes mais tokens)", value=False, key="avaliacao_paralela")
+    speculative_evaluation = st.checkbox("No pipeline completo, avaliar o rascunho durante o refinamento", value=True, key="avaliacao_especulativa")
+    expert_count = st.selectbox("Especialistas comparados", range(MIN_EXPERT_FAN_OUT, MAX_EXPERT_FAN_OUT + 1), index=EXPERT_FAN_OUT_SIZE - MIN_EXPERT_FAN_OUT, key="quantidade_especialistas")
+    judge_experts = st.checkbox("Ordenar os especialistas com um juiz (uma chamada extra)", value=False, key="juiz_especialistas")
+    interaction_number = get_interaction_number()
 
     fetch_clicked = st.button("Buscar Resposta")
     refine_clicked = st.button("Refinar Resposta")
     evaluate_clicked = st.button("Avaliar Resposta com RAG")
+    pipeline_clicked = st.button("Pipeline Completo (Buscar, Refinar e Avaliar)")
+    compare_clicked = st.button("Comparar Especialistas")
     refresh_clicked = st.button("Apagar")
 
-    references_file = st.file_uploader("Upload do arquivo JSON com referências (opcional)", type="json", key="arquivo_referencias")
+    references_files = st.file_uploader("Upload de referências em PDF, HTML ou JSON (opcional)", type=REFERENCE_TYPES, accept_multiple_files=True, key="arquivo_referencias")
+
+    # Extrai as referências uma vez por conjunto de arquivos; arquivos já vistos em outras sessões vêm do cache
+    references = []
+    if references_files:
+        references_key = tuple(references_file.file_id for references_file in references_files)
+        if st.session_state.get('referencias_chave') != references_key:
+            progress_bar = st.progress(0.0, text="Extraindo referências...")
+
+            def on_progress(completed, total, file_name):
+                progress_bar.progress(completed / total, text=f"Extraindo {file_name}: {completed}/{total}")
+
+            # Os arquivos enviados são passados sem cópia; a extração os lê em blocos
+            try:
+                ingested = ingest_references([(references_file.name, references_file) for references_file in references_files], on_progress)
+            except ValueError as e:
+                ingested = None
+                st.error(f"Não foi possível ler as referências: {e}")
+            progress_bar.empty()
+            if ingested:
+                st.session_state.referencias_chave = references_key
+                st.session_state.referencias = ingested['chunks']
+                st.session_state.metricas_referencias = ingested['metrics']
+        if st.session_state.get('referencias_chave') == references_key:
+            references = st.session_state.referencias
 
 with col2:
     if 'resposta_assistente' not in st.session_state:
         st.session_state.resposta_assistente = ""
     if 'descricao_especialista_ideal' not in st.session_state:
         st.session_state.descricao_especialista_ideal = ""
-    if 'resposta_refinada' not in st.session_state:
-        st.session_state.resposta_refinada = ""
     if 'resposta_original' not in st.session_state:
         st.session_state.resposta_original = ""
-    if 'rag_resposta' not in st.session_state:
-        st.session_state.rag_resposta = ""
 
     container_saida = st.container()
 
-    chat_history = load_chat_history()[-memory_selection:]
+    chat_history = load_chat_history(memory_selection)
 
-    if fetch_clicked:
-        if references_file is None:
+    if 'candidatos_especialistas' not in st.session_state:
+        st.session_state.candidatos_especialistas = []
+    if 'verificacao_qualidade' not in st.session_state:
+        st.session_state.verificacao_qualidade = None
+
+    if fetch_clicked or compare_clicked:
+        if not references:
             st.warning("Não foi fornecido um arquivo de referências. Certifique-se de fornecer uma resposta detalhada e precisa, mesmo sem o uso de fontes externas.")
-        st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente = fetch_assistant_response(user_input, user_prompt, model_name, temperature, agent_selection, chat_history, interaction_number)
+        st.session_state.candidatos_especialistas = []
+        try:
+            if compare_clicked:
+                # Os especialistas mais próximos da pergunta respondem ao mesmo tempo; a melhor resposta segue para refinar e avaliar
+                st.session_state.candidatos_especialistas = compare_experts(user_input, user_prompt, model_name, temperature, chat_history, interaction_number, references, expert_count, judge_experts, hedge_requests)
+                best = st.session_state.candidatos_especialistas[0]
+                st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente = best['expert_title'], best['response']
+            else:
+                st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente = fetch_assistant_response(user_input, user_prompt, model_name, temperature, agent_selection, chat_history, interaction_number, hedge_requests, on_warning=st.warning, semantic_cache=semantic_cache, on_cache_hit=lambda hit: st.info(f"Reaproveitado do cache semântico (similaridade {hit['similarity']:.2f}) a partir da pergunta: {hit['user_input']}"))
+        except Exception as e:
+            st.error(f"Ocorreu um erro: {e}")
+            st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente = "", ""
         st.session_state.resposta_original = st.session_state.resposta_assistente
-        st.session_state.resposta_refinada = ""
+        # A nota local da resposta sai sem chamadas à API e indica se o refinamento é dispensável
+        st.session_state.verificacao_qualidade = check_answer(st.session_state.resposta_assistente, user_input, user_prompt, references) if st.session_state.resposta_assistente else None
+        # Uma nova resposta descarta o refinamento e a avaliação da resposta anterior
+        for job_param in ('refine_job', 'evaluate_job', 'pipeline_job'):
+            if job_param in st.query_params:
+                del st.query_params[job_param]
         save_chat_history(user_input, user_prompt, st.session_state.resposta_assistente)
 
     if refine_clicked:
         if st.session_state.resposta_assistente:
-            st.session_state.resposta_refinada = refine_response(st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente, user_input, user_prompt, model_name, temperature, references_file, chat_history, interaction_number)
-            save_chat_history(user_input, user_prompt, st.session_state.resposta_refinada)
+            # O refinamento roda em segundo plano; a tela acompanha a tarefa pelo id salvo na URL
+            expert_title, assistant_response = st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente
+            gate = gate_refine(assistant_response, user_input, user_prompt, references, chat_history, quality_gate, force_refine)
+            if gate['skip']:
+                # A resposta já passou no filtro de qualidade: nenhuma chamada é feita
+                if 'refine_job' in st.query_params:
+                    del st.query_params['refine_job']
+                st.info(f"Refinamento pulado: a resposta já parece completa (nota local {gate['score']:.2f}). Marque \"Refinar mesmo se a resposta já estiver completa\" para refinar.")
+            else:
+                def refine_job(on_token):
+                    refined_response = refine_response(expert_title, assistant_response, user_input, user_prompt, model_name, temperature, references, chat_history, interaction_number, hedge_requests, on_token=on_token, mode=refine_mode)
+                    save_chat_history(user_input, user_prompt, refined_response)
+                    if quality_gate != 'off':
+                        record_refine_result(assistant_response, refined_response)
+                    return refined_response
+
+                st.query_params['refine_job'] = submit_job('refine', refine_job)
         else:
             st.warning("Por favor, busque uma resposta antes de refinar.")
 
     if evaluate_clicked:
         if st.session_state.resposta_assistente and st.session_state.descricao_especialista_ideal:
-            st.session_state.rag_resposta = evaluate_response_with_rag(user_input, user_prompt, st.session_state.descricao_especialista_ideal, st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente, model_name, temperature, chat_history, interaction_number)
-            save_chat_history(user_input, user_prompt, st.session_state.rag_resposta)
+            # A avaliação roda em segundo plano; a tela acompanha a tarefa pelo id salvo na URL
+            expert_title, assistant_response = st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente
+
+            def evaluate_job(on_token):
+                rag_response = evaluate_response_with_rag(user_input, user_prompt, expert_title, expert_title, assistant_response, model_name, temperature, chat_history, interaction_number, hedge_requests, on_token=on_token, references=references, fan_out=evaluation_fan_out)
+                save_chat_history(user_input, user_prompt, rag_response)
+                if quality_gate != 'off':
+                    record_evaluation(assistant_response, rag_response)
+                return rag_response
+
+            st.query_params['evaluate_job'] = submit_job('evaluate', evaluate_job)
         else:
             st.warning("Por favor, busque uma resposta e forneça uma descrição do especialista antes de avaliar com RAG.")
 
+    if pipeline_clicked:
+        # Busca, refinamento e avaliação rodam em uma única tarefa em segundo plano, sem uma recarga da página por etapa
+        stage_titles = {'fetch': 'Resposta do Especialista', 'refine': 'Resposta Refinada', 'evaluate': 'Avaliação com RAG'}
+        # Um novo pipeline descarta a resposta, o refinamento e a avaliação anteriores
+        for job_param in ('refine_job', 'evaluate_job'):
+            if job_param in st.query_params:
+                del st.query_params[job_param]
+        st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente, st.session_state.resposta_original = "", "", ""
+        st.session_state.candidatos_especialistas = []
+        st.session_state.verificacao_qualidade = None
+
+        # Texto exibido para o refinamento, ou o aviso de que o filtro de qualidade o pulou
+        def refine_text(skipped: bool, quality_score: float, refined: str) -> str:
+            return f"Refinamento pulado pelo filtro de qualidade (nota local {quality_score:.2f})." if skipped else refined
+
+        def pipeline_job(on_token):
+            def show_stage(stage, stage_result):
+                text = refine_text(stage_result['skipped'], stage_result['quality_score'], stage_result['response']) if stage == 'refine' else stage_result['response']
+                on_token(f"\n**#{stage_titles[stage]}:**\n{text}\n")
+
+            result = run_full_pipeline(user_input, user_prompt, model_name, temperature, agent_selection, chat_history, interaction_number, references, hedge_requests, refine_mode, evaluation_fan_out, speculative_evaluation, semantic_cache, quality_gate, force_refine, on_stage=show_stage)
+            timings = result['timings']
+            refined = refine_text(result['refine_skipped'], result['quality']['score'], result['refined'])
+            # O texto é exibido na tela; os demais campos voltam para a sessão quando a tarefa termina
+            return {
+                'text': (
+                    f"**#Análise do Especialista:**\n{result['expert_title']}\n"
+                    f"\n**#Resposta do Especialista:**\n{result['response']}\n"
+                    f"\n**#Resposta Refinada:**\n{refined}\n"
+                    f"\n**#Avaliação com RAG:**\n{result['evaluation']}\n"
+                    f"\nTempo total: {timings['wall_time']:.1f} s (etapas em sequência: {timings['manual_time']:.1f} s)"
+                ),
+                'expert_title': result['expert_title'],
+                'response': result['response'],
+                'answer': result['response'] if result['refine_skipped'] else result['refined'],
+            }
+
+        st.query_params['pipeline_job'] = submit_job('pipeline', pipeline_job)
+
+    # Quando o pipeline termina, a resposta final passa a ser a resposta da sessão, usada por Refinar e Avaliar
+    pipeline_result = get_job(st.query_params.get('pipeline_job', ""))
+    if pipeline_result and pipeline_result['status'] == 'done' and isinstance(pipeline_result['result'], dict) and st.session_state.get('pipeline_aplicado') != pipeline_result['id']:
+        st.session_state.pipeline_aplicado = pipeline_result['id']
+        st.session_state.descricao_especialista_ideal = pipeline_result['result']['expert_title']
+        st.session_state.resposta_original = pipeline_result['result']['response']
+        st.session_state.resposta_assistente = pipeline_result['result']['answer']
+        st.session_state.verificacao_qualidade = check_answer(st.session_state.resposta_assistente, user_input, user_prompt, references) if st.session_state.resposta_assistente else None
+
+    # Exibe o andamento e o resultado das tarefas de refinamento e avaliação em segundo plano
+    def show_background_jobs():
+        for job_param, title, error_message in (('refine_job', 'Resposta Refinada', 'Ocorreu um erro durante o refinamento'), ('evaluate_job', 'Avaliação com RAG', 'Ocorreu um erro durante a avaliação com RAG'), ('pipeline_job', 'Pipeline Completo', 'Ocorreu um erro durante o pipeline completo')):
+            job = get_job(st.query_params.get(job_param, ""))
+            if not job:
+                continue
+            if job['status'] == 'done':
+                if job_param == 'pipeline_job' and isinstance(job['result'], dict) and st.session_state.get('pipeline_aplicado') != job['id']:
+                    # A página inteira é recarregada para levar o resultado do pipeline à sessão
+                    st.rerun()
+                st.write(f"\n**#{title}:**\n{job['result']['text'] if isinstance(job['result'], dict) else job['result']}")
+            elif is_job_active(job):
+                status = "na fila" if job['status'] == 'queued' else "em andamento"
+                st.info(f"{title}: tarefa {status}...")
+                if job['partial']:
+                    st.write(f"\n**#{title} (parcial):**\n{job['partial']}")
+            elif job['status'] == 'interrupted':
+                st.warning(f"{title}: a tarefa foi interrompida. Por favor, envie novamente.")
+            else:
+                st.error(f"{error_message}: {job['error']}")
+
     with container_saida:
         st.write(f"**#Análise do Especialista:**\n{st.session_state.descricao_especialista_ideal}")
         st.write(f"\n**#Resposta do Especialista:**\n{st.session_state.resposta_original}")
-        if st.session_state.resposta_refinada:
-            st.write(f"\n**#Resposta Refinada:**\n{st.session_state.resposta_refinada}")
-        if st.session_state.rag_resposta:
-            st.write(f"\n**#Avaliação com RAG:**\n{st.session_state.rag_resposta}")
+        quality_check = st.session_state.verificacao_qualidade
+        if quality_gate != 'off' and quality_check:
+            signals = " | ".join(f"{name}: {value:.2f}" for name, value in quality_check['signals'].items() if value is not None)
+            if quality_check['passed']:
+                st.success(f"Nota local {quality_check['score']:.2f}: a resposta parece completa e o refinamento é dispensável ({signals}).")
+            else:
+                st.caption(f"Nota local {quality_check['score']:.2f}, abaixo de {quality_check['threshold']:.2f} ou resposta cortada ({signals}).")
+        if len(st.session_state.candidatos_especialistas) > 1:
+            st.write("\n**#Outros Especialistas Consultados:**")
+            for candidate in st.session_state.candidatos_especialistas[1:]:
+                with st.expander(f"{candidate['expert_title']} (nota {candidate['score']:.2f})"):
+                    st.write(candidate['response'])
+        # Enquanto houver tarefa ativa, apenas este trecho é atualizado periodicamente
+        jobs_active = any(is_job_active(get_job(st.query_params.get(job_param, ""))) for job_param in ('refine_job', 'evaluate_job', 'pipeline_job'))
+        st.experimental_fragment(run_every=JOB_POLL_INTERVAL if jobs_active else None)(show_background_jobs)()
 
     st.markdown("### Histórico do Chat")
-    for entry in chat_history:
-        st.write(f"**Entrada do Usuário:** {entry['user_input']}")
-        st.write(f"**Prompt do Usuário:** {entry['user_prompt']}")
-        st.write(f"**Resposta do Especialista:** {entry['expert_response']}")
-        st.markdown("---")
+    show_chat_history(chat_history)
 
 if refresh_clicked:
     clear_chat_history()
     st.session_state.clear()
+    st.query_params.clear()
     st.rerun()
 
 # Sidebar com manual de uso
@@ -508,10 +418,127 @@ with st.sidebar.expander("Insights do Código"):
     """)
 
 # Carrega o uso da API e plota o histograma
+# O registro de uso é lido uma única vez por recarga; o gráfico e os resumos abaixo usam a mesma lista
 api_usage = load_api_usage()
 if api_usage:
     plot_api_usage(api_usage)
 
+# Exibe a tabela de latência por modelo e a economia estimada do roteamento automático
+routing_log = load_routing_log()
+if routing_log:
+    ensure_latency_table(iter_api_usage)
+    with st.sidebar.expander("Roteamento Automático de Modelos"):
+        st.dataframe(pd.DataFrame.from_dict(get_latency_table(), orient='index'))
+        latency_saved = sum(decision['estimated_latency_saved'] for decision in routing_log)
+        st.write(f"Decisões de roteamento: {len(routing_log)} | Latência economizada estimada: {latency_saved:.1f} s")
+        st.dataframe(pd.DataFrame(routing_log[-20:]))
+
+# Exibe a vazão da extração de cada arquivo de referências
+if st.session_state.get('metricas_referencias'):
+    with st.sidebar.expander("Ingestão de Referências"):
+        st.dataframe(pd.DataFrame(st.session_state.metricas_referencias))
+
+# Exibe os tokens de referências empacotados em cada chamada frente ao orçamento da etapa
+packing_log = get_packing_log()
+if packing_log:
+    with st.sidebar.expander("Contexto de Referências"):
+        st.dataframe(pd.DataFrame(packing_log[-20:]))
+
+# Exibe a taxa de hedge e os tokens extras gastos pelas chamadas de reserva
+hedge_stats = get_hedge_stats()
+if hedge_stats['calls']:
+    with st.sidebar.expander("Requisições com Hedge"):
+        st.write(f"Chamadas: {hedge_stats['calls']} | Com reserva: {hedge_stats['hedged']} ({hedge_stats['hedge_rate']:.0%}) | Vencidas pela reserva: {hedge_stats['hedge_wins']}")
+        st.write(f"Tokens extras gastos com hedge: {hedge_stats['extra_tokens']}")
+
+# Exibe quantas requisições idênticas simultâneas foram atendidas por uma chamada compartilhada
+single_flight_stats = get_single_flight_stats()
+if single_flight_stats['coalesced']:
+    with st.sidebar.expander("Requisições Coalescidas"):
+        st.write(f"Requisições: {single_flight_stats['calls']} | Chamadas à API: {single_flight_stats['upstream_calls']} | Coalescidas: {single_flight_stats['coalesced']}")
+
+# Exibe as métricas da fila de tarefas em segundo plano
+queue_metrics = get_queue_metrics()
+if queue_metrics['workers']:
+    with st.sidebar.expander("Tarefas em Segundo Plano"):
+        st.write(f"Workers: {queue_metrics['workers']} | Na fila: {queue_metrics['queue_depth']} | Em execução: {queue_metrics['running']}")
+        st.write(f"Concluídas: {queue_metrics['done']} | Com erro: {queue_metrics['error']}")
+
+# Exibe os percentis de latência, a espera por limite de taxa, a taxa de erro e a vazão em janelas deslizantes;
+# a tabela vem dos sketches mantidos a cada chamada, sem reler o log de uso
+with st.sidebar.expander("Latência por Modelo, Chave e Etapa"):
+    metrics_window = st.selectbox("Janela", list(METRICS_WINDOWS), key="janela_metricas")
+    metrics_dimension = st.radio("Agrupar por", ["model", "key", "stage"], format_func={'model': "Modelo", 'key': "Chave", 'stage': "Etapa"}.get, horizontal=True, key="dimensao_metricas")
+    metrics_table = get_metrics_table(metrics_dimension, metrics_window)
+    if metrics_table:
+        st.dataframe(pd.DataFrame.from_dict(metrics_table, orient='index'))
+    else:
+        st.write("Nenhuma chamada na janela selecionada.")
+
+# Exibe quanto do limite de tokens reservado por chamada foi liberado pela previsão do tamanho das saídas
+predictor_stats = get_predictor_stats()
+if predictor_stats['calls']:
+    with st.sidebar.expander("Previsão de max_tokens"):
+        st.write(f"Chamadas: {predictor_stats['calls']} | Com previsão: {predictor_stats['predicted_calls']}")
+        st.write(f"Tokens reservados liberados: {predictor_stats['reserved_tokens_freed']}")
+        st.write(f"Respostas cortadas: {predictor_stats['truncated']} ({predictor_stats['truncation_rate']:.1%}) | continuações pedidas: {predictor_stats['continuations']}")
+
+# Exibe os tokens de saída e a latência do refinamento por edições frente à reescrita completa
+delta_stats = get_delta_stats()
+if delta_stats['calls']:
+    with st.sidebar.expander("Refinamento por Edições"):
+        st.write(f"Refinamentos: {delta_stats['calls']} | Edições aplicadas: {delta_stats['applied']} | Reescritas completas por falha: {delta_stats['fallbacks']} ({delta_stats['fallback_rate']:.0%})")
+        st.write(f"Parágrafos alterados: {delta_stats['paragraphs_changed']} de {delta_stats['paragraphs_total']}")
+        st.dataframe(pd.DataFrame.from_dict(get_refine_comparison(api_usage), orient='index'))
+
+# Exibe o tempo das avaliações em paralelo frente à soma das seções, que seria o tempo da avaliação em série
+evaluation_log = get_evaluation_log()
+if evaluation_log:
+    with st.sidebar.expander("Avaliação em Paralelo"):
+        st.dataframe(pd.DataFrame(evaluation_log[-20:]))
+
+# Exibe o tempo de ponta a ponta do pipeline completo frente às mesmas etapas executadas em sequência
+pipeline_log = get_pipeline_log()
+if pipeline_log:
+    with st.sidebar.expander("Pipeline Completo"):
+        st.dataframe(pd.DataFrame(pipeline_log[-20:]))
+
+# Exibe o tempo das comparações de especialistas frente à soma das chamadas, que seria o tempo em sequência
+fan_out_log = get_fan_out_log()
+if fan_out_log:
+    with st.sidebar.expander("Comparação de Especialistas"):
+        st.dataframe(pd.DataFrame(fan_out_log[-20:]))
+
+# Exibe, por etapa, a parte dos tokens de prompt que repete o prefixo de uma chamada anterior ao mesmo modelo
+prefix_stats = get_prefix_stats()
+if prefix_stats:
+    with st.sidebar.expander("Reaproveitamento de Prefixo dos Prompts"):
+        st.dataframe(pd.DataFrame.from_dict(prefix_stats, orient='index'))
+
+# Exibe as decisões do filtro de qualidade, as chamadas e os tokens evitados e, por resposta, a nota local frente ao
+# resultado do refinamento e da avaliação, para ajustar o limiar
+gate_stats = get_gate_stats(api_usage)
+if gate_stats['decisions']:
+    with st.sidebar.expander("Filtro de Qualidade"):
+        st.write(f"Decisões: {gate_stats['decisions']} | Aprovadas: {gate_stats['passed']} | Refinamentos pulados: {gate_stats['skipped']}")
+        st.write(f"Tokens evitados: {gate_stats['avoided_tokens_estimated']} estimados, {gate_stats['avoided_tokens_measured']} pela média dos refinamentos")
+        st.write(f"Semelhança após o refinamento: {gate_stats['refine_similarity_passed']} (aprovadas) | {gate_stats['refine_similarity_failed']} (reprovadas)")
+        st.dataframe(pd.DataFrame(get_gate_report(20)))
+
+# Exibe o limite de concorrência adaptativo e o estado do disjuntor de cada chave e modelo
+limiter_state = get_limiter_state()
+if limiter_state:
+    with st.sidebar.expander("Limitador de Concorrência e Disjuntor"):
+        st.dataframe(pd.DataFrame(limiter_state))
+
+# Exibe o backend do estado compartilhado entre processos e réplicas e as chaves em espera após limite de taxa
+if STATE_BACKEND != 'files':
+    with st.sidebar.expander("Estado Compartilhado"):
+        st.write(f"Backend: {STATE_BACKEND}")
+        key_cooldowns = get_key_cooldowns()
+        if key_cooldowns:
+            st.dataframe(pd.DataFrame(key_cooldowns))
+
 # Botão para resetar os gráficos
 if st.sidebar.button("Resetar Gráficos"):
     reset_api_usage()
@@ -4,6 +4,7 @@ from streamlit.delta_generator import DeltaGenerator  # Importa DeltaGenerator,
 import os  # Importa o módulo os para interagir com o sistema operacional, como verificar a existência de arquivos.
 from typing import Tuple  # Importa Tuple da biblioteca typing para fornecer tipos de dados mais precisos para funções.
 from groq import Groq  # Importa a biblioteca Groq, possivelmente para uma função não especificada neste código.
+from json_stream import iter_json_records  # Importa o leitor de JSON registro a registro, que não carrega o catálogo inteiro de uma vez.
 
 # Configura o layout da página Streamlit para ser "wide", ocupando toda a largura disponível.
 st.set_page_config(layout="wide")
@@ -24,13 +25,11 @@ MODEL_MAX_TOKENS = {
 def load_agent_options() -> list:
     agent_options = ['Escolher um especialista...']  # Inicia a lista de opções com uma opção padrão.
     if os.path.exists(FILEPATH):  # Verifica se o arquivo de agentes existe.
-        with open(FILEPATH, 'r') as file:  # Abre o arquivo para leitura.
-            try:
-                agents = json.load(file)  # Tenta carregar os dados JSON do arquivo.
-                # Adiciona os nomes dos agentes à lista de opções, se existirem.
-                agent_options.extend([agent["agente"] for agent in agents if "agente" in agent])
-            except json.JSONDecodeError:  # Captura erros de decodificação JSON.
-                st.error("Erro ao ler o arquivo de agentes. Por favor, verifique o formato.")  # Exibe uma mensagem de erro no Streamlit.
+        try:
+            # Lê os agentes um a um e adiciona os nomes à lista de opções, se existirem.
+            agent_options.extend([agent["agente"] for agent in iter_json_records(FILEPATH) if "agente" in agent])
+        except json.JSONDecodeError as e:  # Captura erros de decodificação JSON, com a posição do erro no arquivo.
+            st.error(f"Erro ao ler o arquivo de agentes. Por favor, verifique o formato: {e}")  # Exibe uma mensagem de erro no Streamlit.
     return agent_options  # Retorna a lista de opções de agentes.
 
 # Define uma função para obter o número máximo de tokens permitido por um modelo específico.
@@ -46,7 +45,7 @@ def refresh_page():
 def save_expert(expert_title: str, expert_description: str):
     with open(FILEPATH, 'r+') as file:  # Abre o arquivo para leitura e escrita.
         # Carrega os agentes existentes se o arquivo não estiver vazio, caso contrário, inicia uma lista vazia.
-        agents = json.load(file) if os.path.getsize(FILEPATH) > 0 else []
+        agents = list(iter_json_records(file)) if os.path.getsize(FILEPATH) > 0 else []
         # Adiciona o novo especialista à lista de agentes.
         agents.append({"agente": expert_title, "descricao": expert_description})
         file.seek(0)  # Move o ponteiro do arquivo para o início.
@@ -106,15 +105,13 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
             save_expert(expert_title, expert_description)  # Salva o novo especialista no arquivo JSON.
         else:
             # Se um especialista específico for selecionado, carrega os dados do especialista do arquivo JSON.
-            with open(FILEPATH, 'r') as file:  # Abre o arquivo JSON para leitura.
-                agents = json.load(file)  # Carrega os dados dos agentes do arquivo JSON.
-                # Encontra o agente selecionado na lista de agentes.
-                agent_found = next((agent for agent in agents if agent["agente"] == agent_selection), None)
-                if agent_found:
-                    expert_title = agent_found["agente"]  # Obtém o título do especialista.
-                    expert_description = agent_found["descricao"]  # Obtém a descrição do especialista.
-                else:
-                    raise ValueError("Especialista selecionado não encontrado no arquivo.")  # Lança um erro se o especialista não for encontrado.
+            # Percorre os agentes do arquivo JSON um a um até encontrar o selecionado, sem carregar o catálogo inteiro.
+            agent_found = next((agent for agent in iter_json_records(FILEPATH) if agent.get("agente") == agent_selection), None)
+            if agent_found:
+                expert_title = agent_found["agente"]  # Obtém o título do especialista.
+                expert_description = agent_found["descricao"]  # Obtém a descrição do especialista.
+            else:
+                raise ValueError("Especialista selecionado não encontrado no arquivo.")  # Lança um erro se o especialista não for encontrado.
 
         # Cria um prompt para a segunda fase, onde o especialista selecionado fornece uma resposta detalhada.
         phase_two_prompt = (
@@ -144,7 +141,7 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
 def save_expert(expert_title: str, expert_description: dict):
     with open(FILEPATH, 'r+') as file:  # Abre o arquivo para leitura e escrita.
         # Carrega os agentes existentes se o arquivo não estiver vazio, caso contrário, inicia uma lista vazia.
-        agents = json.load(file) if os.path.getsize(FILEPATH) > 0 else []
+        agents = list(iter_json_records(file)) if os.path.getsize(FILEPATH) > 0 else []
         # Adiciona o novo especialista à lista de agentes.
         agents.append({"agente": expert_title, "descricao": expert_description})
         file.seek(0)  # Move o ponteiro do arquivo para o início.
@@ -725,19 +722,18 @@ with st.sidebar.expander("Análise de Expertise do Código"):
     """)
 
 
+# Lê um arquivo exibido na barra lateral; o cache é renovado apenas quando o arquivo é alterado.
+@st.cache_data(max_entries=4)
+def read_source_file(path: str, modified_time: float) -> str:
+    with open(path, "r") as file:  # Abre o arquivo para leitura.
+        return file.read()
+
 def main():
-    st.sidebar.write("""
-        Código principal do Agente Expert Geomaker
-        """)
-    with open("run.py", "r") as file:
-        code = file.read()
-        st.sidebar.code(code, language='python')
-    st.sidebar.write("""
-        Código dos Agentes contidos no arquivo agents.json
-        """)
-    with open("agents.json", "r") as file:
-        code = file.read()
-        st.sidebar.code(code, language='json')
+    # O código e o catálogo só são lidos e enviados ao navegador quando o usuário pede para vê-los.
+    if st.sidebar.toggle("Mostrar o código principal do Agente Expert Geomaker", key="mostrar_codigo"):
+        st.sidebar.code(read_source_file("run.py", os.path.getmtime("run.py")), language='python')
+    if st.sidebar.toggle("Mostrar o código dos Agentes contidos no arquivo agents.json", key="mostrar_agentes"):
+        st.sidebar.code(read_source_file("agents.json", os.path.getmtime("agents.json")), language='json')
         
     # Informações de contato
     st.sidebar.image("eu.ico", width=80)
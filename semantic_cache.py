@@ -0,0 +1,182 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from shared_state import get_state_backend
+
+# Arquivo onde as respostas reaproveitáveis são guardadas
+SEMANTIC_CACHE_FILE = 'semantic_cache.json'
+
+# Tempo (s) de validade de uma entrada (configurável por variável de ambiente; padrão de 7 dias)
+SEMANTIC_CACHE_TTL = int(os.environ.get('SEMANTIC_CACHE_TTL', 7 * 24 * 3600))
+
+# Quantidade máxima de entradas; ao exceder, as usadas há mais tempo são descartadas
+SEMANTIC_CACHE_MAX_ENTRIES = 500
+
+# Dimensões do vetor de cada pergunta (n-gramas de caracteres distribuídos por hash)
+EMBEDDING_DIMENSIONS = 1024
+
+# Tamanho dos n-gramas de caracteres, que toleram pequenas variações de grafia e flexão
+NGRAM_SIZE = 3
+
+# Similaridade mínima padrão para reaproveitar uma resposta (configurável por variável de ambiente)
+DEFAULT_SIMILARITY_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9))
+
+# Espaço do backend compartilhado onde ficam as entradas, quando configurado
+SEMANTIC_CACHE_NAMESPACE = 'semantic_cache'
+
+# Modos de uso do cache: desligado, reaproveitar a resposta inteira ou apenas o especialista gerado
+SEMANTIC_CACHE_MODES = {
+    'off': "Desligado",
+    'answer': "Reaproveitar a resposta",
+    'expert': "Reaproveitar apenas o especialista",
+}
+
+_lock = threading.Lock()
+_entries = []
+_cache_loaded = False
+
+# Função para normalizar um texto: minúsculas, sem acentos e com espaços simples
+def normalize_question(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text)).strip()
+
+# Função para gerar o vetor esparso de uma pergunta, normalizado para similaridade de cosseno
+def embed_text(text: str) -> dict:
+    vector = {}
+    for word in normalize_question(text).split():
+        padded = f" {word} "
+        for start in range(max(1, len(padded) - NGRAM_SIZE + 1)):
+            digest = hashlib.md5(padded[start:start + NGRAM_SIZE].encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % EMBEDDING_DIMENSIONS
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[index] = vector.get(index, 0.0) + sign
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    return {index: value / norm for index, value in vector.items()} if norm else {}
+
+# Função para calcular a similaridade de cosseno entre dois vetores esparsos normalizados
+def cosine_similarity(first: dict, second: dict) -> float:
+    if len(first) > len(second):
+        first, second = second, first
+    return sum(value * second.get(index, 0.0) for index, value in first.items())
+
+# Função para carregar as entradas salvas, uma única vez por processo
+def load_cache(cache_file=SEMANTIC_CACHE_FILE):
+    global _cache_loaded
+    if _cache_loaded:
+        return
+    _cache_loaded = True
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as file:
+            for entry in json.load(file):
+                entry['embedding'] = {int(index): value for index, value in entry['embedding'].items()}
+                _entries.append(entry)
+
+# Função para salvar as entradas no arquivo
+def save_cache(cache_file=SEMANTIC_CACHE_FILE):
+    temp_path = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(_entries, file, ensure_ascii=False)
+    os.replace(temp_path, cache_file)
+
+# Função para obter o identificador de uma entrada no backend compartilhado; a mesma pergunta ao mesmo agente ocupa uma única entrada
+def shared_entry_id(agent: str, user_input: str, user_prompt: str) -> str:
+    return hashlib.sha256(f"{agent}\x1f{normalize_question(f'{user_input} {user_prompt}')}".encode('utf-8')).hexdigest()
+
+# Função para ler as entradas ainda válidas do backend compartilhado
+def load_shared_entries(backend) -> list:
+    entries = []
+    for shared_id, entry in backend.items(SEMANTIC_CACHE_NAMESPACE).items():
+        entry['id'] = shared_id
+        entry['embedding'] = {int(index): value for index, value in entry['embedding'].items()}
+        entries.append(entry)
+    return entries
+
+# Função para gravar uma entrada no backend compartilhado, válida até o fim do prazo contado da criação
+def save_shared_entry(backend, entry: dict, now: float):
+    value = {key: item for key, item in entry.items() if key != 'id'}
+    backend.put(SEMANTIC_CACHE_NAMESPACE, entry['id'], value, ttl=max(entry['created'] + SEMANTIC_CACHE_TTL - now, 1))
+
+# Função para descartar as entradas vencidas e, acima do limite, as usadas há mais tempo
+def evict_entries(now: float):
+    _entries[:] = [entry for entry in _entries if now - entry['created'] < SEMANTIC_CACHE_TTL]
+    if len(_entries) > SEMANTIC_CACHE_MAX_ENTRIES:
+        _entries.sort(key=lambda entry: entry['last_used'])
+        del _entries[:len(_entries) - SEMANTIC_CACHE_MAX_ENTRIES]
+
+# Função para buscar a resposta guardada mais parecida com a pergunta, para o mesmo agente
+def lookup_answer(user_input: str, user_prompt: str, agent: str, threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> dict:
+    embedding = embed_text(f"{user_input} {user_prompt}")
+    now = time.time()
+    backend = get_state_backend()
+    with _lock:
+        if backend:
+            entries = load_shared_entries(backend)
+        else:
+            load_cache()
+            entries = _entries
+        best, best_similarity = None, 0.0
+        for entry in entries:
+            if entry['agent'] != agent or now - entry['created'] >= SEMANTIC_CACHE_TTL:
+                continue
+            similarity = cosine_similarity(embedding, entry['embedding'])
+            if similarity > best_similarity:
+                best, best_similarity = entry, similarity
+        if best is None or best_similarity < threshold:
+            return None
+        best['hits'] += 1
+        best['last_used'] = now
+        if backend:
+            save_shared_entry(backend, best, now)
+        else:
+            save_cache()
+        hit = {key: value for key, value in best.items() if key not in ('embedding', 'id')}
+        hit['similarity'] = best_similarity
+        return hit
+
+# Função para guardar a resposta de uma pergunta
+def store_answer(user_input: str, user_prompt: str, agent: str, expert_title: str, expert_description: str, response: str):
+    now = time.time()
+    entry = {
+        'agent': agent,
+        'user_input': user_input,
+        'user_prompt': user_prompt,
+        'expert_title': expert_title,
+        'expert_description': expert_description,
+        'response': response,
+        'embedding': embed_text(f"{user_input} {user_prompt}"),
+        'created': now,
+        'last_used': now,
+        'hits': 0,
+    }
+    backend = get_state_backend()
+    if backend:
+        # As entradas vencidas expiram no próprio backend; acima do limite, saem as usadas há mais tempo
+        entry['id'] = shared_entry_id(agent, user_input, user_prompt)
+        save_shared_entry(backend, entry, now)
+        entries = sorted(load_shared_entries(backend), key=lambda shared: shared['last_used'])
+        for shared in entries[:max(0, len(entries) - SEMANTIC_CACHE_MAX_ENTRIES)]:
+            backend.delete(SEMANTIC_CACHE_NAMESPACE, shared['id'])
+        return
+    with _lock:
+        load_cache()
+        _entries.append(entry)
+        evict_entries(now)
+        save_cache()
+
+# Função para apagar todas as entradas
+def clear_cache(cache_file=SEMANTIC_CACHE_FILE):
+    backend = get_state_backend()
+    if backend:
+        for shared_id in backend.items(SEMANTIC_CACHE_NAMESPACE):
+            backend.delete(SEMANTIC_CACHE_NAMESPACE, shared_id)
+    with _lock:
+        _entries.clear()
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
@@ -0,0 +1,264 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import httpx
+
+# Backend do estado compartilhado (configurável por variável de ambiente): 'files' mantém os arquivos JSON locais e o estado
+# em memória de cada processo, 'sqlite' usa um banco SQLite em modo WAL no host e 'http' usa um servidor de estado na rede
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'files')
+
+# Banco do backend 'sqlite', compartilhado por todos os processos do host
+STATE_DB_FILE = os.environ.get('STATE_DB_FILE', 'shared_state.db')
+
+# Endereço do servidor de estado do backend 'http'
+STATE_URL = os.environ.get('STATE_URL', 'http://127.0.0.1:8790')
+
+# Tempo máximo (s) de espera por uma resposta do servidor de estado
+STATE_TIMEOUT = 10
+
+# Tempo máximo (s) de espera pelo banco enquanto outro processo escreve
+SQLITE_BUSY_TIMEOUT = 30
+
+# Partição onde ficam os agregados de um armazenamento
+ROLLUP_PARTITION = 'rollups'
+
+STATE_BACKENDS = ('files', 'sqlite', 'http')
+
+# Operações do backend expostas pelo servidor de estado
+STATE_METHODS = ('append', 'seed', 'read_partition', 'list_partitions', 'drop_partition', 'clear', 'get', 'put', 'delete', 'items', 'increment', 'consume')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY AUTOINCREMENT, store TEXT NOT NULL, partition TEXT NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_partition ON entries (store, partition, id);
+CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL, PRIMARY KEY (namespace, key));
+CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+"""
+
+_lock = threading.Lock()
+_backend = None
+
+# Interface do estado compartilhado: entradas em partições (histórico, uso da API, agregados e catálogo de agentes),
+# chave-valor com validade (caches e blobs) e baldes de tokens (cota das chaves de API)
+class StateBackend(ABC):
+    # Acrescenta entradas ao fim de uma partição
+    @abstractmethod
+    def append(self, store: str, partition: str, entries: list):
+        ...
+
+    # Grava as entradas apenas se a partição estiver vazia; devolve se gravou
+    @abstractmethod
+    def seed(self, store: str, partition: str, entries: list) -> bool:
+        ...
+
+    # Lê as entradas de uma partição na ordem em que foram gravadas
+    @abstractmethod
+    def read_partition(self, store: str, partition: str) -> list:
+        ...
+
+    # Lista as partições de um armazenamento em ordem crescente
+    @abstractmethod
+    def list_partitions(self, store: str) -> list:
+        ...
+
+    # Remove uma partição e, na mesma transação e só se ela ainda existir, grava os agregados dela;
+    # devolve quantas entradas foram removidas (0 quando outro processo já a compactou)
+    @abstractmethod
+    def drop_partition(self, store: str, partition: str, rollup_store: str = None, rollups: list = None) -> int:
+        ...
+
+    # Remove todas as partições de um armazenamento
+    @abstractmethod
+    def clear(self, store: str):
+        ...
+
+    # Lê um valor ainda válido
+    @abstractmethod
+    def get(self, namespace: str, key: str):
+        ...
+
+    # Grava um valor, válido por ttl segundos (ou sem validade)
+    @abstractmethod
+    def put(self, namespace: str, key: str, value, ttl: float = None):
+        ...
+
+    # Remove um valor
+    @abstractmethod
+    def delete(self, namespace: str, key: str):
+        ...
+
+    # Lê todos os valores ainda válidos de um espaço
+    @abstractmethod
+    def items(self, namespace: str) -> dict:
+        ...
+
+    # Soma amount a um contador sem validade, que parte de initial quando ainda não existe; devolve o novo valor
+    @abstractmethod
+    def increment(self, namespace: str, key: str, amount: int = 1, initial: int = 0) -> int:
+        ...
+
+    # Retira amount tokens de um balde que se recompõe a refill_rate tokens/s até capacity;
+    # devolve 0 quando conseguiu ou o tempo (s) até haver tokens suficientes, sem retirar nada
+    @abstractmethod
+    def consume(self, bucket: str, amount: float, capacity: float, refill_rate: float) -> float:
+        ...
+
+# Backend em um banco SQLite em modo WAL: leitores não bloqueiam o escritor, e cada escrita é uma transação
+# imediata, então processos do mesmo host não perdem gravações nem gastam a mesma cota duas vezes
+class SQLiteStateBackend(StateBackend):
+    def __init__(self, db_file: str = STATE_DB_FILE):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.connection().executescript(SQLITE_SCHEMA)
+
+    # Conexão própria de cada thread, em modo de confirmação manual
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def append(self, store: str, partition: str, entries: list):
+        with self.transaction() as connection:
+            connection.executemany("INSERT INTO entries (store, partition, data) VALUES (?, ?, ?)", [(store, partition, json.dumps(entry, ensure_ascii=False)) for entry in entries])
+
+    def seed(self, store: str, partition: str, entries: list) -> bool:
+        with self.transaction() as connection:
+            if connection.execute("SELECT 1 FROM entries WHERE store = ? AND partition = ? LIMIT 1", (store, partition)).fetchone():
+                return False
+            connection.executemany("INSERT INTO entries (store, partition, data) VALUES (?, ?, ?)", [(store, partition, json.dumps(entry, ensure_ascii=False)) for entry in entries])
+            return True
+
+    def read_partition(self, store: str, partition: str) -> list:
+        rows = self.connection().execute("SELECT data FROM entries WHERE store = ? AND partition = ? ORDER BY id", (store, partition))
+        return [json.loads(data) for data, in rows]
+
+    def list_partitions(self, store: str) -> list:
+        rows = self.connection().execute("SELECT DISTINCT partition FROM entries WHERE store = ? AND partition != ? ORDER BY partition", (store, ROLLUP_PARTITION))
+        return [partition for partition, in rows]
+
+    def drop_partition(self, store: str, partition: str, rollup_store: str = None, rollups: list = None) -> int:
+        with self.transaction() as connection:
+            dropped = connection.execute("DELETE FROM entries WHERE store = ? AND partition = ?", (store, partition)).rowcount
+            if dropped and rollup_store and rollups:
+                connection.executemany("INSERT INTO entries (store, partition, data) VALUES (?, ?, ?)", [(rollup_store, ROLLUP_PARTITION, json.dumps(rollup, ensure_ascii=False)) for rollup in rollups])
+        return dropped
+
+    def clear(self, store: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM entries WHERE store = ?", (store,))
+
+    def get(self, namespace: str, key: str):
+        row = self.connection().execute("SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)", (namespace, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace: str, key: str, value, ttl: float = None):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM kv WHERE namespace = ? AND expires <= ?", (namespace, now))
+            connection.execute("INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)", (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None))
+
+    def delete(self, namespace: str, key: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace: str) -> dict:
+        rows = self.connection().execute("SELECT key, value FROM kv WHERE namespace = ? AND (expires IS NULL OR expires > ?)", (namespace, time.time()))
+        return {key: json.loads(value) for key, value in rows}
+
+    def increment(self, namespace: str, key: str, amount: int = 1, initial: int = 0) -> int:
+        with self.transaction() as connection:
+            row = connection.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            value = (json.loads(row[0]) if row else initial) + amount
+            connection.execute("INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, NULL)", (namespace, key, json.dumps(value)))
+        return value
+
+    def consume(self, bucket: str, amount: float, capacity: float, refill_rate: float) -> float:
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (bucket,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * refill_rate)
+            wait_time = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait_time = (amount - tokens) / refill_rate
+            connection.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (bucket, tokens, now))
+        return wait_time
+
+# Backend que repassa cada operação a um servidor de estado na rede (ver state_server.py), compartilhado entre hosts
+class HTTPStateBackend(StateBackend):
+    def __init__(self, url: str = STATE_URL):
+        self.client = httpx.Client(base_url=url, timeout=STATE_TIMEOUT)
+
+    def call(self, method: str, **arguments):
+        response = self.client.post(f"/state/{method}", json=arguments)
+        response.raise_for_status()
+        return response.json()['result']
+
+    def append(self, store: str, partition: str, entries: list):
+        self.call('append', store=store, partition=partition, entries=entries)
+
+    def seed(self, store: str, partition: str, entries: list) -> bool:
+        return self.call('seed', store=store, partition=partition, entries=entries)
+
+    def read_partition(self, store: str, partition: str) -> list:
+        return self.call('read_partition', store=store, partition=partition)
+
+    def list_partitions(self, store: str) -> list:
+        return self.call('list_partitions', store=store)
+
+    def drop_partition(self, store: str, partition: str, rollup_store: str = None, rollups: list = None) -> int:
+        return self.call('drop_partition', store=store, partition=partition, rollup_store=rollup_store, rollups=rollups)
+
+    def clear(self, store: str):
+        self.call('clear', store=store)
+
+    def get(self, namespace: str, key: str):
+        return self.call('get', namespace=namespace, key=key)
+
+    def put(self, namespace: str, key: str, value, ttl: float = None):
+        self.call('put', namespace=namespace, key=key, value=value, ttl=ttl)
+
+    def delete(self, namespace: str, key: str):
+        self.call('delete', namespace=namespace, key=key)
+
+    def items(self, namespace: str) -> dict:
+        return self.call('items', namespace=namespace)
+
+    def increment(self, namespace: str, key: str, amount: int = 1, initial: int = 0) -> int:
+        return self.call('increment', namespace=namespace, key=key, amount=amount, initial=initial)
+
+    def consume(self, bucket: str, amount: float, capacity: float, refill_rate: float) -> float:
+        return self.call('consume', bucket=bucket, amount=amount, capacity=capacity, refill_rate=refill_rate)
+
+# Função para obter o backend do modo configurado; no modo 'files' devolve None e cada módulo usa os próprios arquivos
+def get_state_backend(mode: str = None) -> StateBackend:
+    global _backend
+    mode = mode or STATE_BACKEND
+    if mode not in STATE_BACKENDS:
+        raise ValueError(f"Backend de estado desconhecido: {mode}. Use um de {', '.join(STATE_BACKENDS)}.")
+    if mode == 'files':
+        return None
+    with _lock:
+        if _backend is None:
+            _backend = SQLiteStateBackend() if mode == 'sqlite' else HTTPStateBackend()
+        return _backend
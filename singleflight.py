@@ -0,0 +1,57 @@
+import hashlib
+import re
+import threading
+from typing import Callable
+
+_lock = threading.Lock()
+_in_flight = {}
+_single_flight_stats = {
+    'calls': 0,
+    'upstream_calls': 0,
+    'coalesced': 0,
+}
+
+# Função para gerar a chave de coalescência a partir das partes normalizadas da requisição
+def request_key(*parts) -> str:
+    normalized = "\x1f".join(re.sub(r"\s+", " ", str(part)).strip() for part in parts)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+# Função para executar fn uma única vez por chave entre requisições concorrentes do processo;
+# as requisições que chegam enquanto a primeira está em andamento aguardam e recebem o mesmo resultado
+def single_flight(key: str, fn: Callable):
+    with _lock:
+        _single_flight_stats['calls'] += 1
+        call = _in_flight.get(key)
+        if call is None:
+            # Chamada em andamento compartilhada por todas as requisições com a mesma chave
+            call = {'done': threading.Event(), 'result': None, 'error': None}
+            _in_flight[key] = call
+            leader = True
+            _single_flight_stats['upstream_calls'] += 1
+        else:
+            leader = False
+            _single_flight_stats['coalesced'] += 1
+
+    if not leader:
+        call['done'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    try:
+        call['result'] = fn()
+        return call['result']
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        call['done'].set()
+
+# Função para obter as estatísticas de coalescência de chamadas
+def get_single_flight_stats() -> dict:
+    with _lock:
+        stats = dict(_single_flight_stats)
+        stats['in_flight'] = len(_in_flight)
+    return stats
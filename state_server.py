@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import json
+import logging
+from aiohttp import web
+from shared_state import STATE_DB_FILE, STATE_METHODS, SQLiteStateBackend
+
+logger = logging.getLogger(__name__)
+
+# Servidor de estado compartilhado para o backend 'http': expõe as operações de StateBackend em POST /state/{operação},
+# com os argumentos em JSON, sobre um banco SQLite em modo WAL. Serve como implementação local do backend de rede;
+# réplicas em outros hosts apontam STATE_URL para ele (ou para outro serviço com o mesmo protocolo)
+
+# Rota POST /state/{method}
+async def state_handler(request: web.Request) -> web.Response:
+    method = request.match_info['method']
+    if method not in STATE_METHODS:
+        return web.json_response({'error': f"Operação desconhecida: {method}."}, status=404)
+    try:
+        arguments = await request.json()
+    except json.JSONDecodeError:
+        return web.json_response({'error': 'Corpo da requisição não é um JSON válido.'}, status=400)
+    backend = request.app['backend']
+    try:
+        result = await asyncio.to_thread(getattr(backend, method), **arguments)
+    except TypeError as e:
+        return web.json_response({'error': str(e)}, status=400)
+    return web.json_response({'result': result})
+
+# Rota GET /health
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({'status': 'ok', 'db': request.app['backend'].db_file})
+
+# Função para criar a aplicação HTTP do servidor de estado
+def create_app(db_file: str = STATE_DB_FILE) -> web.Application:
+    app = web.Application()
+    app['backend'] = SQLiteStateBackend(db_file)
+    app.router.add_post('/state/{method}', state_handler)
+    app.router.add_get('/health', health_handler)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor de estado compartilhado dos Agentes Alan Kay (backend 'http').")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--db', default=STATE_DB_FILE, help="Banco SQLite onde o estado é gravado.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(args.db), host=args.host, port=args.port)
@@ -0,0 +1,170 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Modo do transporte das chamadas à API (configurável por variável de ambiente):
+# 'passthrough' chama a Groq normalmente, 'record' chama e grava em um cassete, 'replay' responde a partir do cassete
+TRANSPORT_MODE = os.environ.get('TRANSPORT_MODE', 'passthrough')
+
+# Arquivo do cassete com os pares de requisição e resposta gravados
+CASSETTE_FILE = os.environ.get('CASSETTE_FILE', 'cassette.json')
+
+# Multiplicador da latência original na reprodução (0 responde sem espera)
+REPLAY_LATENCY_SCALE = float(os.environ.get('REPLAY_LATENCY_SCALE', 1.0))
+
+# Cabeçalhos de resposta que não são gravados, por dependerem da conexão original
+SKIPPED_RESPONSE_HEADERS = ('transfer-encoding', 'connection', 'content-length', 'content-encoding', 'set-cookie')
+
+TRANSPORT_MODES = ('passthrough', 'record', 'replay')
+
+_lock = threading.Lock()
+_http_clients = {}
+
+# Função para gerar a chave de uma requisição a partir do método, do caminho e do corpo (sem a chave de API)
+def interaction_key(method: str, path: str, body: bytes) -> str:
+    try:
+        normalized = json.dumps(json.loads(body or b"{}"), sort_keys=True, ensure_ascii=False)
+    except json.JSONDecodeError:
+        normalized = body.decode('utf-8', errors='replace')
+    return hashlib.sha256(f"{method} {path} {normalized}".encode('utf-8')).hexdigest()
+
+# Função para obter o modelo e o modo de streaming de uma requisição, usados quando não há correspondência exata
+def request_signature(body: bytes) -> str:
+    try:
+        payload = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        return ""
+    return f"{payload.get('model')}|{bool(payload.get('stream'))}"
+
+# Corpo de resposta que grava cada trecho com o instante de chegada e salva a interação ao ser fechado
+class RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, interaction: dict, start_time: float, transport: 'RecordingTransport'):
+        self.stream = stream
+        self.interaction = interaction
+        self.start_time = start_time
+        self.transport = transport
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.interaction['response']['chunks'].append([time.time() - self.start_time, base64.b64encode(chunk).decode('ascii')])
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+        self.interaction['elapsed'] = time.time() - self.start_time
+        self.transport.save_interaction(self.interaction)
+
+# Transporte que repassa as chamadas à API e grava requisição, resposta (inclusive limites de taxa) e tempos
+class RecordingTransport(httpx.BaseTransport):
+    def __init__(self, cassette_file: str = CASSETTE_FILE):
+        self.cassette_file = cassette_file
+        self.transport = httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        start_time = time.time()
+        response = self.transport.handle_request(request)
+        interaction = {
+            'key': interaction_key(request.method, request.url.path, body),
+            'signature': request_signature(body),
+            'request': {'method': request.method, 'path': request.url.path, 'body': body.decode('utf-8', errors='replace')},
+            'response': {
+                'status': response.status_code,
+                'headers': {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_RESPONSE_HEADERS},
+                'chunks': [],
+            },
+        }
+        # O corpo já chega decodificado ao cassete, então a codificação original não é repassada
+        headers = [(name, value) for name, value in response.headers.items() if name.lower() not in ('content-encoding', 'content-length')]
+        return httpx.Response(response.status_code, headers=headers, stream=RecordingStream(DecodedStream(response), interaction, start_time, self))
+
+    def save_interaction(self, interaction: dict):
+        with _lock:
+            interactions = []
+            if os.path.exists(self.cassette_file):
+                with open(self.cassette_file, 'r') as file:
+                    interactions = json.load(file)
+            interactions.append(interaction)
+            temp_path = f"{self.cassette_file}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(interactions, file, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.cassette_file)
+
+    def close(self):
+        self.transport.close()
+
+# Corpo de resposta já descomprimido, para que o cassete guarde o conteúdo legível
+class DecodedStream(httpx.SyncByteStream):
+    def __init__(self, response: httpx.Response):
+        self.response = response
+
+    def __iter__(self):
+        yield from self.response.iter_bytes()
+
+    def close(self):
+        self.response.close()
+
+# Corpo de resposta reproduzido: entrega cada trecho no instante gravado, multiplicado pela escala de latência
+class ReplayStream(httpx.SyncByteStream):
+    def __init__(self, chunks: list, start_time: float, latency_scale: float):
+        self.chunks = chunks
+        self.start_time = start_time
+        self.latency_scale = latency_scale
+
+    def __iter__(self):
+        for offset, data in self.chunks:
+            delay = self.start_time + offset * self.latency_scale - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield base64.b64decode(data)
+
+# Transporte que responde a partir do cassete, sem rede; requisições idênticas recebem as respostas na ordem gravada
+class ReplayTransport(httpx.BaseTransport):
+    def __init__(self, cassette_file: str = CASSETTE_FILE, latency_scale: float = REPLAY_LATENCY_SCALE):
+        self.latency_scale = latency_scale
+        with open(cassette_file, 'r') as file:
+            self.interactions = json.load(file)
+        self.used = set()
+
+    def next_interaction(self, key: str, signature: str) -> dict:
+        with _lock:
+            candidates = [index for index, interaction in enumerate(self.interactions) if interaction['key'] == key and index not in self.used]
+            if not candidates:
+                # Sem correspondência exata (por exemplo, o histórico mudou o prompt): usa a próxima gravação do mesmo modelo e modo
+                candidates = [index for index, interaction in enumerate(self.interactions) if interaction['signature'] == signature and index not in self.used]
+                if candidates:
+                    logger.warning("Requisição sem correspondência exata no cassete; usando a próxima gravação de %s", signature)
+            if not candidates:
+                return None
+            self.used.add(candidates[0])
+            return self.interactions[candidates[0]]
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = request.read()
+        interaction = self.next_interaction(interaction_key(request.method, request.url.path, body), request_signature(body))
+        if interaction is None:
+            raise httpx.ConnectError(f"Nenhuma gravação disponível no cassete para {request.method} {request.url.path}.", request=request)
+        recorded = interaction['response']
+        return httpx.Response(recorded['status'], headers=recorded['headers'], stream=ReplayStream(recorded['chunks'], time.time(), self.latency_scale))
+
+# Função para obter o cliente HTTP do modo configurado, um por modo; no modo 'passthrough' devolve None e a Groq usa
+# o cliente padrão
+def get_http_client(mode: str = None):
+    mode = mode or TRANSPORT_MODE
+    if mode not in TRANSPORT_MODES:
+        raise ValueError(f"Modo de transporte desconhecido: {mode}. Use um de {', '.join(TRANSPORT_MODES)}.")
+    if mode == 'passthrough':
+        return None
+    with _lock:
+        if mode not in _http_clients:
+            transport = RecordingTransport() if mode == 'record' else ReplayTransport()
+            _http_clients[mode] = httpx.Client(transport=transport)
+        return _http_clients[mode]